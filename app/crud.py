@@ -9,6 +9,10 @@ from sqlalchemy.types import Float
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.dialects.postgresql import UUID
 
+from app.services.alert_zones import ALERT_ZONE_KINDS, refresh_alert_zone_at
+from app.services.cta_queue import add_report_to_cta_queue
+from app.services.recent_reports import recent_reports
+
 # -----------------------------------------------------------------------------
 # Config / Logs
 # -----------------------------------------------------------------------------
@@ -186,6 +190,8 @@ async def insert_report(
         )
         report_id = res.scalar_one()
         await db.commit()
+        # index mémoire du contrôle de propriété des uploads
+        recent_reports.add(user_id, kind, signal, lat, lng, report_id)
         if LOG_AGG:
             print(
                 f"[report] inserted id={report_id} "
@@ -215,6 +221,18 @@ async def insert_report(
             if LOG_AGG and cleared:
                 print(f"[incident] cleared kind={kind} -> id={cleared}")
 
+        # Zones d'alerte matérialisées : on recalcule la cellule touchée
+        if signal == "cut" and kind in ALERT_ZONE_KINDS:
+            n = await refresh_alert_zone_at(db, kind, lat, lng)
+            if LOG_AGG:
+                print(f"[alert_zone] refreshed kind={kind} -> n={n}")
+
+        # File de travail CTA matérialisée
+        if signal == "to_clean":
+            added = await add_report_to_cta_queue(db, str(report_id))
+            if LOG_AGG:
+                print(f"[cta_queue] report {report_id} -> added={added}")
+
         await db.commit()
     except Exception as e:
         await db.rollback()
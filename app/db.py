@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import os
 import re
+import time
 from typing import AsyncGenerator
 
 from sqlalchemy.ext.asyncio import (
@@ -9,6 +10,11 @@ from sqlalchemy.ext.asyncio import (
     async_sessionmaker,
     create_async_engine,
 )
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from app.services.sql_timing import TimedAsyncSession, install_sql_timing
+from app.services import tracing
+from app.services.telemetry import db_pool_wait, register_collector
 
 # -------------------------------------------------------------------
 # DATABASE_URL : on nettoie sslmode pour asyncpg
@@ -25,6 +31,22 @@ else:
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL not set")
 
+# -------------------------------------------------------------------
+# Pool instrumenté : temps d'obtention d'une connexion (attente comprise)
+# -------------------------------------------------------------------
+def _timed_pool(label: str):
+    class _TimedPool(AsyncAdaptedQueuePool):
+        def _do_get(self):
+            t0 = time.perf_counter()
+            try:
+                return super()._do_get()
+            finally:
+                dt = time.perf_counter() - t0
+                db_pool_wait.observe(dt, label)
+                tracing.add("pool", dt)
+    return _TimedPool
+
+
 # -------------------------------------------------------------------
 # Engine async SQLAlchemy (sans connect_args, compatible asyncpg)
 # -------------------------------------------------------------------
@@ -33,14 +55,54 @@ engine = create_async_engine(
     echo=False,
     pool_pre_ping=True,
     future=True,
+    poolclass=_timed_pool("main"),
 )
 
 AsyncSessionLocal = async_sessionmaker(
     bind=engine,
     expire_on_commit=False,
-    class_=AsyncSession,
+    class_=TimedAsyncSession,
+)
+
+# -------------------------------------------------------------------
+# Pool séparé pour les exports (lectures longues en flux) :
+# borné, il ne peut pas épuiser les connexions de /report et /map
+# -------------------------------------------------------------------
+EXPORT_DB_POOL = int(os.getenv("EXPORT_DB_POOL", "3"))
+
+export_engine = create_async_engine(
+    DATABASE_URL,
+    echo=False,
+    pool_pre_ping=True,
+    future=True,
+    pool_size=EXPORT_DB_POOL,
+    max_overflow=0,
+    pool_timeout=float(os.getenv("EXPORT_DB_POOL_TIMEOUT", "120")),
+    poolclass=_timed_pool("export"),
+)
+
+ExportSessionLocal = async_sessionmaker(
+    bind=export_engine,
+    expire_on_commit=False,
+    class_=TimedAsyncSession,
 )
 
+install_sql_timing(engine.sync_engine, "main")
+install_sql_timing(export_engine.sync_engine, "export")
+
+
+def _pool_families():
+    pools = {"main": engine.sync_engine.pool, "export": export_engine.sync_engine.pool}
+    yield ("ayii_db_pool_size", "gauge", "Taille configurée du pool.",
+           [({"pool": k}, float(p.size())) for k, p in pools.items()])
+    yield ("ayii_db_pool_checked_out", "gauge", "Connexions empruntées.",
+           [({"pool": k}, float(p.checkedout())) for k, p in pools.items()])
+    yield ("ayii_db_pool_overflow", "gauge", "Connexions au-delà de pool_size (négatif = pool pas encore rempli).",
+           [({"pool": k}, float(p.overflow())) for k, p in pools.items()])
+
+
+register_collector(_pool_families)
+
 
 # -------------------------------------------------------------------
 # Dependency FastAPI
@@ -2,10 +2,11 @@
 import os
 import pathlib
 import hashlib
+import time
 from contextlib import asynccontextmanager
 
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request, Response
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.staticfiles import StaticFiles
 
@@ -17,6 +18,11 @@ from apscheduler.triggers.interval import IntervalTrigger
 from app.config import STATIC_DIR, STATIC_URL_PATH
 from app.db import get_db
 from app.services.aggregation import run_aggregation
+from app.services.export_jobs import shutdown_export_jobs
+from app.services.http_clients import http_clients
+from app.services.media import shutdown_media_pool
+from app.services import telemetry, tracing
+from app.services.uploads import UploadGuardMiddleware
 from app.routes import report_simple 
 
 # -----------------------------------------------------------------------------
@@ -40,11 +46,17 @@ async def lifespan(app: FastAPI):
         async def job():
             agen = get_db()
             db = await agen.__anext__()
+            t0 = time.perf_counter()
+            result = "ok"
             try:
-                await run_aggregation(db)
+                with telemetry.attribute("job:ayii_agg"):
+                    await run_aggregation(db)
             except Exception as e:
+                result = "error"
                 print(f"[scheduler] aggregation error: {e}")
             finally:
+                telemetry.job_duration.observe(time.perf_counter() - t0, "ayii_agg")
+                telemetry.job_runs.inc("ayii_agg", result)
                 try:
                     await agen.aclose()
                 except Exception:
@@ -61,6 +73,10 @@ async def lifespan(app: FastAPI):
     else:
         print("[scheduler] disabled via SCHEDULER_ENABLED=0")
 
+    # Clients HTTP partagés (Supabase, Nominatim) : pool + keep-alive
+    http_clients.open()
+    app.state.http_clients = http_clients
+
     app.state.scheduler = scheduler
     yield
 
@@ -68,6 +84,10 @@ async def lifespan(app: FastAPI):
         scheduler.shutdown(wait=False)
         print("[scheduler] stopped")
 
+    await http_clients.aclose()
+    shutdown_media_pool()
+    shutdown_export_jobs()
+
 # -----------------------------------------------------------------------------
 # App
 # -----------------------------------------------------------------------------
@@ -93,6 +113,10 @@ if extra:
 
 NETLIFY_REGEX = r"^https://[a-z0-9-]+(\-\-[a-z0-9-]+)?\.netlify\.app$"
 
+# Uploads : limite de taille et budget appliqués à la réception du corps
+# (ajouté avant CORS → monté à l'intérieur : les refus 413/503 portent les en-têtes CORS)
+app.add_middleware(UploadGuardMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=sorted(list(allowed_origins)),
@@ -100,7 +124,7 @@ app.add_middleware(
     allow_credentials=False,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=["Content-Disposition"],
+    expose_headers=["Content-Disposition", "x-trace-id"],
     max_age=86400,
 )
 
@@ -148,6 +172,23 @@ app.mount(STATIC_URL_PATH, StaticFiles(directory=STATIC_DIR), name="static")
 async def health():
     return {"ok": True}
 
+# -----------------------------------------------------------------------------
+# Métriques opérationnelles (format Prometheus) — distinctes de /metrics/* (métier)
+# -----------------------------------------------------------------------------
+app.add_middleware(tracing.ServerTimingMiddleware)
+app.add_middleware(telemetry.RequestMetricsMiddleware)
+
+@app.get("/internal/metrics", include_in_schema=False)
+async def internal_metrics(request: Request):
+    # fermé par défaut : trafic par route, pool et caches ne sont pas publics
+    if telemetry.METRICS_TOKEN:
+        auth = (request.headers.get("authorization") or "").strip()
+        if auth != f"Bearer {telemetry.METRICS_TOKEN}":
+            raise HTTPException(status_code=401, detail="invalid metrics token")
+    elif not telemetry.METRICS_PUBLIC:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return Response(telemetry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # -----------------------------------------------------------------------------
 # Dev helpers (uniquement en ENV=dev)
 # -----------------------------------------------------------------------------
@@ -243,3 +284,6 @@ for opt in ("reverse", "outages"):
         app.include_router(getattr(mod, "router"))
     except Exception:
         pass
+
+# Server-Timing : chaque endpoint note sa fin (→ temps de sérialisation)
+tracing.instrument_routes(app)
@@ -11,6 +11,12 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import text
 
 from app.db import get_db
+from app.services.attachment_links import attachment_links_ready
+from app.services.cta_queue import set_cta_status
+from app.services.resolution import set_report_status
+from app.services.result_cache import cta_queue_cache, metrics_cache
+from app.services.rollups import refresh_report_rollup_for
+from app.services.signed_cache import signed_url_cache
 
 router = APIRouter(prefix="/cta", tags=["CTA"])
 
@@ -38,72 +44,32 @@ async def cta_ping():
 # - si url publique Supabase -> génère une URL signée courte
 # - sinon renvoie l'url telle quelle
 # -------------------------
-# -------------------------
-# Signature Supabase robuste (normalise /storage/v1/)
-# -------------------------
 async def _supabase_sign_url_if_possible(url: Optional[str], expires_sec: int = 300) -> Optional[str]:
     if not url:
         return url
-
-    import os
-    supa_url = (os.getenv("SUPABASE_URL") or "").rstrip("/")
-    supa_key = os.getenv("SUPABASE_SERVICE_ROLE") or os.getenv("SUPABASE_SERVICE_KEY")
-    if not (supa_url and supa_key):
-        return url  # pas de signature possible
-
-    marker = "/storage/v1/object/public/"
-    if marker not in url:
-        # pas une URL publique Supabase → on ne touche pas
-        return url
-
-    # extrait bucket + path, ex:
-    # https://.../storage/v1/object/public/attachments/fire/xxx.jpg
-    after = url.split(marker, 1)[1]                     # "attachments/fire/xxx.jpg"
-    parts = after.split("/", 1)
-    bucket = parts[0]
-    path = parts[1] if len(parts) > 1 else ""
-
-    # signe
-    import httpx
-    sign_endpoint = f"{supa_url}/storage/v1/object/sign/{bucket}/{path}"
-    payload = {"expiresIn": int(expires_sec)}
-    headers = {"Authorization": f"Bearer {supa_key}", "Content-Type": "application/json"}
-
-    try:
-        async with httpx.AsyncClient(timeout=10) as client:
-            r = await client.post(sign_endpoint, headers=headers, json=payload)
-        if r.status_code not in (200, 201):
-            return url
-        data = r.json()
-        signed_path = data.get("signedURL") or data.get("signedUrl") or ""
-
-        # ⚠️ normalisation du chemin renvoyé par Supabase
-        if signed_path.startswith("http"):
-            return signed_path
-        if signed_path.startswith("/storage/v1/"):
-            return f"{supa_url}{signed_path}"
-        if signed_path.startswith("/object/"):
-            return f"{supa_url}/storage/v1{signed_path}"
-        if signed_path.startswith("object/"):
-            return f"{supa_url}/storage/v1/{signed_path}"
-
-        # dernier recours : on reconstruit manuellement
-        return f"{supa_url}/storage/v1/object/sign/{bucket}/{path}?{signed_path.split('?',1)[-1]}" if "?" in signed_path \
-               else f"{supa_url}/storage/v1/object/sign/{bucket}/{path}"
-    except Exception:
-        return url
+    return (await signed_url_cache.get(url, link_ttl_sec=expires_sec)) or url
 
 
 
 # -------------------------
 # Lecture incidents pour CTA
 # - On liste des reports "new|confirmed|resolved" (défaut: new)
-# - On associe une photo de proximité via attachments (même kind, 48h, 120m)
+# - On associe la photo la plus récente liée au report (attachments.report_id)
 # -------------------------
 DEFAULT_LIMIT = 50
 
-def _sql_incidents(filter_by_status: bool) -> str:
+def _sql_incidents(filter_by_status: bool, linked: bool = True) -> str:
     where_status = "AND r.status = :status" if filter_by_status else ""
+    # attachments.report_id pas encore créée (/admin/ensure_schema) → pas de photo
+    photo = """
+          LEFT JOIN LATERAL (
+            SELECT a.url
+            FROM attachments a
+            WHERE a.report_id = b.id
+            ORDER BY a.created_at DESC
+            LIMIT 1
+          ) ph ON TRUE""" if linked else """
+          LEFT JOIN LATERAL (SELECT NULL::text AS url) ph ON TRUE"""
     # NOTE: on cible uniquement les reports 'cut' comme événements d'ouverture
     #       Le statut (new/confirmed/resolved) vit dans reports.status
     return f"""
@@ -125,18 +91,8 @@ def _sql_incidents(filter_by_status: bool) -> str:
         with_photo AS (
           SELECT
             b.*,
-            (
-              SELECT a.url
-              FROM attachments a
-              WHERE a.kind::text = b.kind
-                AND a.created_at > NOW() - INTERVAL '48 hours'
-                AND ST_DWithin((a.geom::geography),
-                               (ST_SetSRID(ST_MakePoint(b.lng,b.lat),4326)::geography),
-                               120)
-              ORDER BY a.created_at DESC
-              LIMIT 1
-            ) AS photo_url
-          FROM base b
+            ph.url AS photo_url
+          FROM base b{photo}
         )
         SELECT * FROM with_photo
         ORDER BY created_at DESC
@@ -151,17 +107,18 @@ async def list_incidents(
 ):
     params: Dict[str, Any] = {"limit": int(limit)}
     rows = []
+    linked = await attachment_links_ready(db)
     try:
         if status:
             params["status"] = status.strip().lower()
-            q = text(_sql_incidents(filter_by_status=True))
+            q = text(_sql_incidents(filter_by_status=True, linked=linked))
         else:
-            q = text(_sql_incidents(filter_by_status=False))
+            q = text(_sql_incidents(filter_by_status=False, linked=linked))
         rows = (await db.execute(q, params)).mappings().all()
     except Exception as e:
         # fallback sans status si colonne absente
         try:
-            q = text(_sql_incidents(filter_by_status=False))
+            q = text(_sql_incidents(filter_by_status=False, linked=linked))
             rows = (await db.execute(q, {"limit": int(limit)})).mappings().all()
         except Exception as e2:
             raise HTTPException(status_code=500, detail=f"incidents query failed: {e2}")
@@ -176,10 +133,14 @@ async def list_incidents(
             d["age_min"] = int((now - created).total_seconds() // 60) if created else None
         except Exception:
             d["age_min"] = None
-        # URL signée si possible
-        d["photo_url"] = await _supabase_sign_url_if_possible(d.get("photo_url"), expires_sec=300)
         out.append(d)
 
+    # URLs signées si possible : cache partagé, ratés signés en un seul lot
+    signed = await signed_url_cache.get_many([d.get("photo_url") for d in out], link_ttl_sec=300, db=db)
+    for d in out:
+        if d.get("photo_url"):
+            d["photo_url"] = signed.get(d["photo_url"]) or d["photo_url"]
+
     return {"items": out, "count": len(out)}
 
 # -------------------------
@@ -207,18 +168,22 @@ async def mark_status(
         await db.rollback()
 
     try:
-        q = text("""
-            UPDATE reports
-               SET status = :s
-             WHERE id = CAST(:id AS uuid)
-         RETURNING id
-        """)
-        rs = await db.execute(q, {"s": new_status, "id": str(p.id)})
-        row = rs.first()
+        # update + transition journalisée + délai de résolution, dans la même transaction
+        row = await set_report_status(db, str(p.id), new_status)
+        if row:
+            await set_cta_status(db, str(p.id), new_status)
         await db.commit()
         if not row:
             raise HTTPException(status_code=404, detail="report not found")
-        return {"ok": True, "id": str(p.id), "status": new_status}
+        # l'opérateur doit voir son changement tout de suite (file CTA, compteurs par status)
+        cta_queue_cache.invalidate()
+        metrics_cache.invalidate()
+        try:
+            await refresh_report_rollup_for(db, str(p.id))
+        except Exception as e:
+            await db.rollback()
+            print(f"[rollups] status hook failed: {e}")
+        return {"ok": True, "id": str(p.id), "status": new_status, "prev_status": row["prev_status"]}
     except HTTPException:
         raise
     except Exception as e:
@@ -1,10 +1,11 @@
 # app/routes/cta.py
 from fastapi import APIRouter, Depends, HTTPException, Query, Request
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import text
 import os
 
 from app.db import get_db
+from app.services.cta_queue import read_cta_queue
+from app.services.result_cache import cta_queue_cache
 
 router = APIRouter(prefix="/cta", tags=["CTA"])
 
@@ -21,107 +22,20 @@ async def cta_incidents_v2(
     status: str = Query("", description="new|confirmed|resolved"),
     limit: int = Query(20, ge=1, le=200),
     debug: int = Query(0, description="1 = renvoyer l'erreur détaillée"),
+    order: str = Query("recent", description="recent|severity"),
     db: AsyncSession = Depends(get_db),
 ):
     _auth_admin(request)
 
-    where_status = (
-        "AND COALESCE(r.status,'new') = :status"
-        if (status or "").strip().lower() in {"new", "confirmed", "resolved"}
-        else ""
-    )
-
-    sql = f"""
-    SELECT
-      r.id,
-      r.kind::text   AS kind,
-      r.signal::text AS signal,
-      ST_Y(r.geom::geometry) AS lat,
-      ST_X(r.geom::geometry) AS lng,
-      r.created_at,
-      COALESCE(r.status,'new') AS status,
-      r.phone,
-
-      -- 📎 Média le plus récent lié au report (fenêtre serrée autour du report)
-      (
-        SELECT a.url
-        FROM attachments a
-        WHERE LOWER(TRIM(a.kind::text)) = LOWER(TRIM(r.kind::text))
-          AND ST_DWithin(a.geom::geography, r.geom::geography, 30)
-          AND a.created_at BETWEEN r.created_at - INTERVAL '30 seconds'
-                              AND r.created_at + INTERVAL '90 seconds'
-        ORDER BY a.created_at DESC
-        LIMIT 1
-      ) AS photo_url,
-
-      -- 📊 Nombre de pièces jointes liées au report (même fenêtre serrée)
-      (
-        SELECT COUNT(*)::int
-        FROM attachments a
-        WHERE LOWER(TRIM(a.kind::text)) = LOWER(TRIM(r.kind::text))
-          AND ST_DWithin(a.geom::geography, r.geom::geography, 30)
-          AND a.created_at BETWEEN r.created_at - INTERVAL '30 seconds'
-                              AND r.created_at + INTERVAL '90 seconds'
-      ) AS attachments_count,
-
-      -- 👥 Nombre de reports proches du même type (rayon ~50 m)
-      (
-        SELECT COUNT(*)::int
-        FROM reports r2
-        WHERE r2.kind = r.kind
-          AND LOWER(TRIM(r2.signal::text)) = 'to_clean'
-          AND ST_DWithin(r2.geom::geography, r.geom::geography, 50)
-      ) AS reports_count,
-
-      -- ⏱ âge en minutes
-      EXTRACT(EPOCH FROM (NOW() - r.created_at))::int / 60 AS age_min
-
-    FROM reports r
-    WHERE LOWER(TRIM(r.signal::text)) = 'to_clean'
-      {where_status}
-    ORDER BY r.created_at DESC
-    LIMIT :lim
-    """
-
-
-    params = {"lim": int(limit)}
-    if "status" in where_status:
-        params["status"] = status.strip().lower()
+    st = (status or "").strip().lower()
+    st = st if st in {"new", "confirmed", "resolved"} else ""
+    od = "severity" if (order or "").strip().lower() == "severity" else "recent"
 
     try:
-        res = await db.execute(text(sql), params)
-        rows = res.fetchall()
-
-        items = []
-        for r in rows:
-            m = r._mapping
-            items.append(
-                {
-                    "id": m.get("id"),
-                    "kind": m.get("kind"),
-                    "signal": m.get("signal"),
-                    "lat": float(m.get("lat")),
-                    "lng": float(m.get("lng")),
-                    "created_at": m.get("created_at"),
-                    "status": m.get("status"),
-                    "phone": m.get("phone"),
-                    "photo_url": m.get("photo_url"),
-                    "attachments_count": int(m.get("attachments_count") or 0),
-                    "reports_count": int(m.get("reports_count") or 0),
-                    "age_min": (
-                        int(m.get("age_min"))
-                        if m.get("age_min") is not None
-                        else None
-                    ),
-                }
-            )
-
-        return {
-            "api_version": "v2-proprete",
-            "items": items,
-            "count": len(items),
-        }
-
+        # file partagée entre opérateurs : cache court + un seul calcul par jeu de paramètres
+        return await cta_queue_cache.get(
+            ("v2", st, int(limit), od), lambda s: _load_incidents_v2(s, st, int(limit), od), db,
+        )
     except Exception as e:
         if debug:
             raise HTTPException(
@@ -131,12 +45,50 @@ async def cta_incidents_v2(
         raise HTTPException(status_code=500, detail="cta_incidents_v2 error")
 
 
+async def _load_incidents_v2(db: AsyncSession, status: str, limit: int, order: str = "recent") -> dict:
+    # top-N indexé sur la file matérialisée (média, compteurs et status tenus à l'écriture)
+    rows = await read_cta_queue(db, status=status, limit=limit, order=order)
+
+    items = []
+    for m in rows:
+        items.append(
+            {
+                "id": m.get("id"),
+                "kind": m.get("kind"),
+                "signal": m.get("signal"),
+                "lat": float(m.get("lat")),
+                "lng": float(m.get("lng")),
+                "created_at": m.get("created_at"),
+                "status": m.get("status"),
+                "phone": m.get("phone"),
+                "photo_url": m.get("photo_url"),
+                "thumb_url": m.get("thumb_url"),
+                "attachments_count": int(m.get("attachments_count") or 0),
+                "reports_count": int(m.get("reports_count") or 0),
+                "severity": int(m.get("severity") or 0),
+                "age_min": (
+                    int(m.get("age_min"))
+                    if m.get("age_min") is not None
+                    else None
+                ),
+            }
+        )
+
+    return {
+        "api_version": "v2-proprete",
+        "order": order,
+        "items": items,
+        "count": len(items),
+    }
+
+
 @router.get("/incidents")
 async def cta_incidents(
     request: Request,
     status: str = Query("", description="new|confirmed|resolved"),
     limit: int = Query(20, ge=1, le=200),
     debug: int = Query(0),
+    order: str = Query("recent", description="recent|severity"),
     db: AsyncSession = Depends(get_db),
 ):
-    return await cta_incidents_v2(request, status, limit, debug, db)
+    return await cta_incidents_v2(request, status, limit, debug, order, db)
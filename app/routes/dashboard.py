@@ -89,37 +89,7 @@ async def dashboard_page():
            : '•';
     }
 
-    // Gravité (front-only, adaptée propreté)
-    function severityScore(x){
-      const kind=String(x.kind||'').toLowerCase();
-      const ageMin=Number.isFinite(+x.age_min)?+x.age_min:9999;
-      const hasPhoto=!!x.photo_url;
-      const reports=Number(x.reports_count||0);
-      const attach=Number(x.attachments_count||0);
-
-      const W = {
-        blood:       30,
-        syringe:     30,
-        feces:       22,
-        broken_glass:18,
-        vomit:       14,
-        urine:       10
-      };
-
-      let s = W[kind] ?? 8;
-
-      if(ageMin<=5)      s+=25;
-      else if(ageMin<=15) s+=18;
-      else if(ageMin<=60) s+=8;
-      else if(ageMin<=180)s+=3;
-
-      if(hasPhoto) s+=10;
-      s+=Math.min(20, reports*4);
-      s+=Math.min(12, attach*3);
-
-      return Math.max(0,Math.min(100,Math.round(s)));
-    }
-
+    // Gravité : calculée côté serveur (/cta/incidents_v2 → severity)
     function severityChip(score){
       const lv = score>=60?'high':score>=30?'med':'low';
       const label = lv==='high'?'Élevée':lv==='med'?'Moyenne':'Faible';
@@ -130,10 +100,11 @@ async def dashboard_page():
 
     const api = {
       // 👉 on utilise /cta/incidents_v2
-      incidents:(token,{status,limit})=>{
+      incidents:(token,{status,limit,order})=>{
         const u = new URL('/cta/incidents_v2', location.origin);
         if (status) u.searchParams.set('status', status);
         u.searchParams.set('limit', limit || 200);
+        if (order) u.searchParams.set('order', order);
         return fetch(u, { headers:{'x-admin-token':token} })
           .then(r => {
             if (!r.ok) throw new Error('HTTP ' + r.status);
@@ -152,7 +123,7 @@ async def dashboard_page():
     const state = {
       items: [],
       token: localStorage.getItem('ayii_admin_token') || '',
-      filters: { status:'', kind:'', limit:100, q:'' }
+      filters: { status:'', kind:'', limit:100, q:'', order:'recent' }
     };
 
     function updateExportLinks(){
@@ -163,8 +134,10 @@ async def dashboard_page():
 
     function buildThumbHTML(item){
       const icon = iconKind(item.kind);
-      const url  = item.photo_url || "";
-      const isVideo = url && (/\.(mp4|webm|mov)(\?|$)/i.test(url));
+      const full = item.photo_url || "";
+      const isVideo = full && (/\.(mp4|webm|mov)(\?|$)/i.test(full));
+      // miniature générée côté serveur si dispo (évite de charger l'original)
+      const url  = (!isVideo && item.thumb_url) ? item.thumb_url : full;
 
       return `
         <div class="thumbbox">
@@ -173,10 +146,10 @@ async def dashboard_page():
             url
               ? (
                   isVideo
-                    ? `<video class="thumb" src="${url}" muted loop playsinline
+                    ? `<video class="thumb" src="${url}" muted playsinline preload="metadata"
                            onloadeddata="this.previousElementSibling.style.display='none'">
                        </video>`
-                    : `<img class="thumb" src="${url}" alt="${item.kind||''}"
+                    : `<img class="thumb" src="${url}" alt="${item.kind||''}" loading="lazy" decoding="async"
                            onload="this.previousElementSibling.style.display='none'"
                            onerror="this.style.display='none'; this.previousElementSibling.style.display='flex'">`
                 )
@@ -207,7 +180,10 @@ async def dashboard_page():
         );
 
       const ts = d => Date.parse(d?.created_at || 0) || 0;
-      data.sort((a,b)=> ts(b) - ts(a));
+      if (state.filters.order === 'severity')
+        data.sort((a,b)=> (b.severity||0) - (a.severity||0) || ts(b) - ts(a));
+      else
+        data.sort((a,b)=> ts(b) - ts(a));
 
       $('#summary').textContent = data.length + ' signalement(s) propreté';
       const tpl = $('#tpl-row');
@@ -222,7 +198,7 @@ async def dashboard_page():
         const chip = $('.chip', frag);
         chip.textContent = st;
         chip.classList.add('chip-' + st);
-        chip.insertAdjacentHTML('afterend', ' ' + severityChip(severityScore(x)));
+        chip.insertAdjacentHTML('afterend', ' ' + severityChip(x.severity ?? 0));
 
         $('[data-id]',  frag).textContent = (x.id || '').slice(0,8);
         $('[data-geo]', frag).textContent = (+x.lat).toFixed(5) + ', ' + (+x.lng).toFixed(5);
@@ -271,18 +247,11 @@ async def dashboard_page():
       try{
         const data = await api.incidents(state.token, {
           status: state.filters.status,
-          limit: state.filters.limit
+          limit: state.filters.limit,
+          order: state.filters.order
         });
 
-        const items = (data.items || []).map(x => ({
-          ...x,
-          // champs de confort pour la gravité
-          reports_count: x.reports_count ?? 1,
-          attachments_count: x.attachments_count ?? (x.photo_url ? 1 : 0),
-          age_min: x.age_min ?? null,
-        }));
-
-        state.items = items;
+        state.items = data.items || [];
         $('#auth-status').textContent='OK';
       }catch(e){
         console.error(e);
@@ -310,6 +279,7 @@ async def dashboard_page():
       $('#f-kind').onchange  =e=>{ state.filters.kind  =e.target.value; render(); };
       $('#f-limit').onchange =e=>{ state.filters.limit =+e.target.value; load(); };
       $('#f-search').oninput =e=>{ state.filters.q     =e.target.value; render(); };
+      $('#f-order').onchange =e=>{ state.filters.order =e.target.value; load(); };
       $('#btn-refresh').onclick=()=>load();
       load();
       setInterval(()=>{ if(state.token) load(); }, 60000);
@@ -344,7 +314,7 @@ async def dashboard_page():
 
       <div class="md:col-span-3 card p-4 space-y-3">
         <h2 class="font-semibold">Filtres</h2>
-        <div class="grid md:grid-cols-4 gap-3">
+        <div class="grid md:grid-cols-5 gap-3">
           <div>
             <label class="text-xs" style="color:var(--muted)">Statut</label>
             <select id="f-status" class="w-full rounded-xl border px-3 py-2" style="border-color:var(--ring); background:var(--card); color:var(--fg);">
@@ -375,6 +345,13 @@ async def dashboard_page():
               <option>500</option>
             </select>
           </div>
+          <div>
+            <label class="text-xs" style="color:var(--muted)">Tri</label>
+            <select id="f-order" class="w-full rounded-xl border px-3 py-2" style="border-color:var(--ring); background:var(--card); color:var(--fg);">
+              <option value="recent" selected>Plus récents</option>
+              <option value="severity">Gravité</option>
+            </select>
+          </div>
           <div>
             <label class="text-xs" style="color:var(--muted)">Recherche</label>
             <input id="f-search" class="w-full rounded-xl border px-3 py-2" style="border-color:var(--ring); background:var(--card); color:var(--fg);" placeholder="note, id…" />
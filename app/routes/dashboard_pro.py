@@ -52,6 +52,7 @@ async def dashboard_pro():
           <div class="flex items-center justify-between"><span class="label">Nouveaux</span><span class="value" id="sum_new">--</span></div>
           <div class="flex items-center justify-between"><span class="label">Confirmés</span><span class="value" id="sum_confirmed">--</span></div>
           <div class="flex items-center justify-between"><span class="label">Résolus</span><span class="value" id="sum_resolved">--</span></div>
+          <div class="flex items-center justify-between"><span class="label">Délai moyen de résolution</span><span class="value" id="sum_avg_res">--</span></div>
         </div>
       </div>
 
@@ -95,6 +96,34 @@ async def dashboard_pro():
       </div>
     </section>
 
+    <section class="grid-cards">
+      <div class="card col-span-12 lg:col-span-4">
+        <div class="flex items-center justify-between mb-4">
+          <h2 class="font-semibold">Délais de résolution (30j)</h2>
+          <div class="pill" id="res_target">--</div>
+        </div>
+        <div class="space-y-3">
+          <div class="flex items-center justify-between"><span class="label">Résolutions</span><span class="value" id="res_n">--</span></div>
+          <div class="flex items-center justify-between"><span class="label">Médiane (p50)</span><span class="value" id="res_p50">--</span></div>
+          <div class="flex items-center justify-between"><span class="label">p90 / p99</span><span class="value" id="res_p90">--</span></div>
+          <div class="flex items-center justify-between"><span class="label">Dans l'objectif</span><span class="value" id="res_sla">--</span></div>
+          <div class="flex items-center justify-between"><span class="label">Ouverts hors objectif</span><span class="value" id="res_over">--</span></div>
+        </div>
+      </div>
+
+      <div class="card col-span-12 lg:col-span-8">
+        <div class="flex items-center justify-between mb-4">
+          <h2 class="font-semibold">Résolution par type (30j)</h2>
+          <select id="resBy" class="border px-2 py-1 rounded-lg">
+            <option value="kind">Par type</option>
+            <option value="line">Par ligne</option>
+            <option value="day">Par jour</option>
+          </select>
+        </div>
+        <div id="resTable" class="overflow-auto"></div>
+      </div>
+    </section>
+
     <footer class="text-center text-xs text-gray-500 pt-6">© AYii – CTA Dashboard (Propreté)</footer>
   </div>
 
@@ -144,10 +173,56 @@ async def dashboard_pro():
       $("#sum_new").textContent=j.total?.n_new ?? "--";
       $("#sum_confirmed").textContent=j.total?.n_confirmed ?? "--";
       $("#sum_resolved").textContent=j.total?.n_resolved ?? "--";
+      $("#sum_avg_res").textContent=fmtMin(j.avg_to_resolved_min);
       $("#serverNow").textContent=(j.server_now||"").replace("T"," ").replace("Z","");
     }catch(e){ console.error(e); }
   }
 
+  // Délais de résolution / SLA
+  function fmtMin(m){
+    if(m==null) return "--";
+    if(m<120) return `${Math.round(m)} min`;
+    if(m<2880) return `${(m/60).toFixed(1)} h`;
+    return `${(m/1440).toFixed(1)} j`;
+  }
+  function fmtPct(x){ return (x==null)? "--" : `${Math.round(x*100)} %`; }
+  async function loadResolution(){
+    try{
+      const by=$("#resBy").value||"kind";
+      const j=await getJSON(api(`/metrics/resolution?days=30&by=${encodeURIComponent(by)}`));
+      const o=j.overall||{};
+      $("#res_target").textContent=`Objectif ${fmtMin(j.target_min)}`;
+      $("#res_n").textContent=o.n ?? 0;
+      $("#res_p50").textContent=fmtMin(o.p50_min);
+      $("#res_p90").textContent=`${fmtMin(o.p90_min)} / ${fmtMin(o.p99_min)}`;
+      $("#res_sla").textContent=fmtPct(o.within_sla);
+      $("#res_over").textContent=j.open_over_target ?? "--";
+      const col=by==="line"?"line_code":by;
+      const rows=(j.items||[]).map(r=>`
+        <tr class="border-b last:border-none">
+          <td class="p-2 font-medium">${r[col]||"—"}</td>
+          <td class="p-2">${r.n}</td>
+          <td class="p-2">${fmtMin(r.avg_min)}</td>
+          <td class="p-2">${fmtMin(r.p50_min)}</td>
+          <td class="p-2">${fmtMin(r.p90_min)}</td>
+          <td class="p-2">${fmtMin(r.p99_min)}</td>
+          <td class="p-2">${fmtPct(r.within_sla)}</td>
+        </tr>`).join("");
+      $("#resTable").innerHTML = `
+        <table class="w-full text-sm">
+          <thead>
+            <tr class="text-left text-gray-500 border-b">
+              <th class="p-2">${by==="line"?"Ligne":by==="day"?"Jour":"Type"}</th>
+              <th class="p-2">n</th><th class="p-2">Moyenne</th>
+              <th class="p-2">p50</th><th class="p-2">p90</th><th class="p-2">p99</th>
+              <th class="p-2">Dans l'objectif</th>
+            </tr>
+          </thead>
+          <tbody>${rows || `<tr><td class="p-2 text-gray-400" colspan="7">Aucune résolution sur la période</td></tr>`}</tbody>
+        </table>`;
+    }catch(e){ console.error(e); }
+  }
+
   // Timeseries
   let tsChart;
   async function loadTimeseries(){
@@ -188,32 +263,7 @@ async def dashboard_pro():
     }catch(e){ console.error(e); }
   }
 
-  // Gravité (propreté)
-  function severityScore(x){
-    const kind=String(x.kind||'').toLowerCase();
-    const ageMin=Number.isFinite(+x.age_min)?+x.age_min:9999;
-    const hasPhoto=!!x.photo_url;
-    const reports=Number(x.reports_count||0);
-    const attach=Number(x.attachments_count||0);
-    const W={
-      blood:30,
-      syringe:30,
-      feces:22,
-      broken_glass:18,
-      vomit:14,
-      urine:10
-    };
-
-    let s=W[kind] ?? 8;
-    if(ageMin<=5)      s+=25;
-    else if(ageMin<=15)s+=18;
-    else if(ageMin<=60)s+=8;
-    else if(ageMin<=180)s+=3;
-    if(hasPhoto) s+=10;
-    s+=Math.min(20, reports*4);
-    s+=Math.min(12, attach*3);
-    return Math.max(0,Math.min(100,Math.round(s)));
-  }
+  // Gravité : calculée côté serveur (/cta/incidents_v2 → severity)
   function severityPill(score){
     const lv=score>=60?'high':score>=30?'med':'low';
     const label=lv==='high'?'Élevée':lv==='med'?'Moyenne':'Faible';
@@ -231,7 +281,7 @@ async def dashboard_pro():
     );
 
     const rows=filtered.map(it=>{
-      const sev=severityScore(it);
+      const sev=it.severity ?? 0;
       const highlight = focusId && String(it.id) === focusId;
       return `
       <tr class="border-b last:border-none hover:bg-gray-50${highlight ? " bg-yellow-50" : ""}" data-incid="${it.id}">
@@ -291,8 +341,6 @@ async def dashboard_pro():
           ...it,
           status: it.status || 'new',
           age_min: it.age_min ?? null,
-          reports_count: it.reports_count ?? 1,
-          attachments_count: it.attachments_count ?? (it.photo_url ? 1 : 0),
         }))
         .sort(
           (a,b) =>
@@ -315,9 +363,10 @@ async def dashboard_pro():
 
   $("#reloadTS").onclick=loadTimeseries;
   $("#reloadInc").onclick=loadIncidents;
+  $("#resBy").onchange=loadResolution;
 
   async function loadAll(){ 
-    await Promise.all([loadSummary(), loadTimeseries(), loadPieKind(), loadIncidents()]); 
+    await Promise.all([loadSummary(), loadTimeseries(), loadPieKind(), loadIncidents(), loadResolution()]); 
   }
 
   if((localStorage.getItem(tokenKey)||"").trim()) loadAll();
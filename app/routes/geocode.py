@@ -1,6 +1,7 @@
 # app/routes/geocode.py
 from fastapi import APIRouter, Query
-import httpx
+
+from app.services.http_clients import http_clients
 
 router = APIRouter()
 
@@ -14,13 +15,10 @@ async def reverse(lat: float = Query(...), lng: float = Query(...)):
         "accept-language": "fr",
         "zoom": 16
     }
-    headers = {
-        "User-Agent": "AWO/1.0 (contact: support@awo.local)"
-    }
-    async with httpx.AsyncClient(timeout=8.0, headers=headers) as client:
-        r = await client.get(url, params=params)
-        r.raise_for_status()
-        j = r.json()
+    # User-Agent + timeout portés par le profil "nominatim" du client partagé
+    r = await http_clients.request("nominatim", "GET", url, params=params)
+    r.raise_for_status()
+    j = r.json()
     addr = j.get("address", {})
     label = addr.get("neighbourhood") or addr.get("suburb") or addr.get("city_district") or addr.get("village") or addr.get("town") or addr.get("city") or j.get("display_name", "")
     return {
@@ -7,98 +7,78 @@ from fastapi import (
     APIRouter, Depends, HTTPException, Query, Response, Request, Header,
     UploadFile, File, Form, Body
 )
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import text
-from typing import Optional, Any, List
+from typing import Optional, Any, Dict, List
 from uuid import UUID
 from datetime import datetime, timezone
 import os, uuid, mimetypes, io, csv, json, time
 
 from app.db import get_db
 from app.config import BASE_PUBLIC_URL, STATIC_DIR, STATIC_URL_PATH  # constants only (no circular import)
+from app.services.alert_zones import (
+    ALERT_ZONE_CELL_M, ALERT_ZONE_KINDS, ALERT_ZONE_WINDOW_H,
+    ensure_alert_zones_schema, read_alert_zones, suppress_alert_zones_near,
+)
+from app.services.uploads import (
+    IMAGE_MAX_BYTES, VIDEO_DIRECT_MAX_BYTES, VIDEO_DIRECT_TOO_LARGE, VIDEO_MAX_BYTES,
+    StorageUploadError, UploadStream, upload_budget,
+)
+from app.services.storage import LocalStorage, get_storage, local_storage, storage_stats
+from app.services import resumable
+from app.services.attachment_links import (
+    backfill_attachment_links, ensure_attachment_links_schema, resolve_owned_report,
+)
+from app.services.ddl import present_columns
+from app.services.dedup import dedup_stats, ensure_dedup_schema, find_blob
+from app.services.media import (
+    MEDIA_KEEP_ORIGINAL, discard_local, ensure_media_schema, ingest_available, ingest_image, media_ready,
+    media_stats, schedule_variants, spool_source, spool_upload,
+)
+from app.services import export_jobs
+from app.services.exports import (
+    EXPORT_MAX_ROWS, count_rows, csv_chunks, export_stats, geojson_chunks, parquet_available, parquet_chunks,
+)
+from app.services.cta_queue import fill_cta_queue_if_empty, rebuild_cta_queue, refresh_cta_media
+from app.services.recent_reports import recent_reports
+from app.services.resolution import ensure_resolution_schema, reset_resolution
+from app.services.result_cache import cta_queue_cache, result_cache_stats
+from app.services.rollups import (
+    ensure_rollups_schema, event_stats, rebuild_rollups, report_counts, reset_rollups, rollups_stats,
+)
+from app.services.sql_timing import sql_reset, sql_top
+from app.services.tracing import span, trace_get, trace_list, tracing_stats
+from app.services.retention import (
+    RETENTION_BATCH, ensure_retention_schema, reconcile_orphans, retention_stats, run_retention,
+)
 
 router = APIRouter()
 
-# Si Python < 3.10, dé-commente la ligne suivante et remplace l’annotation de _signed_cache plus bas
-# from typing import Dict, Tuple
-
 # ---- Supabase URL signer ----
 import os
 import httpx
 
+from app.services.http_clients import http_clients
+from app.services.signed_cache import ensure_signed_url_schema, signed_url_cache
+
 async def _supabase_sign_url(public_or_path: str, expires_sec: int = 300) -> str | None:
     """
     Prend une URL publique Supabase OU juste un chemin, et renvoie une URL signée.
     Si Supabase n’est pas configuré → None.
     """
-    supa_url = (os.getenv("SUPABASE_URL") or "").rstrip("/")
-    supa_key = (
-        os.getenv("SUPABASE_SERVICE_ROLE")
-        or os.getenv("SUPABASE_SERVICE_KEY")
-        or os.getenv("SUPABASE_ANON_KEY")
-    )
-    bucket = os.getenv("SUPABASE_BUCKET", "attachments")
-
-    # si on n'a pas au moins l'URL et une clé → on ne signe pas
-    if not supa_url or not supa_key:
-      # tu peux logger ici si tu veux
-      return None
-
-    # normaliser le chemin à signer
-    if "/storage/v1/object/public/" in public_or_path:
-        # on a reçu une URL complète
-        try:
-            after = public_or_path.split("/storage/v1/object/public/")[1]
-        except Exception:
-            return None
-    else:
-        # on a reçu juste le chemin
-        p = public_or_path.strip().lstrip("/")
-        # on s'assure que ça commence par le bucket
-        after = p if p.startswith(bucket + "/") else f"{bucket}/{p}"
-
-    sign_endpoint = f"{supa_url}/storage/v1/object/sign/{after}"
-
-    try:
-        headers = {
-            "Authorization": f"Bearer {supa_key}",
-            "Content-Type": "application/json",
-        }
-        payload = {"expiresIn": int(expires_sec)}
-        async with httpx.AsyncClient(timeout=10) as client:
-            r = await client.post(sign_endpoint, headers=headers, json=payload)
-
-        if r.status_code not in (200, 201):
-            # ici pareil tu peux logger r.text
-            return None
-
-        data = r.json()
-        signedURL = data.get("signedURL") or data.get("signedUrl")
-        if not signedURL:
-            return None
-
-        # on reconstruit une URL complète
-        return (f"{supa_url}/storage/v1/{signedURL}").replace(
-            "/storage/v1//", "/storage/v1/"
-        )
-    except Exception:
-        return None
-
-# Si Python ≥ 3.10
-_signed_cache: dict[str, tuple[float, str]] = {}  # url -> (expires_at, signed_url)
-# Si Python < 3.10, utilise plutôt :
-# _signed_cache: Dict[str, Tuple[float, str]] = {}
+    return (await get_storage().sign_many([public_or_path], expires_sec=expires_sec)).get(public_or_path)
 
 async def get_signed_cached(url: str, cache_ttl: int = 60, link_ttl_sec: int = 300) -> str | None:
-    now = time.time()
-    cached = _signed_cache.get(url)
-    if cached and now < cached[0]:
-        return cached[1]
-    signed = await _supabase_sign_url(url, expires_sec=link_ttl_sec)
-    if signed:
-        _signed_cache[url] = (now + cache_ttl, signed)
-    return signed
+    # cache_ttl conservé pour compat : le TTL est désormais dérivé de link_ttl_sec
+    return await signed_url_cache.get(url, link_ttl_sec=link_ttl_sec)
+
+async def get_signed_cached_many(
+    urls: List[str], cache_ttl: int = 60, link_ttl_sec: int = 300, db: AsyncSession | None = None
+) -> dict[str, str | None]:
+    """Version lot : cache partagé borné (LRU), ratés signés en une passe."""
+    return await signed_url_cache.get_many(urls, link_ttl_sec=link_ttl_sec, db=db)
 
 
 # --------- Config ----------
@@ -118,8 +98,6 @@ SUPABASE_URL         = (os.getenv("SUPABASE_URL") or "").rstrip("/")
 SUPABASE_KEY         = os.getenv("SUPABASE_SERVICE_ROLE", "")
 SUPABASE_BUCKET      = os.getenv("SUPABASE_BUCKET", "attachments")
 
-ALERT_RADIUS_M   = int(os.getenv("ALERT_RADIUS_M", "100"))   # rayon des zones d'alerte (≈100m)
-ALERT_WINDOW_H   = int(os.getenv("ALERT_WINDOW_H", "3"))     # fenêtre de temps pour les preuves (3h)
 ALERT_THRESHOLD  = int(os.getenv("ALERT_THRESHOLD", "3"))    # nb min de signalements pour une zone
 RESPONDER_TOKEN  = (os.getenv("RESPONDER_TOKEN") or "").strip()  # jeton simple pour “pompiers”
 
@@ -168,6 +146,102 @@ async def options_upload_image():
     resp.headers["Vary"] = "Origin"
     return resp
 
+# === Helpers vidéo (partagés : upload direct + upload reprenable) ===========
+_VIDEO_KINDS = {"urine", "vomit", "feces", "blood", "syringe", "broken_glass", "smoker", "fight", "sexual_assault"}
+
+def _is_admin_upload(request: Optional[Request]) -> bool:
+    try:
+        admin_hdr = (request.headers.get("x-admin-token") or "").strip()
+        admin_tok = (os.getenv("ADMIN_TOKEN") or os.getenv("NEXT_PUBLIC_ADMIN_TOKEN") or "").strip()
+        return bool(admin_tok) and admin_hdr == admin_tok
+    except Exception:
+        return False
+
+async def _resolve_video_report(
+    db: AsyncSession, is_admin: bool, user_id: Optional[UUID | str], K: str, lat: float, lng: float,
+    report_id: Optional[UUID | str] = None,
+) -> Optional[str]:
+    """Contrôle de propriété + report à lier (attachments.report_id).
+    Non-admin : il faut avoir déclaré ce type à ≤150 m dans les 48 h, sinon 403.
+    Admin : pas de contrôle, lien au mieux (report proche le plus récent)."""
+    if is_admin:
+        return await resolve_owned_report(
+            db, kind=K, lat=lat, lng=lng, signals=("to_clean",), report_id=report_id,
+        )
+    if not user_id:
+        raise HTTPException(status_code=403, detail="not_owner")
+    rid = await resolve_owned_report(
+        db, kind=K, lat=lat, lng=lng, signals=("to_clean",), user_id=str(user_id), report_id=report_id,
+    )
+    if rid is None:
+        raise HTTPException(status_code=403, detail="not_owner")
+    return rid
+
+async def _find_idempotent_attachment(db: AsyncSession, idem: Optional[str]):
+    if not idem:
+        return None
+    rs = await db.execute(
+        text("SELECT id, url FROM attachments WHERE idempotency_key = :k LIMIT 1"),
+        {"k": idem},
+    )
+    return rs.first()
+
+# colonnes ajoutées par les ensure_*_schema : écrites seulement une fois créées
+# par /admin/ensure_schema (jamais de DDL sur le chemin d'upload)
+_ATTACHMENT_OPTIONAL_COLUMNS = (
+    "content_sha256", "report_id", "thumb_url", "medium_url",
+    "original_url", "original_bytes", "stored_bytes",
+)
+
+async def _insert_attachment(
+    db: AsyncSession, K: str, lat: float, lng: float, user_id: Optional[UUID | str], url: str,
+    idem: Optional[str], optional: Dict[str, Any],
+):
+    """INSERT attachments → id ; `optional` : colonnes de _ATTACHMENT_OPTIONAL_COLUMNS,
+    ignorées tant qu'elles n'existent pas. Ne commit pas."""
+    present = await present_columns(db, "attachments", _ATTACHMENT_OPTIONAL_COLUMNS)
+    cols = ["kind", "geom", "user_id", "url", "idempotency_key", "created_at"]
+    vals = [":k", "ST_SetSRID(ST_MakePoint(:lng,:lat),4326)::geography", ":uid", ":url", ":idem", "NOW()"]
+    params: Dict[str, Any] = {
+        "k": K,
+        "lng": float(lng),
+        "lat": float(lat),
+        "uid": str(user_id) if user_id else None,
+        "url": url,
+        "idem": idem,
+    }
+    for col, value in optional.items():
+        if col in present:
+            cols.append(col)
+            vals.append(f"CAST(:{col} AS uuid)" if col == "report_id" else f":{col}")
+            params[col] = value
+    rs = await db.execute(
+        text(f"INSERT INTO attachments ({', '.join(cols)}) VALUES ({', '.join(vals)}) RETURNING id"),
+        params,
+    )
+    return rs.first()
+
+async def _insert_video_attachment(
+    db: AsyncSession, K: str, lat: float, lng: float, user_id: Optional[UUID | str], url: str, idem: Optional[str],
+    content_sha: Optional[str] = None, report_id: Optional[str] = None,
+):
+    # insérer dans attachments (version RATP simplifiée)
+    row = await _insert_attachment(db, K, lat, lng, user_id, url, idem, {
+        "content_sha256": content_sha,
+        "report_id": report_id,
+    })
+    await refresh_cta_media(db, report_id)
+    await db.commit()
+    return row
+
+def _video_ext(ctype: str) -> str:
+    ctype = (ctype or "").lower().strip()
+    if ctype.startswith("video/webm"):
+        return ".webm"
+    if ctype.startswith("video/3gpp") or ctype.startswith("video/3gp"):
+        return ".3gp"
+    return ".mp4"  # défaut
+
 # === UPLOAD VIDEO (séparé de l’upload d’image) ============================
 @router.post("/upload_video")
 async def upload_video(
@@ -176,6 +250,7 @@ async def upload_video(
     lng: float = Form(...),
     user_id: Optional[UUID] = Form(None),
     idempotency_key: Optional[str] = Form(None),
+    report_id: Optional[UUID] = Form(None),
     file: UploadFile = File(...),
     request: Request = None,
     db: AsyncSession = Depends(get_db),
@@ -192,81 +267,34 @@ async def upload_video(
 
     # ✅ normalisation du kind (TRÈS IMPORTANT)
     K = (kind or "").strip().lower()
-    # pour la version propreté RATP, on accepte les 6 types suivants :
-    allowed_kinds = {"urine", "vomit", "feces", "blood", "syringe", "broken_glass", "smoker", "fight", "sexual_assault"}
-    if K not in allowed_kinds:
+    # pour la version propreté RATP, on accepte les types suivants :
+    if K not in _VIDEO_KINDS:
         raise HTTPException(status_code=400, detail="invalid kind")
 
     # admin ?
-    is_admin = False
-    try:
-        admin_hdr = (request.headers.get("x-admin-token") or "").strip()
-        admin_tok = (os.getenv("ADMIN_TOKEN") or os.getenv("NEXT_PUBLIC_ADMIN_TOKEN") or "").strip()
-        is_admin = bool(admin_tok) and admin_hdr == admin_tok
-    except Exception:
-        pass
+    is_admin = _is_admin_upload(request)
 
-    # lire le fichier
-    data = await file.read()
-    if not data:
-        raise HTTPException(status_code=400, detail="empty file")
-
-    # ✅ limite à 15 MB
-    if len(data) > 15 * 1024 * 1024:
-        raise HTTPException(status_code=400, detail="video too large (max ~15MB)")
+    # fichier lu en streaming (limite 15 MB appliquée dès la réception, cf. UPLOAD_GUARDED_ROUTES)
+    stream = UploadStream(file, VIDEO_DIRECT_MAX_BYTES, VIDEO_DIRECT_TOO_LARGE, too_large_status=400)
+    await stream.prime()
 
     # idem key
     idem = (idempotency_key or "").strip() or None
-    if idem:
-        rs = await db.execute(
-            text("SELECT id, url FROM attachments WHERE idempotency_key = :k LIMIT 1"),
-            {"k": idem},
-        )
-        row = rs.first()
-        if row:
-            return {
-                "ok": True,
-                "id": str(row.id),
-                "url": row.url,
-                "idempotency_key": idem,
-            }
+    row = await _find_idempotent_attachment(db, idem)
+    if row:
+        return {
+            "ok": True,
+            "id": str(row.id),
+            "url": row.url,
+            "idempotency_key": idem,
+        }
 
-    # si pas admin → vérifier qu'il a bien déclaré à cet endroit récemment
-    if not is_admin:
-        if not user_id:
-            raise HTTPException(status_code=403, detail="not_owner")
-        chk = await db.execute(
-            text("""
-                WITH me AS (
-                    SELECT ST_SetSRID(ST_MakePoint(:lng,:lat),4326)::geography AS g
-                )
-                SELECT 1
-                  FROM reports
-                 WHERE user_id = :uid
-                   AND LOWER(TRIM(kind::text)) = :k
-                   AND LOWER(TRIM(signal::text)) = 'to_clean'
-                   AND created_at > NOW() - INTERVAL '48 hour'
-                   AND ST_DWithin(geom::geography, (SELECT g FROM me), 150)
-                 LIMIT 1
-            """),
-            {
-                "uid": str(user_id),
-                "k": K,
-                "lat": float(lat),
-                "lng": float(lng),
-            },
-        )
-        if chk.first() is None:
-            raise HTTPException(status_code=403, detail="not_owner")
+    # si pas admin → vérifier qu'il a bien déclaré à cet endroit récemment (→ report lié)
+    linked_report = await _resolve_video_report(db, is_admin, user_id, K, lat, lng, report_id)
 
     # déterminer l'extension à partir du content-type
     ctype = (file.content_type or "").lower().strip()
-    if ctype.startswith("video/webm"):
-        ext = ".webm"
-    elif ctype.startswith("video/3gpp") or ctype.startswith("video/3gp"):
-        ext = ".3gp"
-    else:
-        ext = ".mp4"  # défaut
+    ext = _video_ext(ctype)
 
     filename_orig = file.filename or f"{K}_{uuid.uuid4().hex}{ext}"
     if "." not in filename_orig:
@@ -275,74 +303,25 @@ async def upload_video(
     # chemin dans le bucket → IMPORTANT : on utilise K ici
     path = f"{K}/{int(_time.time())}-{uuid.uuid4().hex}-{os.path.basename(filename_orig)}"
 
-    # upload
-    url_public: Optional[str] = None
-    try:
-        bucket   = os.getenv("SUPABASE_BUCKET", "attachments")
-        supa_url = (os.getenv("SUPABASE_URL") or "").rstrip("/")
-        supa_key = os.getenv("SUPABASE_SERVICE_ROLE") or os.getenv("SUPABASE_SERVICE_KEY")
-
-        if supa_url and supa_key:
-            import httpx
-            upload_url = f"{supa_url}/storage/v1/object/{bucket}/{path}"
-            headers = {
-                "Authorization": f"Bearer {supa_key}",
-                "Content-Type": ctype or "video/mp4",
-                "x-upsert": "false",
-            }
-            async with httpx.AsyncClient(timeout=60) as client:
-                r = await client.post(upload_url, headers=headers, content=data)
-            if r.status_code not in (200, 201):
-                raise RuntimeError(f"supabase upload failed [{r.status_code}]: {r.text}")
-            url_public = f"{supa_url}/storage/v1/object/public/{bucket}/{path}"
-        else:
-            # fallback disque
-            raise RuntimeError("supabase credentials missing")
-    except Exception:
-        # fallback disque
-        os.makedirs(STATIC_DIR, exist_ok=True)
-        disk_name = os.path.basename(path)
-        disk_path = os.path.join(STATIC_DIR, disk_name)
-        with open(disk_path, "wb") as fp:
-            fp.write(data)
-        base = (BASE_PUBLIC_URL or "").rstrip("/")
-        if base:
-            url_public = f"{base}{STATIC_URL_PATH}/{disk_name}"
-        else:
-            url_public = f"{STATIC_URL_PATH}/{disk_name}"
+    # déduplication par contenu : même blob déjà stocké → pas de nouvel envoi
+    content_sha = await stream.digest()
+    blob = await find_blob(db, content_sha, stream.total)
+
+    # upload (streaming ; slot du budget global déjà pris par UploadGuardMiddleware)
+    url_public: Optional[str] = blob["url"] if blob else None
+    if not blob:
+        try:
+            url_public = await get_storage().put_stream(path, stream, ctype or "video/mp4", timeout=60)
+        except HTTPException:
+            raise
+        except Exception:
+            # fallback disque (écritures hors boucle d'événements)
+            url_public = await local_storage().put_stream(path, stream, ctype or "video/mp4")
 
     if not url_public:
         raise HTTPException(status_code=500, detail="no_public_url")
 
-        # insérer dans attachments
-        # insérer dans attachments (version RATP simplifiée)
-    ins = text("""
-        INSERT INTO attachments (
-            kind, geom, user_id, url, idempotency_key, created_at
-        )
-        VALUES (
-            :k,
-            ST_SetSRID(ST_MakePoint(:lng,:lat),4326)::geography,
-            :uid,
-            :url,
-            :idem,
-            NOW()
-        )
-        RETURNING id
-    """)
-    rs = await db.execute(
-        ins,
-        {
-            "k": K,
-            "lng": float(lng),
-            "lat": float(lat),
-            "uid": str(user_id) if user_id else None,
-            "url": url_public,
-            "idem": idem,
-        },
-    )
-    row = rs.first()
-    await db.commit()
+    row = await _insert_video_attachment(db, K, lat, lng, user_id, url_public, idem, content_sha, linked_report)
 
     return {
         "ok": True,
@@ -353,75 +332,205 @@ async def upload_video(
 
 
 
+# === UPLOAD VIDEO REPRENABLE (connexions mobiles instables) =================
+def _session_headers(meta: dict) -> dict:
+    return {
+        "Upload-Offset": str(int(meta["offset"])),
+        "Upload-Length": str(int(meta["size"])),
+        "Cache-Control": "no-store",
+    }
+
+@router.post("/upload_video/sessions")
+async def upload_video_session_create(
+    kind: str = Form(...),
+    lat: float = Form(...),
+    lng: float = Form(...),
+    size: int = Form(..., description="taille totale en octets"),
+    content_type: str = Form("video/mp4"),
+    sha256: Optional[str] = Form(None, description="sha256 hex du fichier complet (optionnel)"),
+    user_id: Optional[UUID] = Form(None),
+    idempotency_key: Optional[str] = Form(None),
+    report_id: Optional[UUID] = Form(None),
+    request: Request = None,
+    db: AsyncSession = Depends(get_db),
+):
+    """Ouvre une session ; mêmes contrôles que /upload_video (kind, auteur, idempotence)."""
+    K = (kind or "").strip().lower()
+    if K not in _VIDEO_KINDS:
+        raise HTTPException(status_code=400, detail="invalid kind")
+    ctype = (content_type or "").lower().strip()
+    if not ctype.startswith("video/"):
+        raise HTTPException(status_code=415, detail=f"unsupported content-type: {ctype or 'unknown'}")
+
+    idem = (idempotency_key or "").strip() or None
+    row = await _find_idempotent_attachment(db, idem)
+    if row:
+        return {"ok": True, "completed": True, "id": str(row.id), "url": row.url, "idempotency_key": idem}
+
+    linked_report = await _resolve_video_report(db, _is_admin_upload(request), user_id, K, lat, lng, report_id)
+
+    meta = await resumable.create_session(
+        kind=K, lat=lat, lng=lng,
+        user_id=str(user_id) if user_id else None,
+        report_id=linked_report,
+        idempotency_key=idem,
+        content_type=ctype,
+        size=int(size),
+        sha256=sha256,
+        max_bytes=15 * 1024 * 1024,
+    )
+    return JSONResponse({"ok": True, **resumable.session_view(meta)}, status_code=201, headers=_session_headers(meta))
+
+@router.api_route("/upload_video/sessions/{session_id}", methods=["GET", "HEAD"])
+async def upload_video_session_status(session_id: str):
+    meta = await resumable.get_session(session_id)
+    return JSONResponse({"ok": True, **resumable.session_view(meta)}, headers=_session_headers(meta))
+
+@router.patch("/upload_video/sessions/{session_id}")
+async def upload_video_session_chunk(session_id: str, request: Request):
+    """
+    Corps brut = un morceau. Headers :
+    - Upload-Offset (obligatoire) : doit valoir l'offset courant, sinon 409 (+ offset attendu)
+    - Upload-Checksum (optionnel) : "sha256 <base64|hex>" → 460 si le morceau est corrompu
+    """
+    meta = await resumable.get_session(session_id)
+    raw_offset = request.headers.get("upload-offset")
+    try:
+        offset = int(raw_offset)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Upload-Offset header required")
+    checksum = resumable.parse_checksum(request.headers.get("upload-checksum"))
+
+    meta = await resumable.write_chunk(meta, offset, request.stream(), checksum)
+    return JSONResponse({"ok": True, **resumable.session_view(meta)}, headers=_session_headers(meta))
+
+@router.delete("/upload_video/sessions/{session_id}")
+async def upload_video_session_abort(session_id: str):
+    meta = await resumable.get_session(session_id)
+    await resumable.delete_session(meta["id"])
+    return {"ok": True}
+
+@router.post("/upload_video/sessions/{session_id}/complete")
+async def upload_video_session_complete(
+    session_id: str,
+    request: Request = None,
+    db: AsyncSession = Depends(get_db),
+):
+    """Assemble → backend de stockage (flux depuis le disque) → attachments."""
+    import uuid, time as _time
+
+    meta = await resumable.get_session(session_id)
+    K, lat, lng = meta["kind"], meta["lat"], meta["lng"]
+    user_id, idem = meta.get("user_id"), meta.get("idempotency_key")
+
+    row = await _find_idempotent_attachment(db, idem)
+    if row:
+        await resumable.delete_session(meta["id"])
+        return {"ok": True, "id": str(row.id), "url": row.url, "idempotency_key": idem}
+
+    # re-contrôle (la session peut avoir été ouverte il y a longtemps)
+    linked_report = await _resolve_video_report(
+        db, _is_admin_upload(request), user_id, K, lat, lng, meta.get("report_id"),
+    ) or meta.get("report_id")
+
+    part, content_sha = await resumable.verify_complete(meta)
+    ctype = meta.get("content_type") or "video/mp4"
+    path = f"{K}/{int(_time.time())}-{uuid.uuid4().hex}{_video_ext(ctype)}"
+
+    blob = await find_blob(db, content_sha, int(meta["size"]))
+    url_public: Optional[str] = blob["url"] if blob else None
+    if not blob:  # blob inédit → envoi au stockage (sinon métadonnées seules)
+        async with upload_budget.slot("video_session"):
+            # fichier déjà assemblé sur disque : envoyé en flux (distant) ou simplement déplacé (local)
+            try:
+                url_public = await get_storage().put_file(path, part, ctype, move=True)
+            except StorageUploadError as e:
+                raise HTTPException(status_code=502, detail=f"storage upload failed: {e.status_code}")
+
+    row = await _insert_video_attachment(db, K, lat, lng, user_id, url_public, idem, content_sha, linked_report)
+    await resumable.delete_session(meta["id"])
+
+    return {
+        "ok": True,
+        "id": str(row.id),
+        "url": url_public,
+        "idempotency_key": idem,
+    }
+
+
 @router.post("/maintenance/purge_old_attachments")
 async def purge_old_attachments(
     request: Request,
+    batch: int = Query(RETENTION_BATCH, ge=10, le=5000),
+    max_batches: int = Query(0, ge=0, description="0 = jusqu'à épuisement"),
+    max_seconds: float = Query(0, ge=0, description="0 = sans limite"),
     db: AsyncSession = Depends(get_db),
 ):
     """
-    Supprime de la base les attachments plus vieux que 49 jours.
-    (à appeler via cron ou à la main)
+    Supprime les attachments plus vieux que RETENTION_DAYS (49 j) par lots,
+    ainsi que leurs objets de stockage (fichier + variantes) quand plus aucune
+    ligne ne les référence. (à appeler via cron ou à la main)
     """
-    import os
-    from sqlalchemy import text
+    _require_admin_token(request)
+    try:
+        stats = await run_retention(db, batch=batch, max_batches=max_batches, max_seconds=max_seconds)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"purge failed: {e}")
+    if stats.get("busy"):
+        raise HTTPException(status_code=409, detail={"error": "purge already running", **stats})
+    return {"ok": True, "deleted": stats["progress"]["rows_deleted"], **stats}
 
-    admin_tok = (os.getenv("ADMIN_TOKEN") or "").strip()
-    req_tok = (request.headers.get("x-admin-token") or "").strip()
-    if not admin_tok or req_tok != admin_tok:
-      raise HTTPException(status_code=403, detail="forbidden")
 
-    # on récupère les vieux (pour info)
-    rs = await db.execute(
-        text("""
-            SELECT id, url
-            FROM attachments
-            WHERE created_at < NOW() - INTERVAL '49 days'
-        """)
-    )
-    rows = rs.mappings().all()
+@router.get("/maintenance/retention_status")
+async def retention_status(request: Request):
+    _require_admin_token(request)
+    return {"ok": True, **retention_stats()}
 
-    # on supprime en base
-    await db.execute(
-        text("DELETE FROM attachments WHERE created_at < NOW() - INTERVAL '49 days'")
-    )
-    await db.commit()
 
-    return {"ok": True, "deleted": len(rows)}
+@router.post("/maintenance/reconcile_attachment_blobs")
+async def reconcile_attachment_blobs(
+    request: Request,
+    dry_run: bool = Query(True),
+    prefix: str = Query(""),
+    max_objects: int = Query(0, ge=0, description="0 = tout le stockage"),
+    db: AsyncSession = Depends(get_db),
+):
+    """Objets de stockage qu'aucune ligne ne référence (dry_run=false pour supprimer).
+    Seuls les préfixes d'upload des pièces jointes (<kind>/…) sont parcourus."""
+    _require_admin_token(request)
+    try:
+        return {"ok": True, **(await reconcile_orphans(
+            db, upload_prefixes=ALLOWED_KINDS, dry_run=dry_run, prefix=prefix, max_objects=max_objects,
+        ))}
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"reconcile failed: {e}")
+
+
+def _require_admin_token(request: Request) -> None:
+    # comme l'ancien endpoint : refusé si ADMIN_TOKEN n'est pas configuré
+    admin_tok = (os.getenv("ADMIN_TOKEN") or "").strip()
+    req_tok = (request.headers.get("x-admin-token") or "").strip()
+    if not admin_tok or req_tok != admin_tok:
+        raise HTTPException(status_code=403, detail="forbidden")
 
 
 
-# --------- Upload vers Supabase Storage ----------
+# --------- Upload (petits fichiers en mémoire) vers le backend de stockage ----------
 async def _upload_to_supabase(file_bytes: bytes, filename: str, content_type: str) -> str:
-    SUPA_URL = (os.getenv("SUPABASE_URL") or "").rstrip("/")
-    SUPA_KEY = os.getenv("SUPABASE_SERVICE_ROLE", "")
-    BUCKET   = os.getenv("SUPABASE_BUCKET", "attachments")
-
-    if not (SUPA_URL and SUPA_KEY and BUCKET):
-        raise HTTPException(status_code=500, detail="supabase creds missing (SUPABASE_URL / SUPABASE_SERVICE_ROLE / SUPABASE_BUCKET)")
-
-    import httpx, time as _time, uuid as _uuid
-    path = f"{int(_time.time())}/{_uuid.uuid4()}-{(filename or 'photo.jpg')}"
-    upload_url = f"{SUPA_URL}/storage/v1/object/{BUCKET}/{path}"
-    headers = {
-        "Authorization": f"Bearer {SUPA_KEY}",
-        "Content-Type": content_type or "application/octet-stream",
-        "x-upsert": "true",
-    }
-
+    import time as _time, uuid as _uuid
+    path = f"{int(_time.time())}/{_uuid.uuid4()}-{os.path.basename(filename or 'photo.jpg')}"
     try:
-        async with httpx.AsyncClient(timeout=30) as client:
-            r = await client.post(upload_url, headers=headers, content=file_bytes)
+        return await get_storage().put_bytes(path, file_bytes, content_type or "application/octet-stream")
+    except StorageUploadError as e:
+        raise HTTPException(status_code=500, detail=f"storage upload failed [{e.status_code}]: {e.body}")
     except httpx.ConnectError as e:
-        raise HTTPException(502, detail=f"supabase connect error: {e}")
+        raise HTTPException(502, detail=f"storage connect error: {e}")
     except httpx.ReadTimeout as e:
-        raise HTTPException(504, detail=f"supabase timeout: {e}")
+        raise HTTPException(504, detail=f"storage timeout: {e}")
     except Exception as e:
-        raise HTTPException(500, detail=f"supabase http error: {e}")
-
-    if r.status_code not in (200, 201):
-        raise HTTPException(status_code=500, detail=f"supabase upload failed [{r.status_code}]: {r.text}")
-
-    return f"{SUPA_URL}/storage/v1/object/public/{BUCKET}/{path}"
+        raise HTTPException(500, detail=f"storage error: {e}")
 
 # ---------- LECTURES (outages/incidents) ----------
 # ---------------------------------------------------------------------
@@ -670,98 +779,24 @@ async def fetch_incidents_all(db: AsyncSession, limit: int = 2000):
 
 
 
-# --- Helper pour /map : zones d’alerte via cluster DBSCAN ---
-
-# --- Helper pour /map : zones d’alerte via cluster DBSCAN ---
+# --- Helper pour /map : zones d’alerte (table matérialisée alert_zones) ---
 async def fetch_alert_zones(db: AsyncSession, lat: float, lng: float, r_m: float):
     """
-    Regroupe les reports 'cut' récents par proximité (DBSCAN-like)
-    et renvoie des clusters {kind, count, lat, lng} prêts pour la carte.
-    Compatible avec tous les types (incidents + outages).
+    Lit les zones d'alerte pré-calculées (tous kinds) autour du point.
+    Les acks sont déjà appliqués à l'écriture → simple lookup spatial indexé.
+    Regroupement par cellules de ALERT_RADIUS_M (150 m par défaut) et non plus
+    par DBSCAN à 100 m ; ALERT_WINDOW_H reste lu (repli de ALERT_WINDOW_HOURS).
     """
-    window_min = int(ALERT_WINDOW_H) * 60  # passer heures -> minutes
-    group_radius_m = float(ALERT_RADIUS_M)
-    threshold = int(ALERT_THRESHOLD)
-
-    sql = text(f"""
-        WITH me AS (
-          SELECT ST_SetSRID(ST_MakePoint(:lng,:lat),4326)::geography AS g
-        ),
-        pts AS (
-          SELECT
-            id,
-            kind::text AS kind,
-            ST_SnapToGrid(ST_Transform((geom::geometry),3857), 1.0) AS g3857,
-            (geom::geometry) AS g4326
-          FROM reports
-          WHERE created_at > NOW() - INTERVAL '{window_min} minutes'
-            AND LOWER(TRIM(signal::text))='cut'
-            AND ST_DWithin((geom::geography), (SELECT g FROM me), :r)
-            AND kind IN ('traffic','accident','fire','flood','power','water','assault','weapon','medical')
-        ),
-        clus AS (
-          SELECT
-            kind,
-            ST_ClusterDBSCAN(g3857, eps := :eps, minpoints := 2) OVER () AS cid,
-            g4326
-          FROM pts
-        ),
-        agg AS (
-          SELECT
-            kind,
-            cid,
-            COUNT(*)::int AS n,
-            ST_Transform(ST_Centroid(ST_Collect(g4326)), 4326) AS center4326
-          FROM clus
-          WHERE cid IS NOT NULL
-          GROUP BY kind, cid
-        ),
-        zones AS (
-          SELECT
-            a.kind,
-            a.n,
-            ST_Y(a.center4326) AS lat,
-            ST_X(a.center4326) AS lng
-          FROM agg a
-          WHERE a.n >= :threshold
-        )
-        SELECT z.kind, z.n, z.lat, z.lng
-        FROM zones z
-        WHERE NOT EXISTS (
-          SELECT 1
-          FROM acks ak
-          WHERE ak.kind = z.kind
-            AND ST_DWithin(
-              (ST_SetSRID(ST_MakePoint(z.lng, z.lat),4326)::geography),
-              ak.geom,
-              :ack_r
-            )
-        )
-        ORDER BY z.kind, z.n DESC
-    """)
-
-    params = {
-        "lat": float(lat),
-        "lng": float(lng),
-        "r": float(r_m),
-        "eps": group_radius_m,
-        "threshold": threshold,
-        "ack_r": group_radius_m,
-    }
-
     try:
-        res = await db.execute(sql, params)
-        rows = res.fetchall()
+        zones = await read_alert_zones(
+            db, ALERT_ZONE_KINDS, lat, lng, r_m, min_count=int(ALERT_THRESHOLD), limit=200,
+        )
+        return zones or []
     except Exception as e:
         await db.rollback()
         print(f"⚠️ fetch_alert_zones SQL error: {e}")
         return []
 
-    return [
-        {"kind": r.kind, "count": int(r.n), "lat": float(r.lat), "lng": float(r.lng)}
-        for r in rows
-    ]
-
 
 
 # ---------- ENDPOINT /map ----------
@@ -796,30 +831,35 @@ async def map_view(
         # 0) Auto-clôture incidents/outages anciens (si activé)
         try:
             if os.getenv("AUTO_EXPIRE_ENABLED", "1") != "0":
-                await db.execute(text(f"""
-                    UPDATE incidents
-                       SET restored_at = COALESCE(restored_at, NOW())
-                     WHERE restored_at IS NULL
-                       AND started_at  < NOW() - INTERVAL '{AUTO_EXPIRE_H} hours'
-                """))
-                await db.execute(text(f"""
-                    UPDATE outages
-                       SET restored_at = COALESCE(restored_at, NOW())
-                     WHERE restored_at IS NULL
-                       AND started_at  < NOW() - INTERVAL '{AUTO_EXPIRE_H} hours'
-                """))
-                await db.commit()
+                with span("map.auto_expire"):
+                    await db.execute(text(f"""
+                        UPDATE incidents
+                           SET restored_at = COALESCE(restored_at, NOW())
+                         WHERE restored_at IS NULL
+                           AND started_at  < NOW() - INTERVAL '{AUTO_EXPIRE_H} hours'
+                    """))
+                    await db.execute(text(f"""
+                        UPDATE outages
+                           SET restored_at = COALESCE(restored_at, NOW())
+                         WHERE restored_at IS NULL
+                           AND started_at  < NOW() - INTERVAL '{AUTO_EXPIRE_H} hours'
+                    """))
+                    await db.commit()
         except Exception:
             await db.rollback()
 
         # 1) lecture globale ou locale
         if show_all:
-            outages = await fetch_outages_all(db, limit=2000)
-            incidents = await fetch_incidents_all(db, limit=2000)
+            with span("map.outages"):
+                outages = await fetch_outages_all(db, limit=2000)
+            with span("map.incidents"):
+                incidents = await fetch_incidents_all(db, limit=2000)
             # alert_zones reste [] en mode global
         else:
-            outages = await fetch_outages(db, lat, lng, r_m)
-            incidents = await fetch_incidents(db, lat, lng, r_m)
+            with span("map.outages"):
+                outages = await fetch_outages(db, lat, lng, r_m)
+            with span("map.incidents"):
+                incidents = await fetch_incidents(db, lat, lng, r_m)
             # si tu veux remettre les vraies alert_zones plus tard :
             # alert_zones = await fetch_alert_zones(db, lat, lng, r_m)
 
@@ -976,6 +1016,7 @@ async def upload_image(
     lng: float = Form(...),
     user_id: Optional[UUID] = Form(None),
     idempotency_key: Optional[str] = Form(None),
+    report_id: Optional[UUID] = Form(None),
     file: UploadFile = File(...),
     request: Request = None,
     db: AsyncSession = Depends(get_db),
@@ -994,11 +1035,6 @@ async def upload_image(
          raise HTTPException(status_code=400, detail="invalid kind")
 
 
-    # --- lecture du fichier
-    data = await file.read()
-    if not data:
-        raise HTTPException(status_code=400, detail="empty file")
-
     ctype = (file.content_type or "").lower().strip()
     is_image = ctype.startswith("image/")
     is_video = ctype.startswith("video/")
@@ -1007,11 +1043,12 @@ async def upload_image(
         # accepte uniquement image/* ou video/* (webm/mp4)
         raise HTTPException(status_code=415, detail=f"unsupported content-type: {ctype or 'unknown'}")
 
-    # bornes de taille : image 15Mo, vidéo 50Mo
-    if is_image and len(data) > 15 * 1024 * 1024:
-        raise HTTPException(status_code=413, detail="image too large")
-    if is_video and len(data) > 50 * 1024 * 1024:
-        raise HTTPException(status_code=413, detail="video too large")
+    # --- lecture du fichier en streaming ; bornes : image 15Mo, vidéo 50Mo
+    if is_image:
+        stream = UploadStream(file, IMAGE_MAX_BYTES, "image too large")
+    else:
+        stream = UploadStream(file, VIDEO_MAX_BYTES, "video too large")
+    await stream.prime()
 
     # --- idempotency
     idem = (idempotency_key or "").strip() or None
@@ -1028,23 +1065,15 @@ async def upload_image(
             }
 
     # --- Ownership check : si pas admin, l'uploader doit avoir un report récent proche
-    if not is_admin:
-        if not user_id:
-            raise HTTPException(status_code=403, detail="not_owner")
-        chk = text("""
-            WITH me AS (SELECT ST_SetSRID(ST_MakePoint(:lng,:lat),4326)::geography AS g)
-            SELECT 1
-              FROM reports
-             WHERE user_id = :uid
-               AND LOWER(TRIM(kind::text))   = :k
-               AND LOWER(TRIM(signal::text)) IN ('cut','to_clean')
-               AND created_at > NOW() - INTERVAL '48 hours'
-               AND ST_DWithin((geom::geography),(SELECT g FROM me),150)
-             LIMIT 1
-        """)
-        rs = await db.execute(chk, {"uid": str(user_id), "k": K, "lat": lat, "lng": lng})
-        if rs.first() is None:
-            raise HTTPException(status_code=403, detail="not_owner")
+    #     (le report trouvé est lié à la pièce jointe : attachments.report_id)
+    if not is_admin and not user_id:
+        raise HTTPException(status_code=403, detail="not_owner")
+    linked_report = await resolve_owned_report(
+        db, kind=K, lat=lat, lng=lng, signals=("cut", "to_clean"),
+        user_id=None if is_admin else str(user_id), report_id=report_id,
+    )
+    if not is_admin and linked_report is None:
+        raise HTTPException(status_code=403, detail="not_owner")
 
     # --- choix extension/filename
     ext = ".jpg"
@@ -1065,79 +1094,95 @@ async def upload_image(
         else:
             ext = ".jpg"
 
-    # --- stockage Supabase (si configuré) sinon local
-    url_public = None
-    bucket   = os.getenv("SUPABASE_BUCKET", "attachments")
-    supa_url = (os.getenv("SUPABASE_URL") or "").rstrip("/")
-    supa_key = os.getenv("SUPABASE_SERVICE_ROLE") or os.getenv("SUPABASE_SERVICE_KEY")
+    # --- déduplication par contenu : même blob déjà stocké → métadonnées seules
+    content_sha = await stream.digest()
+    blob = await find_blob(db, content_sha, stream.total)
 
-    try:
-        if supa_url and supa_key:
-            import httpx
-            path = f"{K}/{int(time.time())}-{uuid.uuid4()}{ext}"
-            upload_url = f"{supa_url}/storage/v1/object/{bucket}/{path}"
-            headers = {
-                "Authorization": f"Bearer {supa_key}",
-                "Content-Type": ctype or ("video/mp4" if is_video else "image/jpeg"),
-                "x-upsert": "false",
-            }
-            async with httpx.AsyncClient(timeout=30) as client:
-                r = await client.post(upload_url, headers=headers, content=data)
-            if r.status_code not in (200, 201):
-                raise HTTPException(status_code=502, detail=f"supabase upload failed: {r.status_code}")
-            url_public = f"{supa_url}/storage/v1/object/public/{bucket}/{path}"
-        else:
-            # local /static (dev)
-            os.makedirs(STATIC_DIR, exist_ok=True)
-            path = f"{K}-{uuid.uuid4()}{ext}"
-            disk_path = os.path.join(STATIC_DIR, path)
-            with open(disk_path, "wb") as fp:
-                fp.write(data)
-            base = (BASE_PUBLIC_URL or "").rstrip("/")
-            url_public = f"{base}{STATIC_URL_PATH}/{path}" if base else f"{STATIC_URL_PATH}/{path}"
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"storage_error: {e}")
+    # --- stockage via le backend actif (Supabase / local / mémoire), en streaming sous budget global
+    url_public = None
+    original_url = None
+    stored_bytes = stream.total
+    storage = get_storage()
+    on_disk = isinstance(storage, LocalStorage)
+    variant_src: Optional[str] = None  # source locale pour les variantes (images)
+    variant_tmp = not on_disk          # variant_src = copie temporaire à supprimer
+    stem = f"{K}/{int(time.time())}-{uuid.uuid4()}"
+    path = stem + ext
+    if blob:
+        url_public = blob["url"]
+        original_url = blob.get("original_url")
+    else:
+        spooled: Optional[str] = None
+        ingested = None
+        try:
+            # slot du budget global déjà pris par UploadGuardMiddleware
+            # ingestion optionnelle : réduction / ré-encodage (pool de processus) avant stockage
+            if is_image and ingest_available():
+                try:
+                    spooled = await spool_upload(stream)
+                    ingested = await ingest_image(spooled)
+                except Exception as e:
+                    print(f"[upload_image] ingest skipped: {e}")
+            try:
+                if ingested:
+                    path = stem + ingested["ext"]
+                    url_public = await storage.put_file(path, ingested["path"], ingested["content_type"])
+                    stored_bytes = ingested["bytes_out"]
+                    if MEDIA_KEEP_ORIGINAL:
+                        original_url = await storage.put_file(f"{stem}.orig{ext}", spooled, ctype or "image/jpeg")
+                else:
+                    url_public = await storage.put_stream(
+                        path, stream, ctype or ("video/mp4" if is_video else "image/jpeg"), timeout=30,
+                    )
+            except StorageUploadError as e:
+                raise HTTPException(status_code=502, detail=f"storage upload failed: {e.status_code}")
+            if is_image:
+                # variantes depuis l'image réduite si elle existe (plus rapide), sinon l'original
+                if ingested:
+                    variant_src, ingested = ingested["path"], None
+                    variant_tmp = True
+                elif spooled:
+                    variant_src, spooled = spooled, None
+                    variant_tmp = True
+                else:
+                    try:
+                        variant_src = storage.local_path(path) if on_disk else await spool_source(stream)
+                    except Exception as e:
+                        print(f"[upload_image] variant spool failed: {e}")
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"storage_error: {e}")
+        finally:
+            discard_local(spooled, ingested["path"] if ingested else None)
 
     if not url_public:
         raise HTTPException(status_code=500, detail="no_public_url")
 
-    # --- insert DB
-        # --- insert DB (version simplifiée pour schéma RATP)
-    ins = text("""
-        INSERT INTO attachments (
-            kind, geom, user_id, url, idempotency_key, created_at
-        )
-        VALUES (
-            :k,
-            ST_SetSRID(ST_MakePoint(:lng,:lat),4326)::geography,
-            :uid,
-            :url,
-            :idem,
-            NOW()
-        )
-        RETURNING id
-    """)
-    rs = await db.execute(
-        ins,
-        {
-            "k": K,
-            "lng": float(lng),
-            "lat": float(lat),
-            "uid": str(user_id) if user_id else None,
-            "url": url_public,
-            "idem": idem,
-        },
-    )
-    new_id = rs.scalar() if hasattr(rs, "scalar") else (rs.first().id if rs.first() else None)
+    # --- insert DB (version simplifiée pour schéma RATP)
+    row = await _insert_attachment(db, K, lat, lng, user_id, url_public, idem, {
+        "content_sha256": content_sha,
+        "thumb_url": blob.get("thumb_url") if blob else None,
+        "medium_url": blob.get("medium_url") if blob else None,
+        "report_id": linked_report,
+        "original_url": original_url,
+        "original_bytes": stream.total,
+        "stored_bytes": stored_bytes,
+    })
+    new_id = row.id if row else None
+    await refresh_cta_media(db, linked_report)
     await db.commit()
 
+    # miniature + taille moyenne en tâche de fond (pool de processus) ; blob réutilisé → déjà faites
+    if is_image and not blob:
+        schedule_variants(new_id, variant_src, path, remove_src=variant_tmp)
+
     return {
         "ok": True,
         "id": str(new_id) if new_id else None,
         "url": url_public if is_admin else None,
         "idempotency_key": idem,
+        "deduplicated": bool(blob),
     }
 
 
@@ -1153,6 +1198,24 @@ async def supabase_status():
         "SUPABASE_BUCKET": os.getenv("SUPABASE_BUCKET", "attachments"),
     }
 
+@router.get("/admin/http_stats")
+async def admin_http_stats(request: Request):
+    _check_admin_token(request)
+    return {
+        "http": http_clients.stats(),
+        "uploads": upload_budget.stats(),
+        "signed_urls": signed_url_cache.stats(),
+        "media": media_stats(),
+        "dedup": dedup_stats(),
+        "retention": retention_stats(),
+        "ownership_index": recent_reports.stats(),
+        "rollups": rollups_stats(),
+        "result_cache": result_cache_stats(),
+        "tracing": tracing_stats(),
+        "exports": {**export_stats(), "background": export_jobs.export_jobs_stats()},
+        "storage": storage_stats(),
+    }
+
 # --------- RESET USER ----------
 @router.post("/reset_user")
 async def reset_user(id: str = Query(..., alias="id"), db: AsyncSession = Depends(get_db)):
@@ -1180,6 +1243,8 @@ async def admin_wipe_all(request: Request, truncate: bool = Query(False), db: As
             await db.execute(text("DELETE FROM reports"))
             await db.execute(text("DELETE FROM incidents"))
             await db.execute(text("DELETE FROM outages"))
+        await reset_rollups(db)
+        await reset_resolution(db)
         await db.commit()
         return {"ok": True}
     except Exception as e:
@@ -1196,11 +1261,103 @@ async def admin_ensure_schema(db: AsyncSession = Depends(get_db)):
         await db.execute(text("CREATE INDEX IF NOT EXISTS idx_incidents_kind ON incidents(kind)"))
         await db.execute(text("CREATE INDEX IF NOT EXISTS idx_outages_kind   ON outages(kind)"))
         await db.commit()
+        await ensure_alert_zones_schema(db)
+        await ensure_signed_url_schema(db)
+        await ensure_media_schema(db)
+        await ensure_dedup_schema(db)
+        await ensure_attachment_links_schema(db)
+        await ensure_retention_schema(db)
+        await ensure_rollups_schema(db)
+        await ensure_resolution_schema(db)
+        await fill_cta_queue_if_empty(db)  # DDL + remplissage d'une file neuve
         return {"ok": True}
     except Exception as e:
         await db.rollback()
         raise HTTPException(status_code=500, detail=f"ensure_schema failed: {e}")
 
+@router.post("/admin/backfill_attachment_links")
+async def admin_backfill_attachment_links(
+    request: Request,
+    batch: int = Query(500, ge=10, le=5000),
+    max_batches: int = Query(0, ge=0, description="0 = passe complète"),
+    db: AsyncSession = Depends(get_db),
+):
+    """Lie les pièces jointes existantes à leur report (attachments.report_id)."""
+    _check_admin_token(request)
+    try:
+        return {"ok": True, **(await backfill_attachment_links(db, batch=batch, max_batches=max_batches))}
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=f"backfill_attachment_links failed: {e}")
+
+@router.get("/admin/sql_stats")
+async def admin_sql_stats(
+    request: Request,
+    limit: int = Query(20, ge=1, le=200),
+    sort: str = Query("total", description="total | p95 | max | count"),
+):
+    """Requêtes SQL les plus coûteuses (par nom stable « module.fonction VERBE table »),
+    percentiles glissants, routes d'origine et dernières requêtes lentes."""
+    _check_admin_token(request)
+    return sql_top(limit=limit, sort=sort)
+
+@router.post("/admin/sql_stats/reset")
+async def admin_sql_stats_reset(request: Request):
+    _check_admin_token(request)
+    sql_reset()
+    return {"ok": True}
+
+@router.get("/admin/traces")
+async def admin_traces(
+    request: Request,
+    limit: int = Query(50, ge=1, le=500),
+    route: str | None = Query(None, description="gabarit de route, ex. /map"),
+    min_ms: float = Query(0.0, ge=0),
+):
+    """Dernières traces conservées (échantillonnées, forcées par x-ayii-trace: 1,
+    ou lentes) : durées par catégorie, sans l'arbre de spans."""
+    _check_admin_token(request)
+    return {"stats": tracing_stats(), "items": trace_list(limit=limit, route=route, min_ms=min_ms)}
+
+@router.get("/admin/traces/{trace_id}")
+async def admin_trace(trace_id: str, request: Request):
+    """Une trace (id renvoyé dans l'en-tête x-trace-id) avec son arbre de spans."""
+    _check_admin_token(request)
+    t = trace_get(trace_id)
+    if t is None:
+        raise HTTPException(status_code=404, detail="trace not found (expired or not kept)")
+    return t
+
+@router.post("/admin/cta_queue/rebuild")
+async def admin_rebuild_cta_queue(request: Request, db: AsyncSession = Depends(get_db)):
+    """Reconstruit la file de travail CTA depuis les reports de la fenêtre."""
+    _check_admin_token(request)
+    try:
+        n = await rebuild_cta_queue(db)
+        await db.commit()
+        cta_queue_cache.invalidate()
+        return {"ok": True, "rows": n}
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=f"rebuild_cta_queue failed: {e}")
+
+@router.post("/admin/rollups/rebuild")
+async def admin_rebuild_rollups(
+    request: Request,
+    date_from: str | None = None,
+    date_to: str | None = None,
+    db: AsyncSession = Depends(get_db),
+):
+    """Recalcule les agrégats horaires (métriques, export agrégé) sur une plage
+    — après une suppression massive de reports par exemple. Sans bornes : tout l'historique."""
+    _check_admin_token(request)
+    try:
+        res = await rebuild_rollups(db, since=_parse_dt(date_from), until=_parse_dt(date_to))
+        return {"ok": True, **res, "stats": rollups_stats()}
+    except Exception as e:
+        await db.rollback()
+        raise HTTPException(status_code=500, detail=f"rebuild_rollups failed: {e}")
+
 @router.post("/admin/normalize_reports")
 async def admin_normalize_reports(db: AsyncSession = Depends(get_db)):
     try:
@@ -1376,23 +1533,10 @@ def _bbox_clause(min_lat, max_lat, min_lng, max_lng, alias="geom"):
         parts.append(f"ST_X({alias}::geometry) BETWEEN :min_lng AND :max_lng")
     return (" AND ".join(parts), params)
 
-@router.get("/admin/export_reports.csv")
-async def admin_export_reports_csv(
-    request: Request,
-    date_from: str | None = None,
-    date_to: str | None = None,
-    kind: str | None = None,          # 'traffic'|'accident'|'fire'|'flood'|'power'|'water'
-    signal: str | None = None,        # 'cut'|'restored'
-    min_lat: float | None = None, max_lat: float | None = None,
-    min_lng: float | None = None, max_lng: float | None = None,
-    db: AsyncSession = Depends(get_db),
-):
-    if not _is_admin_req(request):
-        raise HTTPException(status_code=401, detail="invalid admin token")
-
-    dt_from = _parse_dt(date_from)
-    dt_to   = _parse_dt(date_to)
-
+def _reports_export_where(f: dict):
+    # filtres communs des exports reports (CSV / GeoJSON / Parquet)
+    dt_from = _parse_dt(f.get("date_from"))
+    dt_to   = _parse_dt(f.get("date_to"))
     where = ["1=1"]
     params = {}
     if dt_from:
@@ -1401,41 +1545,298 @@ async def admin_export_reports_csv(
     if dt_to:
         where.append("created_at <= :dt")
         params["dt"] = dt_to
-    if kind:
+    if f.get("kind"):
         where.append("kind = :kind")
-        params["kind"] = kind
-    if signal:
+        params["kind"] = f["kind"]
+    if f.get("signal"):
         where.append("LOWER(TRIM(signal::text)) = :sig")
-        params["sig"] = signal.strip().lower()
-    bbox_sql, bbox_params = _bbox_clause(min_lat, max_lat, min_lng, max_lng, alias="geom")
+        params["sig"] = f["signal"].strip().lower()
+    bbox_sql, bbox_params = _bbox_clause(f.get("min_lat"), f.get("max_lat"), f.get("min_lng"), f.get("max_lng"), alias="geom")
+    if bbox_sql:
+        where.append(bbox_sql)
+        params.update(bbox_params)
+    return " AND ".join(where), params
+
+def _events_export_where(f: dict):
+    # filtres communs des exports incidents/outages (CSV / GeoJSON / Parquet)
+    dt_from = _parse_dt(f.get("date_from"))
+    dt_to   = _parse_dt(f.get("date_to"))
+    where = ["1=1"]
+    params = {}
+    if dt_from:
+        where.append("started_at >= :df")
+        params["df"] = dt_from
+    if dt_to:
+        where.append("started_at <= :dt")
+        params["dt"] = dt_to
+    if f.get("kind"):
+        where.append("kind = :kind")
+        params["kind"] = f["kind"]
+    status = f.get("status")
+    if status in ("active","restored"):
+        if status == "active":
+            where.append("restored_at IS NULL")
+        else:
+            where.append("restored_at IS NOT NULL")
+    bbox_sql, bbox_params = _bbox_clause(f.get("min_lat"), f.get("max_lat"), f.get("min_lng"), f.get("max_lng"), alias="center")
     if bbox_sql:
         where.append(bbox_sql)
         params.update(bbox_params)
+    return " AND ".join(where), params
 
+def _event_tables(table):
+    tabs = ["incidents","outages"] if table in (None,"both","") else [table]
+    if any(t not in ("incidents","outages") for t in tabs):
+        raise HTTPException(status_code=400, detail="invalid table")
+    return tabs
+
+# format → (content-type, extension)
+_EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "geojson": ("application/geo+json", "geojson"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+def _check_export(subject: str, fmt: str, f: dict):
+    if subject not in ("reports", "events"):
+        raise HTTPException(status_code=400, detail="subject must be reports or events")
+    if fmt not in _EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(_EXPORT_FORMATS)}")
+    if fmt == "parquet" and not parquet_available():
+        raise HTTPException(status_code=501, detail="parquet export unavailable (pyarrow not installed)")
+    if subject == "events":
+        _event_tables(f.get("table"))
+
+def _reports_export_body(fmt: str, f: dict, on_rows=None):
+    where, params = _reports_export_where(f)
+    params["lim"] = int(f.get("limit") or EXPORT_MAX_ROWS)
+
+    if fmt == "csv":
+        q = text(f"""
+            SELECT id,
+                   kind::text AS kind,
+                   signal::text AS signal,
+                   ST_Y(geom::geometry) AS lat,
+                   ST_X(geom::geometry) AS lng,
+                   user_id,
+                   created_at
+            FROM reports
+            WHERE {where}
+            ORDER BY created_at DESC, id DESC
+            LIMIT :lim
+        """)
+
+        def _row(r):
+            return [r.id, r.kind, r.signal, float(r.lat), float(r.lng), r.user_id, r.created_at.isoformat() if r.created_at else ""]
+
+        return csv_chunks(["id","kind","signal","lat","lng","user_id","created_at"], [(q, params, _row)], on_rows=on_rows)
+
+    if fmt in ("geojson", "ndjson"):
+        q = text(f"""
+            SELECT
+              id,
+              kind::text AS kind,
+              signal::text AS signal,
+              ST_AsGeoJSON(geom::geometry)::text AS geom_json,
+              user_id,
+              created_at
+            FROM reports
+            WHERE {where}
+            ORDER BY created_at DESC, id DESC
+            LIMIT :lim
+        """)
+
+        def _props(r):
+            return {
+                "id": r.id,
+                "kind": r.kind,
+                "signal": r.signal,
+                "user_id": r.user_id,
+                "created_at": r.created_at.isoformat() if r.created_at else None,
+            }
+
+        return geojson_chunks([(q, params, _props)], ndjson=(fmt == "ndjson"), on_rows=on_rows)
+
+    # parquet : colonnes typées + contexte transport
     q = text(f"""
-        SELECT id,
+        SELECT id::text AS id,
                kind::text AS kind,
                signal::text AS signal,
                ST_Y(geom::geometry) AS lat,
                ST_X(geom::geometry) AS lng,
-               user_id,
-               created_at
+               user_id::text AS user_id,
+               created_at,
+               mode, line_code, direction, current_stop, next_stop, final_stop
         FROM reports
-        WHERE {" AND ".join(where)}
+        WHERE {where}
         ORDER BY created_at DESC, id DESC
-        LIMIT 200000
+        LIMIT :lim
     """)
-    res = await db.execute(q, params)
-    rows = res.fetchall()
+    columns = [
+        ("id", "str"), ("kind", "dict"), ("signal", "dict"), ("lat", "float"), ("lng", "float"),
+        ("user_id", "str"), ("created_at", "ts"), ("mode", "dict"), ("line_code", "dict"),
+        ("direction", "dict"), ("current_stop", "dict"), ("next_stop", "dict"), ("final_stop", "dict"),
+    ]
 
-    buf = io.StringIO()
-    w = csv.writer(buf)
-    w.writerow(["id","kind","signal","lat","lng","user_id","created_at"])
-    for r in rows:
-        w.writerow([r.id, r.kind, r.signal, float(r.lat), float(r.lng), r.user_id, r.created_at.isoformat() if r.created_at else ""])
-    buf.seek(0)
-    return StreamingResponse(buf, media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=reports.csv"})
+    def _prow(r):
+        return (
+            r.id, r.kind, r.signal,
+            float(r.lat) if r.lat is not None else None,
+            float(r.lng) if r.lng is not None else None,
+            r.user_id, r.created_at,
+            r.mode, r.line_code, r.direction, r.current_stop, r.next_stop, r.final_stop,
+        )
+
+    return parquet_chunks(columns, [(q, params, _prow)], on_rows=on_rows)
+
+def _events_export_body(fmt: str, f: dict, on_rows=None):
+    lim = f.get("limit")
+    lim_sql = "LIMIT :lim" if lim else ""
+    queries = []
+    for tname in _event_tables(f.get("table")):
+        where, params = _events_export_where(f)
+        if lim:
+            params["lim"] = int(lim)
+
+        if fmt == "csv":
+            sql = text(f"""
+                SELECT '{tname}' AS table_name,
+                       id,
+                       kind::text AS kind,
+                       CASE WHEN restored_at IS NULL THEN 'active' ELSE 'restored' END AS status,
+                       ST_Y(center::geometry) AS lat,
+                       ST_X(center::geometry) AS lng,
+                       started_at,
+                       restored_at
+                FROM {tname}
+                WHERE {where}
+                {lim_sql}
+            """)
+
+            def _row(r):
+                started = r.started_at
+                restored = r.restored_at
+                dur_min = ""
+                if started and restored:
+                    dur_min = int((restored - started).total_seconds() // 60)
+                return [
+                    r.table_name, r.id, r.kind, r.status,
+                    float(r.lat), float(r.lng),
+                    started.isoformat() if started else "",
+                    restored.isoformat() if restored else "",
+                    dur_min
+                ]
+            queries.append((sql, params, _row))
+
+        elif fmt in ("geojson", "ndjson"):
+            sql = text(f"""
+                SELECT
+                  '{tname}' AS table_name,
+                  id,
+                  kind::text AS kind,
+                  CASE WHEN restored_at IS NULL THEN 'active' ELSE 'restored' END AS status,
+                  ST_AsGeoJSON(center::geometry)::text AS geom_json,
+                  started_at, restored_at
+                FROM {tname}
+                WHERE {where}
+                ORDER BY started_at DESC NULLS LAST, id DESC
+                {lim_sql}
+            """)
+
+            def _props(r):
+                return {
+                    "table": r.table_name,
+                    "id": r.id,
+                    "kind": r.kind,
+                    "status": r.status,
+                    "started_at": r.started_at.isoformat() if r.started_at else None,
+                    "restored_at": r.restored_at.isoformat() if r.restored_at else None,
+                }
+            queries.append((sql, params, _props))
+
+        else:  # parquet
+            sql = text(f"""
+                SELECT '{tname}' AS table_name,
+                       id::text AS id,
+                       kind::text AS kind,
+                       CASE WHEN restored_at IS NULL THEN 'active' ELSE 'restored' END AS status,
+                       ST_Y(center::geometry) AS lat,
+                       ST_X(center::geometry) AS lng,
+                       started_at,
+                       restored_at,
+                       EXTRACT(EPOCH FROM (restored_at - started_at)) / 60.0 AS duration_min
+                FROM {tname}
+                WHERE {where}
+                {lim_sql}
+            """)
+
+            def _prow(r):
+                return (
+                    r.table_name, r.id, r.kind, r.status,
+                    float(r.lat) if r.lat is not None else None,
+                    float(r.lng) if r.lng is not None else None,
+                    r.started_at, r.restored_at,
+                    float(r.duration_min) if r.duration_min is not None else None,
+                )
+            queries.append((sql, params, _prow))
+
+    if fmt == "csv":
+        return csv_chunks(["table","id","kind","status","lat","lng","started_at","restored_at","duration_min"], queries, on_rows=on_rows)
+    if fmt in ("geojson", "ndjson"):
+        return geojson_chunks(queries, ndjson=(fmt == "ndjson"), on_rows=on_rows)
+    columns = [
+        ("table", "dict"), ("id", "str"), ("kind", "dict"), ("status", "dict"),
+        ("lat", "float"), ("lng", "float"), ("started_at", "ts"), ("restored_at", "ts"),
+        ("duration_min", "float"),
+    ]
+    return parquet_chunks(columns, queries, on_rows=on_rows)
+
+def _export_body(subject: str, fmt: str, f: dict, on_rows=None):
+    """Générateur d'octets d'un export : mêmes requêtes en flux direct et en tâche de fond."""
+    _check_export(subject, fmt, f)
+    if subject == "reports":
+        return _reports_export_body(fmt, f, on_rows)
+    return _events_export_body(fmt, f, on_rows)
+
+def _export_count_queries(subject: str, f: dict):
+    # estimation de progression pour les tâches de fond
+    lim = f.get("limit") or (EXPORT_MAX_ROWS if subject == "reports" else None)
+    lim_sql = "LIMIT :lim" if lim else ""
+    out = []
+    if subject == "reports":
+        tabs, where_fn = ["reports"], _reports_export_where
+    else:
+        tabs, where_fn = _event_tables(f.get("table")), _events_export_where
+    for tname in tabs:
+        where, params = where_fn(f)
+        if lim:
+            params["lim"] = int(lim)
+        out.append((text(f"SELECT COUNT(*) FROM (SELECT 1 FROM {tname} WHERE {where} {lim_sql}) t"), params))
+    return out
+
+def _export_response(subject: str, fmt: str, f: dict) -> StreamingResponse:
+    """Export en flux direct (curseur serveur)."""
+    body = _export_body(subject, fmt, f)
+    media, ext = _EXPORT_FORMATS[fmt]
+    return StreamingResponse(body, media_type=media,
+        headers={"Content-Disposition": f"attachment; filename={subject}.{ext}"})
+
+@router.get("/admin/export_reports.csv")
+async def admin_export_reports_csv(
+    request: Request,
+    date_from: str | None = None,
+    date_to: str | None = None,
+    kind: str | None = None,          # 'traffic'|'accident'|'fire'|'flood'|'power'|'water'
+    signal: str | None = None,        # 'cut'|'restored'
+    min_lat: float | None = None, max_lat: float | None = None,
+    min_lng: float | None = None, max_lng: float | None = None,
+):
+    if not _is_admin_req(request):
+        raise HTTPException(status_code=401, detail="invalid admin token")
+    f = dict(date_from=date_from, date_to=date_to, kind=kind, signal=signal,
+             min_lat=min_lat, max_lat=max_lat, min_lng=min_lng, max_lng=max_lng)
+    return _export_response("reports", "csv", f)
 
 @router.get("/admin/export_events.csv")
 async def admin_export_events_csv(
@@ -1447,81 +1848,54 @@ async def admin_export_events_csv(
     table: str | None = None,         # 'incidents'|'outages'|'both' (par défaut both)
     min_lat: float | None = None, max_lat: float | None = None,
     min_lng: float | None = None, max_lng: float | None = None,
-    db: AsyncSession = Depends(get_db),
 ):
     if not _is_admin_req(request):
         raise HTTPException(status_code=401, detail="invalid admin token")
+    f = dict(date_from=date_from, date_to=date_to, kind=kind, status=status, table=table,
+             min_lat=min_lat, max_lat=max_lat, min_lng=min_lng, max_lng=max_lng)
+    return _export_response("events", "csv", f)
 
-    dt_from = _parse_dt(date_from)
-    dt_to   = _parse_dt(date_to)
-
-    def _build_sql(tab):
-        where = ["1=1"]
-        params = {}
-        if dt_from:
-            where.append("started_at >= :df")
-            params["df"] = dt_from
-        if dt_to:
-            where.append("started_at <= :dt")
-            params["dt"] = dt_to
-        if kind:
-            where.append("kind = :kind")
-            params["kind"] = kind
-        if status in ("active","restored"):
-            if status == "active":
-                where.append("restored_at IS NULL")
-            else:
-                where.append("restored_at IS NOT NULL")
-        bbox_sql, bbox_params = _bbox_clause(min_lat, max_lat, min_lng, max_lng, alias="center")
-        if bbox_sql:
-            where.append(bbox_sql)
-            params.update(bbox_params)
-        sql = text(f"""
-            SELECT '{tab}' AS table_name,
-                   id,
-                   kind::text AS kind,
-                   CASE WHEN restored_at IS NULL THEN 'active' ELSE 'restored' END AS status,
-                   ST_Y(center::geometry) AS lat,
-                   ST_X(center::geometry) AS lng,
-                   started_at,
-                   restored_at
-            FROM {tab}
-            WHERE {" AND ".join(where)}
-        """)
-        return sql, params
-
-    tabs = ["incidents","outages"] if table in (None,"both","") else [table]
-    all_rows = []
-    for tname in tabs:
-        sql, par = _build_sql(tname)
-        res = await db.execute(sql, par)
-        all_rows.extend([("incidents" if tname=="incidents" else "outages",) + tuple(r) for r in res.fetchall()])  # not used directly
+# --- Parquet exports (analyses) ---
+@router.get("/admin/export_reports.parquet")
+async def admin_export_reports_parquet(
+    request: Request,
+    date_from: str | None = None,
+    date_to: str | None = None,
+    kind: str | None = None,
+    signal: str | None = None,
+    min_lat: float | None = None, max_lat: float | None = None,
+    min_lng: float | None = None, max_lng: float | None = None,
+):
+    if not _is_admin_req(request):
+        raise HTTPException(status_code=401, detail="invalid admin token")
+    f = dict(date_from=date_from, date_to=date_to, kind=kind, signal=signal,
+             min_lat=min_lat, max_lat=max_lat, min_lng=min_lng, max_lng=max_lng)
+    return _export_response("reports", "parquet", f)
 
-    # build CSV
-    buf = io.StringIO()
-    w = csv.writer(buf)
-    w.writerow(["table","id","kind","status","lat","lng","started_at","restored_at","duration_min"])
-    for tname in tabs:
-        sql, par = _build_sql(tname)
-        res = await db.execute(sql, par)
-        for r in res.fetchall():
-            started = r.started_at
-            restored = r.restored_at
-            dur_min = ""
-            if started and restored:
-                dur_min = int((restored - started).total_seconds() // 60)
-            w.writerow([
-                tname, r.id, r.kind, r.status,
-                float(r.lat), float(r.lng),
-                started.isoformat() if started else "",
-                restored.isoformat() if restored else "",
-                dur_min
-            ])
-    buf.seek(0)
-    return StreamingResponse(buf, media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=events.csv"})
+@router.get("/admin/export_events.parquet")
+async def admin_export_events_parquet(
+    request: Request,
+    date_from: str | None = None,
+    date_to: str | None = None,
+    kind: str | None = None,
+    status: str | None = None,        # 'active'|'restored'
+    table: str | None = None,         # 'incidents'|'outages'|'both' (par défaut both)
+    min_lat: float | None = None, max_lat: float | None = None,
+    min_lng: float | None = None, max_lng: float | None = None,
+):
+    if not _is_admin_req(request):
+        raise HTTPException(status_code=401, detail="invalid admin token")
+    f = dict(date_from=date_from, date_to=date_to, kind=kind, status=status, table=table,
+             min_lat=min_lat, max_lat=max_lat, min_lng=min_lng, max_lng=max_lng)
+    return _export_response("events", "parquet", f)
 
 # --- GeoJSON exports ---
+def _geojson_format(fmt: str) -> str:
+    fmt = (fmt or "geojson").strip().lower()
+    if fmt not in ("geojson", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be geojson or ndjson")
+    return fmt
+
 @router.get("/admin/export_reports.geojson")
 async def admin_export_reports_geojson(
     request: Request,
@@ -1532,69 +1906,13 @@ async def admin_export_reports_geojson(
     min_lat: float | None = None, max_lat: float | None = None,
     min_lng: float | None = None, max_lng: float | None = None,
     limit: int = 200000,
-    db: AsyncSession = Depends(get_db),
+    format: str = "geojson",          # 'geojson' | 'ndjson' (une Feature par ligne)
 ):
     if not _is_admin_req(request):
         raise HTTPException(status_code=401, detail="invalid admin token")
-
-    dt_from = _parse_dt(date_from)
-    dt_to   = _parse_dt(date_to)
-
-    where = ["1=1"]
-    params = {}
-    if dt_from:
-        where.append("created_at >= :df"); params["df"] = dt_from
-    if dt_to:
-        where.append("created_at <= :dt"); params["dt"] = dt_to
-    if kind:
-        where.append("kind = :kind"); params["kind"] = kind
-    if signal:
-        where.append("LOWER(TRIM(signal::text)) = :sig"); params["sig"] = signal.strip().lower()
-    bbox_sql, bbox_params = _bbox_clause(min_lat, max_lat, min_lng, max_lng, alias="geom")
-    if bbox_sql: where.append(bbox_sql); params.update(bbox_params)
-
-    q = text(f"""
-        SELECT
-          id,
-          kind::text AS kind,
-          signal::text AS signal,
-          ST_AsGeoJSON(geom::geometry)::text AS geom_json,
-          user_id,
-          created_at
-        FROM reports
-        WHERE {" AND ".join(where)}
-        ORDER BY created_at DESC, id DESC
-        LIMIT :lim
-    """)
-    params["lim"] = limit
-    res = await db.execute(q, params)
-    rows = res.fetchall()
-
-    fc = {
-        "type": "FeatureCollection",
-        "features": []
-    }
-    for r in rows:
-        try:
-            geom = json.loads(r.geom_json)
-        except Exception:
-            continue
-        fc["features"].append({
-            "type": "Feature",
-            "geometry": geom,
-            "properties": {
-                "id": r.id,
-                "kind": r.kind,
-                "signal": r.signal,
-                "user_id": r.user_id,
-                "created_at": r.created_at.isoformat() if r.created_at else None,
-            }
-        })
-    buf = io.StringIO()
-    json.dump(fc, buf, ensure_ascii=False)
-    buf.seek(0)
-    return StreamingResponse(buf, media_type="application/geo+json",
-        headers={"Content-Disposition": "attachment; filename=reports.geojson"})
+    f = dict(date_from=date_from, date_to=date_to, kind=kind, signal=signal,
+             min_lat=min_lat, max_lat=max_lat, min_lng=min_lng, max_lng=max_lng, limit=limit)
+    return _export_response("reports", _geojson_format(format), f)
 
 @router.get("/admin/export_events.geojson")
 async def admin_export_events_geojson(
@@ -1607,73 +1925,75 @@ async def admin_export_events_geojson(
     min_lat: float | None = None, max_lat: float | None = None,
     min_lng: float | None = None, max_lng: float | None = None,
     limit: int = 200000,
-    db: AsyncSession = Depends(get_db),
+    format: str = "geojson",          # 'geojson' | 'ndjson' (une Feature par ligne)
 ):
     if not _is_admin_req(request):
         raise HTTPException(status_code=401, detail="invalid admin token")
+    f = dict(date_from=date_from, date_to=date_to, kind=kind, status=status, table=table,
+             min_lat=min_lat, max_lat=max_lat, min_lng=min_lng, max_lng=max_lng, limit=limit)
+    return _export_response("events", _geojson_format(format), f)
+
+# --- Exports en tâche de fond (job id, progression, téléchargement reprenable) ---
+class ExportJobIn(BaseModel):
+    subject: str = "reports"          # 'reports' | 'events'
+    format: str = "csv"               # 'csv' | 'geojson' | 'ndjson' | 'parquet'
+    date_from: Optional[str] = None
+    date_to: Optional[str] = None
+    kind: Optional[str] = None
+    signal: Optional[str] = None      # reports
+    status: Optional[str] = None      # events
+    table: Optional[str] = None       # events : 'incidents'|'outages'|'both'
+    min_lat: Optional[float] = None
+    max_lat: Optional[float] = None
+    min_lng: Optional[float] = None
+    max_lng: Optional[float] = None
+    limit: Optional[int] = None
+
+@router.post("/admin/export_jobs")
+async def admin_submit_export_job(request: Request, body: ExportJobIn):
+    if not _is_admin_req(request):
+        raise HTTPException(status_code=401, detail="invalid admin token")
+    subject = (body.subject or "").strip().lower()
+    fmt = (body.format or "").strip().lower()
+    f = body.model_dump(exclude={"subject", "format"})
+    _check_export(subject, fmt, f)
+    count_queries = _export_count_queries(subject, f)
+    meta = await export_jobs.submit_job(
+        subject=subject,
+        fmt=fmt,
+        filters=f,
+        filename=f"{subject}.{_EXPORT_FORMATS[fmt][1]}",
+        make_body=lambda on_rows: _export_body(subject, fmt, f, on_rows),
+        estimate=lambda: count_rows(count_queries),
+        compress=(fmt != "parquet"),  # parquet : déjà compressé par colonne
+    )
+    return {"ok": True, **export_jobs.job_view(meta)}
 
-    dt_from = _parse_dt(date_from)
-    dt_to   = _parse_dt(date_to)
-
-    tabs = ["incidents","outages"] if table in (None,"both","") else [table]
-    feats = []
+@router.get("/admin/export_jobs")
+async def admin_list_export_jobs(request: Request):
+    if not _is_admin_req(request):
+        raise HTTPException(status_code=401, detail="invalid admin token")
+    return {"ok": True, "jobs": export_jobs.list_jobs()}
 
-    for tname in tabs:
-        where = ["1=1"]
-        params = {}
-        if dt_from:
-            where.append("started_at >= :df"); params["df"] = dt_from
-        if dt_to:
-            where.append("started_at <= :dt"); params["dt"] = dt_to
-        if kind:
-            where.append("kind = :kind"); params["kind"] = kind
-        if status in ("active","restored"):
-            if status == "active":
-                where.append("restored_at IS NULL")
-            else:
-                where.append("restored_at IS NOT NULL")
-        bbox_sql, bbox_params = _bbox_clause(min_lat, max_lat, min_lng, max_lng, alias="center")
-        if bbox_sql: where.append(bbox_sql); params.update(bbox_params)
+@router.get("/admin/export_jobs/{job_id}")
+async def admin_export_job_status(job_id: str, request: Request):
+    if not _is_admin_req(request):
+        raise HTTPException(status_code=401, detail="invalid admin token")
+    return {"ok": True, **export_jobs.job_view(await export_jobs.get_job(job_id))}
 
-        sql = text(f"""
-            SELECT
-              id,
-              kind::text AS kind,
-              CASE WHEN restored_at IS NULL THEN 'active' ELSE 'restored' END AS status,
-              ST_AsGeoJSON(center::geometry)::text AS geom_json,
-              started_at, restored_at
-            FROM {tname}
-            WHERE {" AND ".join(where)}
-            ORDER BY started_at DESC NULLS LAST, id DESC
-            LIMIT :lim
-        """)
-        params["lim"] = limit
-        res = await db.execute(sql, params)
-        rows = res.fetchall()
-        for r in rows:
-            try:
-                geom = json.loads(r.geom_json)
-            except Exception:
-                continue
-            feats.append({
-                "type": "Feature",
-                "geometry": geom,
-                "properties": {
-                    "table": tname,
-                    "id": r.id,
-                    "kind": r.kind,
-                    "status": r.status,
-                    "started_at": r.started_at.isoformat() if r.started_at else None,
-                    "restored_at": r.restored_at.isoformat() if r.restored_at else None,
-                }
-            })
+@router.get("/admin/export_jobs/{job_id}/download")
+async def admin_export_job_download(job_id: str, request: Request):
+    if not _is_admin_req(request):
+        raise HTTPException(status_code=401, detail="invalid admin token")
+    meta = await export_jobs.get_job(job_id)
+    return await export_jobs.download_response(meta, request.headers.get("range"), request.headers.get("if-range"))
 
-    fc = {"type":"FeatureCollection","features":feats}
-    buf = io.StringIO()
-    json.dump(fc, buf, ensure_ascii=False)
-    buf.seek(0)
-    return StreamingResponse(buf, media_type="application/geo+json",
-        headers={"Content-Disposition": "attachment; filename=events.geojson"})
+@router.delete("/admin/export_jobs/{job_id}")
+async def admin_cancel_export_job(job_id: str, request: Request):
+    if not _is_admin_req(request):
+        raise HTTPException(status_code=401, detail="invalid admin token")
+    await export_jobs.cancel_job(job_id)
+    return {"ok": True}
 
 # --- Attachments près d'un point ---
 
@@ -1724,8 +2044,10 @@ async def attachments_near(
         pass
 
     try:
+        # colonne créée par /admin/ensure_schema : pas de miniature tant qu'elle manque
+        thumb_col = "thumb_url" if await media_ready(db) else "NULL::text AS thumb_url"
         rs = await db.execute(
-            text("""
+            text(f"""
                 WITH me AS (
                     SELECT ST_SetSRID(ST_MakePoint(:lng,:lat),4326)::geography AS g
                 )
@@ -1735,7 +2057,8 @@ async def attachments_near(
                     ST_Y(geom::geometry) AS lat,
                     ST_X(geom::geometry) AS lng,
                     user_id,
-                    created_at
+                    created_at,
+                    {thumb_col}
                 FROM attachments
                 WHERE LOWER(TRIM(kind::text)) = :k
                   AND created_at > NOW() - (:hours * INTERVAL '1 hour')
@@ -1753,28 +2076,31 @@ async def attachments_near(
         )
         rows = rs.mappings().all()
 
+        def _can_see(r) -> bool:
+            # admin, ou viewer == uploader
+            uploader = str(r["user_id"]) if r["user_id"] else None
+            return is_admin or bool(viewer_user_id and uploader and str(viewer_user_id) == uploader)
+
+        # signatures en un seul lot (dédoublonné, concurrent) au lieu d'un appel par ligne
+        to_sign = [u for r in rows if _can_see(r) for u in (r["url"], r["thumb_url"]) if u]
+        try:
+            signed = await get_signed_cached_many(to_sign, link_ttl_sec=300, db=db)
+        except Exception:
+            signed = {u: u for u in to_sign} if debug else {}  # en debug on laisse brut
+
         out = []
         for r in rows:
             uploader_id = str(r["user_id"]) if r["user_id"] else None
             raw_url = r["url"]
 
-            # est-ce que ce viewer est bien l'uploader ?
-            is_owner = False
-            if viewer_user_id and uploader_id:
-                if str(viewer_user_id) == uploader_id:
-                    is_owner = True
-
             final_url = None
             guessed_mime = None
 
-            if raw_url and (is_admin or is_owner):
-                try:
-                    final_url = await get_signed_cached(raw_url, cache_ttl=60, link_ttl_sec=300)
-                except Exception:
-                    if debug:
-                        final_url = raw_url  # en debug on laisse brut
-            else:
-                final_url = None
+            thumb_url = None
+            if raw_url and _can_see(r):
+                final_url = signed.get(raw_url)
+                if r["thumb_url"]:
+                    thumb_url = signed.get(r["thumb_url"])
 
             if final_url:
                 low = final_url.lower()
@@ -1797,6 +2123,7 @@ async def attachments_near(
                     "lng": float(r["lng"]),
                     "created_at": r["created_at"].isoformat() if r["created_at"] else None,
                     "url": final_url,
+                    "thumb_url": thumb_url,
                     "mime_type": guessed_mime,
                     "uploader_id": uploader_id,
                 })
@@ -1850,106 +2177,52 @@ async def admin_export_aggregated_csv(
     buf = io.StringIO()
     w = csv.writer(buf)
 
+    # lecture dans les agrégats horaires (app/services/rollups.py), bords en brut
+    day_dim = ("day", "date_trunc('day', bucket)::date")
+    dims = {
+        "day": [day_dim],
+        "kind": [("kind", "kind")],
+        "day_kind": [day_dim, ("kind", "kind")],
+        "day_kind_status": [day_dim, ("kind", "kind"), ("status", "status")],
+    }
+
     if subject == "reports":
-        where = ["1=1"]; params = {}
-        if dt_from: where.append("created_at >= :df"); params["df"] = dt_from
-        if dt_to:   where.append("created_at <= :dt"); params["dt"] = dt_to
+        where = []; params = {}
         if kind:    where.append("kind = :kind");       params["kind"] = kind
 
-        if by == "day":
-            sql = text(f"""
-                SELECT date_trunc('day', created_at)::date AS day, COUNT(*) AS n
-                FROM reports
-                WHERE {" AND ".join(where)}
-                GROUP BY 1 ORDER BY 1
-            """)
-            w.writerow(["day","reports"])
-        elif by == "kind":
-            sql = text(f"""
-                SELECT kind::text AS kind, COUNT(*) AS n
-                FROM reports
-                WHERE {" AND ".join(where)}
-                GROUP BY 1 ORDER BY 1
-            """)
-            w.writerow(["kind","reports"])
-        else:  # day_kind
-            sql = text(f"""
-                SELECT date_trunc('day', created_at)::date AS day, kind::text AS kind, COUNT(*) AS n
-                FROM reports
-                WHERE {" AND ".join(where)}
-                GROUP BY 1,2 ORDER BY 1,2
-            """)
-            w.writerow(["day","kind","reports"])
-
-        res = await db.execute(sql, params)
-        for r in res.fetchall():
-            w.writerow(list(r))
+        by_r = by if by in ("day", "kind") else "day_kind"
+        w.writerow([alias for alias, _ in dims[by_r]] + ["reports"])
+        rows = await report_counts(
+            db, dims[by_r], since=dt_from, until=dt_to, where=where, params=params,
+        )
+        for r in rows:
+            w.writerow(list(r.values()))
 
     else:  # events
         tabs = ["incidents","outages"] if table in (None,"both","") else [table]
-        # on agrège en UNION ALL puis regroupement Python
-        rows = []
-        for tname in tabs:
-            where = ["1=1"]; params = {}
-            if dt_from: where.append("started_at >= :df"); params["df"] = dt_from
-            if dt_to:   where.append("started_at <= :dt"); params["dt"] = dt_to
-            if kind:    where.append("kind = :kind");       params["kind"] = kind
-            if status in ("active","restored"):
-                if status == "active": where.append("restored_at IS NULL")
-                else: where.append("restored_at IS NOT NULL")
-
-            sql = text(f"""
-                SELECT
-                  date_trunc('day', started_at)::date AS day,
-                  kind::text AS kind,
-                  CASE WHEN restored_at IS NULL THEN 'active' ELSE 'restored' END AS status,
-                  started_at, restored_at
-                FROM {tname}
-                WHERE {" AND ".join(where)}
-            """)
-            res = await db.execute(sql, params)
-            rows.extend(res.fetchall())
+        where = []; params = {}
+        if kind:    where.append("kind = :kind");       params["kind"] = kind
+        if status in ("active","restored"):
+            where.append("status = :status");           params["status"] = status
 
-        # regroupement
-        from collections import defaultdict
-        agg = defaultdict(lambda: {"n":0, "dur_sum":0.0, "dur_min":None, "dur_max":None})
-        for r in rows:
-            day = r.day
-            kindv = r.kind
-            statusv = r.status
-            if by == "day":
-                key = (str(day),)
-            elif by == "kind":
-                key = (kindv,)
-            elif by == "day_kind":
-                key = (str(day), kindv)
-            else:
-                key = (str(day), kindv, statusv)
-            agg[key]["n"] += 1
-            if r.started_at and r.restored_at:
-                dur = (r.restored_at - r.started_at).total_seconds() / 60.0
-                agg[key]["dur_sum"] += dur
-                agg[key]["dur_min"] = dur if agg[key]["dur_min"] is None else min(agg[key]["dur_min"], dur)
-                agg[key]["dur_max"] = dur if agg[key]["dur_max"] is None else max(agg[key]["dur_max"], dur)
+        by_e = by if by in dims else "day_kind_status"
+        rows = await event_stats(
+            db, dims[by_e], tables=tabs, since=dt_from, until=dt_to, where=where, params=params,
+        )
 
         # header & rows
-        if by == "day":
-            w.writerow(["day","events","avg_duration_min","min_duration_min","max_duration_min"])
-        elif by == "kind":
-            w.writerow(["kind","events","avg_duration_min","min_duration_min","max_duration_min"])
-        elif by == "day_kind":
-            w.writerow(["day","kind","events","avg_duration_min","min_duration_min","max_duration_min"])
-        else:
-            w.writerow(["day","kind","status","events","avg_duration_min","min_duration_min","max_duration_min"])
+        w.writerow([alias for alias, _ in dims[by_e]]
+                   + ["events","avg_duration_min","min_duration_min","max_duration_min"])
 
-        for key, val in sorted(agg.items()):
+        for r in rows:
+            key = [r[alias] for alias, _ in dims[by_e]]
             avg = ""
-            if val["dur_sum"] > 0 and val["n"] > 0:
+            if r["dur_sum"] and r["dur_sum"] > 0 and r["n"] > 0:
                 # moyenne sur éléments avec durée (approx via dur_sum / n)
-                avg = round(val["dur_sum"] / val["n"], 2)
-            row = list(key) + [val["n"], avg,
-                               round(val["dur_min"],2) if val["dur_min"] is not None else "",
-                               round(val["dur_max"],2) if val["dur_max"] is not None else ""]
+                avg = round(r["dur_sum"] / r["n"], 2)
+            row = key + [r["n"], avg,
+                         round(r["dur_min"],2) if r["dur_min"] is not None else "",
+                         round(r["dur_max"],2) if r["dur_max"] is not None else ""]
             w.writerow(row)
 
     buf.seek(0)
@@ -2007,100 +2280,111 @@ from sqlalchemy import text
 from typing import Optional
 from ..db import get_db  # adapte si besoin
 
+# Calcul à la volée : uniquement si l'appelant demande une fenêtre/cellule
+# différente de celle matérialisée dans alert_zones (ou table pas encore créée).
+_ALERT_ZONES_LIVE_SQL = text("""
+  WITH me AS (
+    SELECT ST_SetSRID(ST_MakePoint(:lng,:lat),4326)::geography AS g
+  ),
+  base AS (
+    SELECT id, LOWER(TRIM(kind::text)) AS kind, created_at, (geom::geography) AS gg
+    FROM reports
+    WHERE LOWER(TRIM(kind::text))   = ANY(:kinds)
+      AND LOWER(TRIM(signal::text)) = 'cut'
+      AND created_at > NOW() - make_interval(hours => :hours)
+      AND ST_DWithin((geom::geography), (SELECT g FROM me), :rad_m)
+  ),
+  cells AS (
+    -- même découpage que la table matérialisée (alert_zones.cell_of : floor, pas d'arrondi)
+    SELECT
+      kind,
+      FLOOR(ST_X(gg::geometry) / :cell_deg)::int AS cx,
+      FLOOR(ST_Y(gg::geometry) / :cell_deg)::int AS cy,
+      gg
+    FROM base
+  ),
+  grouped AS (
+    SELECT
+      kind,
+      cx,
+      cy,
+      COUNT(*) AS count,
+      ST_Centroid(ST_Collect(gg::geometry)) AS center_geom
+    FROM cells
+    GROUP BY kind, cx, cy
+    HAVING COUNT(*) >= :min_count
+  ),
+  zones AS (
+    SELECT
+      kind,
+      count::int AS count,
+      ST_Y(center_geom) AS lat,
+      ST_X(center_geom) AS lng
+    FROM grouped
+  )
+  SELECT z.kind, z.count, z.lat, z.lng
+  FROM zones z
+  WHERE NOT EXISTS (
+    SELECT 1
+    FROM acks ak
+    WHERE LOWER(TRIM(ak.kind::text)) = z.kind
+      AND ST_DWithin(
+        (ST_SetSRID(ST_MakePoint(z.lng, z.lat),4326)::geography),
+        (ak.geom::geography),
+        :ack_r
+      )
+  )
+  ORDER BY z.count DESC
+  LIMIT 50
+""")
+
 @router.get("/alert_zones")
 async def alert_zones(
-    kind: str = Query(..., description="fire|traffic|accident|flood|power|water"),
+    kind: str = Query(..., description="fire|traffic|accident|flood|power|water (plusieurs: fire,flood)"),
     lat: float = Query(..., ge=-90, le=90),
     lng: float = Query(..., ge=-180, le=180),
     radius_km: float = Query(1.0, ge=0.1, le=50),
-    hours: int = Query(int(os.getenv("ALERT_WINDOW_HOURS", "3")), ge=1, le=72),
+    hours: int = Query(ALERT_ZONE_WINDOW_H, ge=1, le=72),
     min_count: int = Query(int(os.getenv("ALERT_MIN_REPORTS", "3")), ge=2, le=50),
-    cell_m: int = Query(int(os.getenv("ALERT_RADIUS_M", "150")), ge=50, le=1000),
+    cell_m: int = Query(ALERT_ZONE_CELL_M, ge=50, le=1000),
     db: AsyncSession = Depends(get_db),
 ):
-    k = (kind or "").strip().lower()
-    if k not in ALLOWED_KINDS:
+    kinds = sorted({k.strip().lower() for k in (kind or "").split(",") if k.strip()})
+    if not kinds or any(k not in ALLOWED_KINDS for k in kinds):
         raise HTTPException(status_code=400, detail="invalid kind")
 
-
-    # ~150 m → degrés
-    cell_deg = max(0.0003, min(0.01, cell_m / 111_000.0))
-
-    sql = text("""
-      WITH me AS (
-        SELECT ST_SetSRID(ST_MakePoint(:lng,:lat),4326)::geography AS g
-      ),
-      base AS (
-        SELECT id, kind, created_at, (geom::geography) AS gg
-        FROM reports
-        WHERE LOWER(TRIM(kind::text))   = :kind
-          AND LOWER(TRIM(signal::text)) = 'cut'
-          AND created_at > NOW() - make_interval(hours => :hours)
-          AND ST_DWithin((geom::geography), (SELECT g FROM me), :rad_m)
-      ),
-      cells AS (
-        SELECT
-          kind,
-          ST_SnapToGrid((gg::geometry), :cell_deg, :cell_deg) AS grid,
-          gg
-        FROM base
-      ),
-      grouped AS (
-        SELECT
-          kind,
-          grid,
-          COUNT(*) AS count,
-          ST_Centroid(ST_Collect(gg::geometry)) AS center_geom
-        FROM cells
-        GROUP BY kind, grid
-        HAVING COUNT(*) >= :min_count
-      ),
-      zones AS (
-        SELECT
-          kind,
-          count::int AS count,
-          ST_Y(center_geom) AS lat,
-          ST_X(center_geom) AS lng
-        FROM grouped
-      )
-      SELECT z.kind, z.count, z.lat, z.lng
-      FROM zones z
-      WHERE NOT EXISTS (
-        SELECT 1
-        FROM acks ak
-        WHERE LOWER(TRIM(ak.kind::text)) = LOWER(TRIM(z.kind::text))
-          AND ST_DWithin(
-            (ST_SetSRID(ST_MakePoint(z.lng, z.lat),4326)::geography),
-            (ak.geom::geography),
-            :ack_r
-          )
-      )
-      ORDER BY z.count DESC
-      LIMIT 50
-    """)
-
-
-    params = {
-        "kind": k,
-        "lng": lng, "lat": lat,
-        "rad_m": float(radius_km) * 1000.0,
-        "hours": int(hours),
-        "cell_deg": float(cell_deg),
-        "min_count": int(min_count),
-        "ack_r": float(cell_m),
-    }
-
     try:
-        rs = await db.execute(sql, params)
-        rows = rs.mappings().all()
+        zones = None
+        if int(hours) == ALERT_ZONE_WINDOW_H and int(cell_m) == ALERT_ZONE_CELL_M:
+            # None : table pas encore créée (/admin/ensure_schema) → calcul à la volée
+            zones = await read_alert_zones(
+                db, kinds, lat, lng, float(radius_km) * 1000.0,
+                min_count=int(min_count), limit=50,
+            )
+        if zones is None:
+            # ~150 m → degrés
+            cell_deg = max(0.0003, min(0.01, cell_m / 111_000.0))
+            rs = await db.execute(_ALERT_ZONES_LIVE_SQL, {
+                "kinds": kinds,
+                "lng": lng, "lat": lat,
+                "rad_m": float(radius_km) * 1000.0,
+                "hours": int(hours),
+                "cell_deg": float(cell_deg),
+                "min_count": int(min_count),
+                "ack_r": float(cell_m),
+            })
+            zones = [
+                {"kind": r.kind, "count": int(r.count), "lat": float(r.lat), "lng": float(r.lng)}
+                for r in rs.fetchall()
+            ]
     except Exception as e:
         await db.rollback()
         raise HTTPException(status_code=500, detail=f"alert_zones failed: {e}")
 
     return [
-        {"kind": r["kind"], "lat": float(r["lat"]), "lng": float(r["lng"]),
-         "radius_m": int(cell_m), "count": int(r["count"])}
-        for r in rows
+        {"kind": z["kind"], "lat": z["lat"], "lng": z["lng"],
+         "radius_m": int(cell_m), "count": z["count"]}
+        for z in zones
     ]
 
 
@@ -2134,6 +2418,8 @@ async def fire_ack(
             VALUES (:k, ST_SetSRID(ST_MakePoint(:lng,:lat),4326)::geography,
                     NULLIF(:uid,'')::uuid, NOW())
         """), {"k": k, "lng": p.lng, "lat": p.lat, "uid": (p.user_id or "")})
+        # suppression appliquée à l'écriture sur les zones matérialisées
+        await suppress_alert_zones_near(db, k, p.lat, p.lng)
         await db.commit()
     except Exception as e:
         await db.rollback()
@@ -7,9 +7,11 @@ from typing import Optional, Dict, Any
 
 from fastapi import APIRouter, Depends, HTTPException, Request, Query
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import text
 
 from app.db import get_db
+from app.services.resolution import SLA_TARGET_MIN, avg_resolution_min, open_over_sla, resolution_stats
+from app.services.result_cache import metrics_cache
+from app.services.rollups import report_counts
 
 router = APIRouter(prefix="/metrics", tags=["Metrics"])
 
@@ -58,44 +60,38 @@ async def metrics_summary(
     - nb total de reports
     - nb par status (new / confirmed / resolved)
     - breakdown par kind (tous kinds présents dans la table)
+    - délai moyen de résolution (histogrammes journaliers → fenêtre au jour près)
+    Résultat partagé entre opérateurs (cache court, un seul calcul à la fois).
     """
 
-    cutoff = datetime.now(timezone.utc) - timedelta(hours=hours)
-    params: Dict[str, Any] = {"cutoff": cutoff}
-
-    # Total & par status
-    q_tot = text("""
-        SELECT
-          COUNT(*)::int AS n_total,
-          COUNT(*) FILTER (WHERE COALESCE(status,'new') = 'new')::int       AS n_new,
-          COUNT(*) FILTER (WHERE status = 'confirmed')::int                 AS n_confirmed,
-          COUNT(*) FILTER (WHERE status = 'resolved')::int                  AS n_resolved
-        FROM reports
-        WHERE created_at > :cutoff
-    """)
-    res_tot = await db.execute(q_tot, params)
-    tot = res_tot.mappings().first() or {
-        "n_total": 0,
-        "n_new": 0,
-        "n_confirmed": 0,
-        "n_resolved": 0,
-    }
-
-    # Breakdown par kind (tous kinds, pour debug général)
-    q_kind = text("""
-        SELECT kind::text AS kind, COUNT(*)::int AS n
-          FROM reports
-         WHERE created_at > :cutoff
-         GROUP BY 1
-         ORDER BY 2 DESC
-    """)
-    rows_kind = (await db.execute(q_kind, params)).mappings().all()
-
+    async def _load(s: AsyncSession) -> Dict[str, Any]:
+        cutoff = datetime.now(timezone.utc) - timedelta(hours=hours)
+
+        # Total & par status (agrégats horaires + bords en brut)
+        by_status = {
+            r["status"]: r["n"]
+            for r in await report_counts(s, [("status", "status")], since=cutoff)
+        }
+        tot = {
+            "n_total": sum(by_status.values()),
+            "n_new": by_status.get("new", 0),
+            "n_confirmed": by_status.get("confirmed", 0),
+            "n_resolved": by_status.get("resolved", 0),
+        }
+
+        # Breakdown par kind (tous kinds, pour debug général)
+        rows_kind = await report_counts(s, [("kind", "kind")], since=cutoff, order="2 DESC")
+
+        return {
+            "window_h": hours,
+            "total": dict(tot),
+            "by_kind": rows_kind,
+            "avg_to_resolved_min": await avg_resolution_min(s, cutoff),
+        }
+
+    out = await metrics_cache.get(("summary", hours), _load, db)
     return {
-        "window_h": hours,
-        "total": dict(tot),
-        "by_kind": rows_kind,
-        "avg_to_resolved_min": None,
+        **out,
         "server_now": datetime.now(timezone.utc).isoformat().replace("+00:00", "Z"),
     }
 
@@ -116,27 +112,23 @@ async def metrics_incidents_by_day(
     Spécifique RATP propreté : on ne regarde que signal = 'to_clean'.
     """
 
-    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
-    params: Dict[str, Any] = {"cutoff": cutoff}
+    async def _load(s: AsyncSession) -> Dict[str, Any]:
+        cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+        params: Dict[str, Any] = {}
 
-    where = ["LOWER(TRIM(signal::text)) = 'to_clean'", "created_at >= :cutoff"]
+        where = ["signal = 'to_clean'"]
 
-    if kind:
-        where.append("LOWER(kind::text) = LOWER(:k)")
-        params["k"] = kind
+        if kind:
+            where.append("LOWER(kind) = LOWER(:k)")
+            params["k"] = kind
 
-    q = text(f"""
-        SELECT
-          date_trunc('day', created_at)::date AS day,
-          COUNT(*)::int AS n
-        FROM reports
-        WHERE {" AND ".join(where)}
-        GROUP BY 1
-        ORDER BY 1
-    """)
+        rows = await report_counts(
+            s, [("day", "date_trunc('day', bucket)::date")],
+            since=cutoff, where=where, params=params,
+        )
+        return {"days": days, "kind": kind, "series": rows}
 
-    rows = (await db.execute(q, params)).mappings().all()
-    return {"days": days, "kind": kind, "series": rows}
+    return await metrics_cache.get(("incidents_by_day", days, kind), _load, db)
 
 
 # ---------------------------------------------------------------------------
@@ -156,22 +148,54 @@ async def metrics_kind_breakdown(
     Même si la table contient encore d'anciens 'traffic', 'accident', etc.
     """
 
-    cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+    async def _load(s: AsyncSession) -> Dict[str, Any]:
+        cutoff = datetime.now(timezone.utc) - timedelta(days=days)
+
+        rows_raw = await report_counts(s, [("kind", "kind")], since=cutoff, order="2 DESC")
 
-    q = text("""
-        SELECT kind::text AS kind, COUNT(*)::int AS n
-          FROM reports
-         WHERE created_at >= :cutoff
-         GROUP BY 1
-         ORDER BY 2 DESC
-    """)
+        items = []
+        for r in rows_raw:
+            k = (r["kind"] or "").lower()
+            if k in RATP_KINDS:
+                items.append({"kind": k, "n": r["n"]})
 
-    rows_raw = (await db.execute(q, {"cutoff": cutoff})).mappings().all()
+        return {"days": days, "items": items}
+
+    return await metrics_cache.get(("kind_breakdown", days), _load, db)
+
+
+# ---------------------------------------------------------------------------
+# /metrics/resolution
+# ---------------------------------------------------------------------------
 
-    items = []
-    for r in rows_raw:
-        k = (r["kind"] or "").lower()
-        if k in RATP_KINDS:
-            items.append({"kind": k, "n": r["n"]})
+@router.get("/resolution")
+async def metrics_resolution(
+    ok: bool = Depends(require_admin),
+    db: AsyncSession = Depends(get_db),
+    days: int = Query(30, ge=1, le=365),
+    by: str = Query("kind", pattern="^(all|kind|line|day|kind_day)$"),
+    kind: Optional[str] = Query(None),
+    target_min: int = Query(SLA_TARGET_MIN, ge=1, le=10080),
+):
+    """
+    Délais de résolution (minutes, création → passage à 'resolved') :
+    n, moyenne, p50 / p90 / p99 et part résolue sous l'objectif SLA,
+    groupés par kind, ligne, jour de résolution (ou kind × jour).
+    Lus depuis les histogrammes tenus à chaque /cta/mark_status
+    (percentiles interpolés dans l'intervalle).
+    """
 
-    return {"days": days, "items": items}
+    async def _load(s: AsyncSession) -> Dict[str, Any]:
+        items = await resolution_stats(s, days=days, by=by, kind=kind, target_min=target_min)
+        overall = await resolution_stats(s, days=days, by="all", kind=kind, target_min=target_min)
+        return {
+            "days": days,
+            "by": by,
+            "kind": kind,
+            "target_min": target_min,
+            "overall": overall[0] if overall else None,
+            "open_over_target": await open_over_sla(s, days=days, kind=kind, target_min=target_min),
+            "items": items,
+        }
+
+    return await metrics_cache.get(("resolution", days, by, kind, target_min), _load, db)
@@ -3,6 +3,10 @@ import os
 from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.crud import expire_stale_outages, expire_incidents
+from app.services.alert_zones import maintain_alert_zones
+from app.services.attachment_links import maintain_attachment_links
+from app.services.cta_queue import maintain_cta_queue
+from app.services.rollups import maintain_rollups
 
 # -------- Parameters (override via env if needed) ----------
 LOG_AGG = os.getenv("LOG_AGG", "0") == "1"
@@ -164,3 +168,15 @@ async def run_aggregation(db: AsyncSession) -> None:
     if LOG_AGG:
         if c1 is not None: print(f"[agg] expire_stale_outages -> {c1}")
         if c2 is not None: print(f"[agg] expire_incidents -> {c2}")
+
+    # 6) Zones d'alerte matérialisées : sortie de fenêtre
+    await maintain_alert_zones(db)
+
+    # 7) Lien report ↔ pièces jointes : backfill des anciennes lignes, un lot par passage
+    await maintain_attachment_links(db)
+
+    # 8) Agrégats horaires (métriques / export agrégé) : heures closes + fenêtre récente
+    await maintain_rollups(db)
+
+    # 9) File de travail CTA : sortie de fenêtre, rattrapage, compteurs de voisinage
+    await maintain_cta_queue(db)
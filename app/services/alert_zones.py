@@ -0,0 +1,298 @@
+# app/services/alert_zones.py
+"""
+Zones d'alerte matérialisées.
+
+Au lieu de recalculer grille/DBSCAN + NOT EXISTS(acks) à chaque lecture,
+on maintient une ligne par (kind, cellule) dans `alert_zones` :
+  - mise à jour de la cellule à chaque report 'cut' inséré
+  - ré-évaluation des cellules dont le plus vieux report sort de la fenêtre
+  - suppression par acks/fire_ack appliquée à l'écriture (colonne `acked`)
+La lecture devient un simple lookup spatial indexé.
+
+Schéma créé uniquement par /admin/ensure_schema ou le scheduler (index sur
+reports en CONCURRENTLY, hors transaction) ; tant que la table n'existe pas,
+les hooks d'écriture ne font rien et la lecture renvoie None.
+
+Grille fixe (cellules de ALERT_RADIUS_M, 150 m par défaut, comme /alert_zones)
+au lieu de l'ancien DBSCAN de /map (eps ALERT_RADIUS_M, 100 m par défaut) ;
+fenêtre ALERT_WINDOW_HOURS, avec repli sur ALERT_WINDOW_H (ancien nom de /map).
+"""
+import math
+import os
+from typing import Any, Dict, Iterable, List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.services.ddl import create_indexes_concurrently
+
+# -------- Parameters (override via env if needed) ----------
+LOG_AGG = os.getenv("LOG_AGG", "0") == "1"
+
+ALERT_ZONE_WINDOW_H  = int(os.getenv("ALERT_WINDOW_HOURS") or os.getenv("ALERT_WINDOW_H") or "3")
+ALERT_ZONE_CELL_M    = int(os.getenv("ALERT_RADIUS_M", "150"))
+ALERT_ZONE_MIN_COUNT = int(os.getenv("ALERT_MIN_REPORTS", "3"))
+
+# ~150 m → degrés (mêmes bornes que l'ancien calcul à la volée)
+ALERT_ZONE_CELL_DEG = max(0.0003, min(0.01, ALERT_ZONE_CELL_M / 111_000.0))
+
+ALERT_ZONE_KINDS = {
+    "traffic", "accident", "fire", "flood", "power", "water",
+    "assault", "weapon", "medical",
+}
+
+_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS alert_zones (
+      kind       text        NOT NULL,
+      cell_x     integer     NOT NULL,
+      cell_y     integer     NOT NULL,
+      n          integer     NOT NULL DEFAULT 0,
+      center     geography(Point,4326) NOT NULL,
+      oldest_at  timestamptz NOT NULL,
+      newest_at  timestamptz NOT NULL,
+      acked      boolean     NOT NULL DEFAULT false,
+      updated_at timestamptz NOT NULL DEFAULT NOW(),
+      PRIMARY KEY (kind, cell_x, cell_y)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_alert_zones_center ON alert_zones USING GIST (center)",
+    "CREATE INDEX IF NOT EXISTS idx_alert_zones_oldest ON alert_zones (oldest_at)",
+    "CREATE INDEX IF NOT EXISTS idx_acks_geom ON acks USING GIST (geom)",
+]
+
+# index sur la table chaude : sans verrou bloquant les INSERT, hors transaction
+_CONCURRENT_DDL = [
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_reports_geom_geometry ON reports USING GIST ((geom::geometry))",
+]
+
+_schema_ready = False
+_table_ready = False  # sonde hooks/lecture, distincte : ne court-circuite pas le DDL
+_rebuilt = False
+
+
+async def ensure_alert_zones_schema(db: AsyncSession) -> None:
+    """DDL + commit : /admin/ensure_schema et scheduler uniquement."""
+    global _schema_ready, _table_ready
+    if _schema_ready:
+        return
+    for ddl in _DDL:
+        await db.execute(text(ddl))
+    await db.commit()
+    await create_indexes_concurrently(db, _CONCURRENT_DDL)
+    _schema_ready = _table_ready = True
+
+
+async def alert_zones_ready(db: AsyncSession) -> bool:
+    """Table présente ? (hooks / lecture : ni DDL ni commit)."""
+    global _table_ready
+    if not _table_ready and (await db.execute(text("SELECT to_regclass('alert_zones') IS NOT NULL"))).scalar():
+        _table_ready = True
+    return _table_ready
+
+
+def cell_of(lat: float, lng: float) -> tuple[int, int]:
+    return (
+        int(math.floor(float(lng) / ALERT_ZONE_CELL_DEG)),
+        int(math.floor(float(lat) / ALERT_ZONE_CELL_DEG)),
+    )
+
+
+# -----------------------------------------------------------------------------
+# Écriture
+# -----------------------------------------------------------------------------
+_REFRESH_CELL = text("""
+    WITH pts AS (
+      SELECT created_at, (geom::geometry) AS g
+        FROM reports
+       WHERE kind::text = :kind
+         AND LOWER(TRIM(signal::text)) = 'cut'
+         AND created_at > NOW() - make_interval(hours => :hours)
+         AND (geom::geometry) && ST_MakeEnvelope(:x0, :y0, :x1, :y1, 4326)
+         AND ST_X(geom::geometry) >= :x0 AND ST_X(geom::geometry) < :x1
+         AND ST_Y(geom::geometry) >= :y0 AND ST_Y(geom::geometry) < :y1
+    ),
+    agg AS (
+      SELECT COUNT(*)::int AS n,
+             ST_Centroid(ST_Collect(g)) AS c,
+             MIN(created_at) AS oldest_at,
+             MAX(created_at) AS newest_at
+        FROM pts
+      HAVING COUNT(*) > 0
+    )
+    INSERT INTO alert_zones (kind, cell_x, cell_y, n, center, oldest_at, newest_at, acked, updated_at)
+    SELECT :kind, :cx, :cy, a.n, (a.c::geography), a.oldest_at, a.newest_at,
+           EXISTS (
+             SELECT 1
+               FROM acks ak
+              WHERE ak.kind::text = :kind
+                AND ST_DWithin(ak.geom, (a.c::geography), :ack_r)
+           ),
+           NOW()
+      FROM agg a
+    ON CONFLICT (kind, cell_x, cell_y) DO UPDATE
+       SET n          = EXCLUDED.n,
+           center     = EXCLUDED.center,
+           oldest_at  = EXCLUDED.oldest_at,
+           newest_at  = EXCLUDED.newest_at,
+           acked      = EXCLUDED.acked,
+           updated_at = NOW()
+    RETURNING n
+""")
+
+
+async def refresh_alert_zone_cell(db: AsyncSession, kind: str, cx: int, cy: int) -> int:
+    """Recalcule une cellule depuis les reports de la fenêtre (0 → ligne supprimée).
+    Ne commit pas : à la charge de l'appelant. Table absente → 0, rien fait."""
+    if not await alert_zones_ready(db):
+        return 0
+    x0 = cx * ALERT_ZONE_CELL_DEG
+    y0 = cy * ALERT_ZONE_CELL_DEG
+    res = await db.execute(_REFRESH_CELL, {
+        "kind": kind, "cx": cx, "cy": cy,
+        "hours": ALERT_ZONE_WINDOW_H,
+        "x0": x0, "y0": y0,
+        "x1": x0 + ALERT_ZONE_CELL_DEG, "y1": y0 + ALERT_ZONE_CELL_DEG,
+        "ack_r": float(ALERT_ZONE_CELL_M),
+    })
+    n = res.scalar_one_or_none()
+    if n is None:
+        await db.execute(
+            text("DELETE FROM alert_zones WHERE kind = :kind AND cell_x = :cx AND cell_y = :cy"),
+            {"kind": kind, "cx": cx, "cy": cy},
+        )
+        return 0
+    return int(n)
+
+
+async def refresh_alert_zone_at(db: AsyncSession, kind: str, lat: float, lng: float) -> int:
+    """Hook post-insert d'un report 'cut'."""
+    cx, cy = cell_of(lat, lng)
+    return await refresh_alert_zone_cell(db, kind, cx, cy)
+
+
+async def suppress_alert_zones_near(db: AsyncSession, kind: str, lat: float, lng: float) -> int:
+    """Hook post-insert d'un ack : marque les zones proches comme prises en charge."""
+    if not await alert_zones_ready(db):
+        return 0
+    res = await db.execute(text("""
+        UPDATE alert_zones
+           SET acked = true, updated_at = NOW()
+         WHERE kind = :kind
+           AND NOT acked
+           AND ST_DWithin(center, ST_SetSRID(ST_MakePoint(:lng,:lat),4326)::geography, :ack_r)
+    """), {"kind": kind, "lat": float(lat), "lng": float(lng), "ack_r": float(ALERT_ZONE_CELL_M)})
+    return res.rowcount or 0
+
+
+async def rebuild_alert_zones(db: AsyncSession) -> int:
+    """Reconstruction complète (set-based) depuis les reports de la fenêtre."""
+    await ensure_alert_zones_schema(db)
+    await db.execute(text("DELETE FROM alert_zones"))
+    res = await db.execute(text("""
+        INSERT INTO alert_zones (kind, cell_x, cell_y, n, center, oldest_at, newest_at, acked, updated_at)
+        SELECT p.kind, p.cx, p.cy,
+               COUNT(*)::int,
+               (ST_Centroid(ST_Collect(p.g))::geography),
+               MIN(p.created_at), MAX(p.created_at),
+               false, NOW()
+          FROM (
+            SELECT kind::text AS kind,
+                   FLOOR(ST_X(geom::geometry) / :cell)::int AS cx,
+                   FLOOR(ST_Y(geom::geometry) / :cell)::int AS cy,
+                   (geom::geometry) AS g,
+                   created_at
+              FROM reports
+             WHERE LOWER(TRIM(signal::text)) = 'cut'
+               AND created_at > NOW() - make_interval(hours => :hours)
+               AND kind::text = ANY(:kinds)
+          ) p
+         GROUP BY p.kind, p.cx, p.cy
+    """), {
+        "cell": ALERT_ZONE_CELL_DEG,
+        "hours": ALERT_ZONE_WINDOW_H,
+        "kinds": sorted(ALERT_ZONE_KINDS),
+    })
+    await db.execute(text("""
+        UPDATE alert_zones z
+           SET acked = true
+         WHERE EXISTS (
+           SELECT 1
+             FROM acks ak
+            WHERE ak.kind::text = z.kind
+              AND ST_DWithin(ak.geom, z.center, :ack_r)
+         )
+    """), {"ack_r": float(ALERT_ZONE_CELL_M)})
+    return res.rowcount or 0
+
+
+async def expire_alert_zones(db: AsyncSession) -> int:
+    """Ré-évalue les cellules dont le plus vieux report est sorti de la fenêtre."""
+    await ensure_alert_zones_schema(db)
+    rs = await db.execute(text("""
+        SELECT kind, cell_x, cell_y
+          FROM alert_zones
+         WHERE oldest_at <= NOW() - make_interval(hours => :hours)
+    """), {"hours": ALERT_ZONE_WINDOW_H})
+    cells = rs.fetchall()
+    for c in cells:
+        await refresh_alert_zone_cell(db, c.kind, int(c.cell_x), int(c.cell_y))
+    return len(cells)
+
+
+async def maintain_alert_zones(db: AsyncSession) -> None:
+    """Appelé par le scheduler : rebuild au premier passage du process, expiration ensuite."""
+    global _rebuilt
+    try:
+        if not _rebuilt:
+            n = await rebuild_alert_zones(db)
+            _rebuilt = True
+            if LOG_AGG:
+                print(f"[agg] alert_zones rebuilt -> {n}")
+        else:
+            n = await expire_alert_zones(db)
+            if LOG_AGG:
+                print(f"[agg] alert_zones expired cells -> {n}")
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        if LOG_AGG:
+            print(f"[agg] alert_zones error: {e}")
+
+
+# -----------------------------------------------------------------------------
+# Lecture
+# -----------------------------------------------------------------------------
+async def read_alert_zones(
+    db: AsyncSession,
+    kinds: Iterable[str],
+    lat: float,
+    lng: float,
+    radius_m: float,
+    min_count: Optional[int] = None,
+    limit: int = 50,
+) -> Optional[List[Dict[str, Any]]]:
+    """Zones non acquittées autour du point ; None si la table n'existe pas encore."""
+    if not await alert_zones_ready(db):
+        return None
+    rs = await db.execute(text("""
+        SELECT kind, n,
+               ST_Y(center::geometry) AS lat,
+               ST_X(center::geometry) AS lng
+          FROM alert_zones
+         WHERE kind = ANY(:kinds)
+           AND NOT acked
+           AND n >= :min_count
+           AND ST_DWithin(center, ST_SetSRID(ST_MakePoint(:lng,:lat),4326)::geography, :r)
+         ORDER BY n DESC, kind
+         LIMIT :lim
+    """), {
+        "kinds": sorted({(k or "").strip().lower() for k in kinds}),
+        "min_count": int(ALERT_ZONE_MIN_COUNT if min_count is None else min_count),
+        "lat": float(lat), "lng": float(lng), "r": float(radius_m),
+        "lim": int(limit),
+    })
+    return [
+        {"kind": r.kind, "count": int(r.n), "lat": float(r.lat), "lng": float(r.lng)}
+        for r in rs.fetchall()
+    ]
@@ -0,0 +1,241 @@
+# app/services/attachment_links.py
+"""
+Lien explicite report ↔ pièce jointe (attachments.report_id).
+
+- à l'upload : le contrôle de propriété renvoie le report correspondant,
+  stocké directement dans attachments.report_id (FK + index)
+- listings CTA : simple jointure sur report_id au lieu des sous-requêtes
+  spatio-temporelles corrélées (ST_DWithin + fenêtre de temps)
+- backfill : lie les lignes existantes par lots (scheduler + endpoint admin)
+
+Schéma créé par /admin/ensure_schema ou le scheduler uniquement (index sur
+reports/attachments en CONCURRENTLY, hors transaction) ; tant que la colonne
+report_id n'existe pas, l'upload ne lie pas et les listings n'ont pas de photo.
+"""
+import os
+from datetime import datetime
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.services.cta_queue import refresh_cta_media_all
+from app.services.ddl import create_indexes_concurrently, present_columns
+from app.services.recent_reports import OWNERSHIP_LINK_HOURS, RECENT_INDEX_ENABLED, recent_reports
+
+# -------- Parameters (override via env if needed) ----------
+LOG_AGG = os.getenv("LOG_AGG", "0") == "1"
+
+OWNERSHIP_LINK_RADIUS_M = int(os.getenv("OWNERSHIP_LINK_RADIUS_M", "150"))
+LINK_BACKFILL_BATCH     = int(os.getenv("LINK_BACKFILL_BATCH", "500"))
+
+_DDL = [
+    "ALTER TABLE attachments ADD COLUMN IF NOT EXISTS report_id uuid NULL REFERENCES reports(id) ON DELETE SET NULL",
+]
+
+# tables chaudes : sans verrou bloquant les INSERT, hors transaction
+_CONCURRENT_DDL = [
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_attachments_report ON attachments (report_id, created_at DESC) WHERE report_id IS NOT NULL",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_attachments_unlinked ON attachments (created_at) WHERE report_id IS NULL",
+    # contrôle de propriété : reports récents d'un utilisateur (kind/distance filtrés ensuite)
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_reports_user_recent ON reports (user_id, created_at DESC)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_reports_created_at ON reports (created_at DESC)",
+]
+
+_schema_ready = False
+_backfill_cursor: Optional[Tuple[datetime, str]] = None
+_backfill_done = False
+
+
+async def ensure_attachment_links_schema(db: AsyncSession) -> None:
+    """DDL + commit : /admin/ensure_schema et scheduler uniquement."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    for ddl in _DDL:
+        await db.execute(text(ddl))
+    await db.commit()
+    await create_indexes_concurrently(db, _CONCURRENT_DDL)
+    _schema_ready = True
+
+
+async def attachment_links_ready(db: AsyncSession) -> bool:
+    """attachments.report_id présente ? (upload / listings : ni DDL ni commit)."""
+    return "report_id" in await present_columns(db, "attachments", ("report_id",))
+
+
+# -----------------------------------------------------------------------------
+# Résolution à l'upload
+# -----------------------------------------------------------------------------
+async def resolve_owned_report(
+    db: AsyncSession,
+    *,
+    kind: str,
+    lat: float,
+    lng: float,
+    signals: Iterable[str],
+    user_id: Optional[str] = None,
+    report_id: Optional[str] = None,
+) -> Optional[str]:
+    """Report le plus récent de ce kind à ≤150 m / 48 h (de cet utilisateur si user_id).
+    Si report_id est fourni, on vérifie qu'il satisfait les mêmes conditions.
+    → id du report, ou None (= pas propriétaire).
+
+    Index mémoire d'abord (clé user_id/kind, distance en Python), confirmé par
+    la clé primaire ; sinon requête SQL sur idx_reports_user_recent."""
+    signals = sorted({s.lower() for s in signals})
+
+    if user_id and RECENT_INDEX_ENABLED:
+        rid = recent_reports.find(user_id, kind, lat, lng, OWNERSHIP_LINK_RADIUS_M, signals, report_id)
+        if rid is not None:
+            rs = await db.execute(text("SELECT 1 FROM reports WHERE id = CAST(:rid AS uuid)"), {"rid": rid})
+            if rs.first() is not None:
+                return rid
+            recent_reports.discard(rid)  # supprimé entre-temps
+
+    extra = ""
+    params: Dict[str, Any] = {
+        "k": kind,
+        "lat": float(lat),
+        "lng": float(lng),
+        "signals": signals,
+        "hours": OWNERSHIP_LINK_HOURS,
+        "r": OWNERSHIP_LINK_RADIUS_M,
+    }
+    if user_id:
+        extra += " AND user_id = CAST(:uid AS uuid)"
+        params["uid"] = str(user_id)
+    if report_id:
+        extra += " AND id = CAST(:rid AS uuid)"
+        params["rid"] = str(report_id)
+    rs = await db.execute(text(f"""
+        WITH me AS (
+            SELECT ST_SetSRID(ST_MakePoint(:lng,:lat),4326)::geography AS g
+        )
+        SELECT id,
+               LOWER(TRIM(signal::text))                AS signal,
+               ST_Y(geom::geometry)                     AS lat,
+               ST_X(geom::geometry)                     AS lng,
+               EXTRACT(EPOCH FROM created_at)::float8   AS ts
+          FROM reports
+         WHERE created_at > NOW() - make_interval(hours => :hours)
+           {extra}
+           AND LOWER(TRIM(kind::text)) = :k
+           AND LOWER(TRIM(signal::text)) = ANY(:signals)
+           AND ST_DWithin(geom::geography, (SELECT g FROM me), :r)
+         ORDER BY created_at DESC
+         LIMIT 1
+    """), params)
+    row = rs.first()
+    if row is None:
+        return None
+    if user_id and RECENT_INDEX_ENABLED:
+        # réchauffe l'index (autre instance / redémarrage) pour les uploads suivants
+        recent_reports.add(user_id, kind, row.signal, row.lat, row.lng, row.id, row.ts)
+    return str(row.id)
+
+
+# -----------------------------------------------------------------------------
+# Backfill
+# -----------------------------------------------------------------------------
+_BACKFILL_SQL = text("""
+    WITH batch AS (
+      SELECT a.id, a.kind, a.geom, a.user_id, a.created_at
+        FROM attachments a
+       WHERE a.report_id IS NULL
+         AND (
+           CAST(:after_ts AS timestamptz) IS NULL
+           OR a.created_at > CAST(:after_ts AS timestamptz)
+           OR (a.created_at = CAST(:after_ts AS timestamptz) AND a.id::text > :after_id)
+         )
+       ORDER BY a.created_at, a.id::text
+       LIMIT :batch
+    ),
+    matched AS (
+      SELECT b.id AS attachment_id, m.id AS report_id
+        FROM batch b
+        CROSS JOIN LATERAL (
+          SELECT r.id
+            FROM reports r
+           WHERE LOWER(TRIM(r.kind::text)) = LOWER(TRIM(b.kind::text))
+             AND LOWER(TRIM(r.signal::text)) IN ('cut','to_clean')
+             AND r.created_at BETWEEN b.created_at - make_interval(hours => :hours)
+                                  AND b.created_at + INTERVAL '90 seconds'
+             AND ST_DWithin(r.geom::geography, b.geom::geography, :r)
+           ORDER BY (r.user_id IS NOT DISTINCT FROM b.user_id) DESC,
+                    ABS(EXTRACT(EPOCH FROM (r.created_at - b.created_at))) ASC
+           LIMIT 1
+        ) m
+    ),
+    upd AS (
+      UPDATE attachments a
+         SET report_id = matched.report_id
+        FROM matched
+       WHERE a.id = matched.attachment_id
+      RETURNING a.id
+    ),
+    last AS (
+      SELECT created_at, id::text AS id
+        FROM batch
+       ORDER BY created_at DESC, id::text DESC
+       LIMIT 1
+    )
+    SELECT (SELECT COUNT(*) FROM upd)::int   AS linked,
+           (SELECT COUNT(*) FROM batch)::int AS scanned,
+           (SELECT created_at FROM last)     AS last_ts,
+           (SELECT id FROM last)             AS last_id
+""")
+
+
+async def backfill_attachment_links_batch(
+    db: AsyncSession,
+    after: Optional[Tuple[datetime, str]] = None,
+    batch: int = LINK_BACKFILL_BATCH,
+) -> Tuple[int, int, Optional[Tuple[datetime, str]]]:
+    """Un lot (keyset sur created_at,id) → (liés, parcourus, curseur suivant)."""
+    await ensure_attachment_links_schema(db)
+    rs = await db.execute(_BACKFILL_SQL, {
+        "after_ts": after[0] if after else None,
+        "after_id": after[1] if after else "",
+        "batch": int(batch),
+        "hours": OWNERSHIP_LINK_HOURS,
+        "r": OWNERSHIP_LINK_RADIUS_M,
+    })
+    row = rs.first()
+    if row and row.linked:
+        await refresh_cta_media_all(db)
+    await db.commit()
+    cursor = (row.last_ts, row.last_id) if row and row.last_ts is not None else None
+    return int(row.linked or 0), int(row.scanned or 0), cursor
+
+
+async def backfill_attachment_links(db: AsyncSession, batch: int = LINK_BACKFILL_BATCH, max_batches: int = 0) -> Dict[str, int]:
+    """Passe complète (ou max_batches lots) sur les pièces jointes non liées."""
+    linked = scanned = batches = 0
+    cursor = None
+    while True:
+        n_linked, n_scanned, cursor = await backfill_attachment_links_batch(db, cursor, batch)
+        linked += n_linked
+        scanned += n_scanned
+        batches += 1
+        if n_scanned < batch or cursor is None or (max_batches and batches >= max_batches):
+            break
+    return {"linked": linked, "scanned": scanned, "batches": batches}
+
+
+async def maintain_attachment_links(db: AsyncSession) -> None:
+    """Appelé par le scheduler : un lot par passage jusqu'à la fin du backfill."""
+    global _backfill_cursor, _backfill_done
+    if _backfill_done:
+        return
+    try:
+        n_linked, n_scanned, cursor = await backfill_attachment_links_batch(db, _backfill_cursor)
+        _backfill_cursor = cursor
+        if n_scanned < LINK_BACKFILL_BATCH or cursor is None:
+            _backfill_done = True
+        if LOG_AGG:
+            print(f"[agg] attachment links backfill -> linked={n_linked} scanned={n_scanned}")
+    except Exception as e:
+        await db.rollback()
+        if LOG_AGG:
+            print(f"[agg] attachment links backfill error: {e}")
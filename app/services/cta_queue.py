@@ -0,0 +1,432 @@
+# app/services/cta_queue.py
+"""
+File de travail CTA matérialisée.
+
+Au lieu de trois sous-requêtes corrélées par ligne à chaque lecture (dernier
+média, nombre de pièces jointes, reports proches sans borne de temps), on
+maintient une ligne par report 'to_clean' ouvert dans `cta_queue` :
+  - insertion à chaque report 'to_clean' (+1 sur les voisins déjà en file)
+  - média / compteur de pièces jointes rafraîchis à chaque pièce jointe
+    insérée, liée ou dont les variantes arrivent
+  - status recopié à chaque /cta/mark_status ; un report résolu reste
+    visible CTA_QUEUE_RESOLVED_KEEP_H puis sort de la file
+  - fenêtre glissante CTA_QUEUE_WINDOW_H ; les suppressions de reports
+    suivent par la clé étrangère (ON DELETE CASCADE)
+  - reports_count = reports du même kind à moins de CTA_NEARBY_M dans la
+    file (borné par la fenêtre, plus par tout l'historique), recalculé par
+    le scheduler pour absorber suppressions et écritures concurrentes
+La lecture devient un top-N indexé (status, created_at DESC) ; l'âge est
+calculé à la lecture.
+
+Schéma et remplissage initial uniquement depuis /admin/ensure_schema, le
+scheduler ou /admin/cta_queue/rebuild ; tant que la table n'existe pas, les
+hooks d'écriture ne font rien (le rebuild du scheduler rattrape) et la
+lecture renvoie une liste vide.
+
+Gravité (ex-severityScore des dashboards, désormais côté serveur) :
+  - composante stockée `base_score` (colonne générée : poids du kind, photo,
+    reports proches, pièces jointes), indexée avec created_at
+  - bonus de fraîcheur évalué à la requête, par paliers d'âge
+  - order=severity : un top-N par palier (bonus constant dans le palier →
+    ordre = base_score, parcours d'index), fusionnés puis tronqués à N
+"""
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.services.resolution import ensure_resolution_schema
+
+# -------- Parameters (override via env if needed) ----------
+LOG_AGG = os.getenv("LOG_AGG", "0") == "1"
+
+CTA_QUEUE_WINDOW_H        = int(os.getenv("CTA_QUEUE_WINDOW_H", "720"))
+CTA_QUEUE_RESOLVED_KEEP_H = int(os.getenv("CTA_QUEUE_RESOLVED_KEEP_H", "168"))
+CTA_NEARBY_M              = float(os.getenv("CTA_NEARBY_M", "50"))
+
+# poids par kind (alias : anciens et nouveaux noms RATP)
+SEVERITY_KIND_WEIGHTS = {
+    "blood": 30, "syringe": 30,
+    "feces": 22, "excrement": 22,
+    "broken_glass": 18, "glass": 18,
+    "vomit": 14,
+    "urine": 10,
+}
+SEVERITY_DEFAULT_WEIGHT = 8
+# (âge max en minutes entières, bonus) ; au-delà du dernier palier : 0
+SEVERITY_AGE_BONUS = ((5, 25), (15, 18), (60, 8), (180, 3))
+
+
+def _base_score_sql() -> str:
+    weights = " ".join(f"WHEN '{k}' THEN {w}" for k, w in SEVERITY_KIND_WEIGHTS.items())
+    return f"""(
+        CASE LOWER(kind) {weights} ELSE {SEVERITY_DEFAULT_WEIGHT} END
+        + CASE WHEN COALESCE(photo_url, '') <> '' THEN 10 ELSE 0 END
+        + LEAST(20, reports_count * 4)
+        + LEAST(12, attachments_count * 3)
+    )::smallint"""
+
+
+def _age_bonus_sql() -> str:
+    # âge en minutes entières ≤ m  ⇔  created_at > NOW() - (m + 1) minutes
+    whens = " ".join(
+        f"WHEN created_at > NOW() - INTERVAL '{m + 1} minutes' THEN {b}" for m, b in SEVERITY_AGE_BONUS
+    )
+    return f"CASE {whens} ELSE 0 END"
+
+
+_DDL = [
+    "ALTER TABLE reports ADD COLUMN IF NOT EXISTS status text",
+    """
+    CREATE TABLE IF NOT EXISTS cta_queue (
+      report_id         uuid        PRIMARY KEY REFERENCES reports(id) ON DELETE CASCADE,
+      kind              text        NOT NULL,
+      signal            text        NOT NULL,
+      status            text        NOT NULL DEFAULT 'new',
+      lat               double precision NOT NULL,
+      lng               double precision NOT NULL,
+      geom              geography(Point,4326) NOT NULL,
+      created_at        timestamptz NOT NULL,
+      phone             text        NULL,
+      photo_url         text        NULL,
+      thumb_url         text        NULL,
+      attachments_count integer     NOT NULL DEFAULT 0,
+      reports_count     integer     NOT NULL DEFAULT 1,
+      resolved_at       timestamptz NULL,
+      updated_at        timestamptz NOT NULL DEFAULT NOW()
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_cta_queue_created ON cta_queue (created_at DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_cta_queue_status_created ON cta_queue (status, created_at DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_cta_queue_geom ON cta_queue USING GIST (geom)",
+    # colonne générée : recalculée par PostgreSQL à chaque écriture de la ligne
+    # (poids modifiés → DROP COLUMN base_score, elle sera recréée)
+    f"ALTER TABLE cta_queue ADD COLUMN IF NOT EXISTS base_score smallint GENERATED ALWAYS AS ({_base_score_sql()}) STORED",
+    "CREATE INDEX IF NOT EXISTS idx_cta_queue_score ON cta_queue (base_score DESC, created_at DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_cta_queue_status_score ON cta_queue (status, base_score DESC, created_at DESC)",
+]
+
+_schema_ready = False
+_table_ready = False  # sonde hooks/lecture, distincte : ne court-circuite pas le DDL
+_rebuilt = False
+
+
+async def ensure_cta_queue_schema(db: AsyncSession) -> None:
+    """DDL + commit : /admin/ensure_schema, scheduler, rebuild admin uniquement."""
+    global _schema_ready, _table_ready
+    if _schema_ready:
+        return
+    # imports tardifs : ces modules importent eux-mêmes la file (hooks)
+    from app.services.attachment_links import ensure_attachment_links_schema
+    from app.services.media import ensure_media_schema
+
+    await ensure_resolution_schema(db)        # report_status_events (date de résolution)
+    await ensure_attachment_links_schema(db)  # attachments.report_id + index (report_id, created_at)
+    await ensure_media_schema(db)             # attachments.thumb_url
+    for ddl in _DDL:
+        await db.execute(text(ddl))
+    await db.commit()
+    _schema_ready = _table_ready = True
+
+
+async def cta_queue_ready(db: AsyncSession) -> bool:
+    """Table présente ? (hooks / lecture : ni DDL ni commit). Le DDL est validé
+    d'un bloc : table présente ⇒ colonnes et index aussi."""
+    global _table_ready
+    if not _table_ready and (await db.execute(text("SELECT to_regclass('cta_queue') IS NOT NULL"))).scalar():
+        _table_ready = True
+    return _table_ready
+
+
+async def fill_cta_queue_if_empty(db: AsyncSession) -> int:
+    """/admin/ensure_schema : remplissage immédiat d'une table neuve (premier
+    déploiement, scheduler désactivé). Commit."""
+    await ensure_cta_queue_schema(db)
+    if (await db.execute(text("SELECT EXISTS (SELECT 1 FROM cta_queue)"))).scalar():
+        return 0
+    n = await rebuild_cta_queue(db)
+    await db.commit()
+    print(f"[cta_queue] initial fill -> {n}")
+    return n
+
+
+# -----------------------------------------------------------------------------
+# Écriture
+# -----------------------------------------------------------------------------
+def _fill_sql(where: str) -> str:
+    # une ligne par report 'to_clean' de la fenêtre ; média calculé une fois ici
+    return f"""
+        INSERT INTO cta_queue (
+          report_id, kind, signal, status, lat, lng, geom, created_at, phone,
+          photo_url, thumb_url, attachments_count, resolved_at, updated_at
+        )
+        SELECT r.id,
+               r.kind::text,
+               r.signal::text,
+               COALESCE(r.status, 'new'),
+               ST_Y(r.geom::geometry),
+               ST_X(r.geom::geometry),
+               r.geom::geography,
+               r.created_at,
+               r.phone,
+               media.url,
+               media.thumb_url,
+               COALESCE(media.cnt, 0),
+               res.at,
+               NOW()
+          FROM reports r
+          LEFT JOIN LATERAL (
+              SELECT (ARRAY_AGG(a.url       ORDER BY a.created_at DESC))[1] AS url,
+                     (ARRAY_AGG(a.thumb_url ORDER BY a.created_at DESC))[1] AS thumb_url,
+                     COUNT(*)::int AS cnt
+                FROM attachments a
+               WHERE a.report_id = r.id
+          ) media ON true
+          LEFT JOIN LATERAL (
+              SELECT MAX(e.at) AS at
+                FROM report_status_events e
+               WHERE e.report_id = r.id AND e.to_status = 'resolved'
+          ) res ON COALESCE(r.status, 'new') = 'resolved'
+         WHERE LOWER(TRIM(r.signal::text)) = 'to_clean'
+           AND r.created_at > NOW() - make_interval(hours => :window)
+           AND (COALESCE(r.status, 'new') <> 'resolved'
+                OR res.at > NOW() - make_interval(hours => :keep))
+           {where}
+        ON CONFLICT (report_id) DO NOTHING
+    """
+
+
+_PARAMS = {"window": CTA_QUEUE_WINDOW_H, "keep": CTA_QUEUE_RESOLVED_KEEP_H}
+
+_BUMP_NEIGHBOURS = text("""
+    WITH me AS (
+      SELECT report_id, kind, geom FROM cta_queue WHERE report_id = CAST(:id AS uuid)
+    ),
+    nb AS (
+      UPDATE cta_queue q
+         SET reports_count = q.reports_count + 1,
+             updated_at    = NOW()
+        FROM me
+       WHERE q.kind = me.kind
+         AND q.report_id <> me.report_id
+         AND ST_DWithin(q.geom, me.geom, :r)
+      RETURNING q.report_id
+    )
+    UPDATE cta_queue
+       SET reports_count = 1 + (SELECT COUNT(*) FROM nb)
+     WHERE report_id = CAST(:id AS uuid)
+""")
+
+_REFRESH_MEDIA = """
+    UPDATE cta_queue q
+       SET photo_url         = media.url,
+           thumb_url         = media.thumb_url,
+           attachments_count = COALESCE(media.cnt, 0),
+           updated_at        = NOW()
+      FROM (
+        SELECT a.report_id,
+               (ARRAY_AGG(a.url       ORDER BY a.created_at DESC))[1] AS url,
+               (ARRAY_AGG(a.thumb_url ORDER BY a.created_at DESC))[1] AS thumb_url,
+               COUNT(*)::int AS cnt
+          FROM attachments a
+         WHERE {where}
+         GROUP BY a.report_id
+      ) media
+     WHERE q.report_id = media.report_id
+"""
+
+
+async def add_report_to_cta_queue(db: AsyncSession, report_id: str) -> bool:
+    """Hook après insertion d'un report 'to_clean'. Ne commit pas."""
+    if not await cta_queue_ready(db):
+        return False
+    res = await db.execute(text(_fill_sql("AND r.id = CAST(:id AS uuid)")), {**_PARAMS, "id": str(report_id)})
+    if not res.rowcount:
+        return False
+    await db.execute(_BUMP_NEIGHBOURS, {"id": str(report_id), "r": CTA_NEARBY_M})
+    return True
+
+
+async def refresh_cta_media(db: AsyncSession, report_id: Optional[str]) -> None:
+    """Hook après insertion / liaison d'une pièce jointe. Ne commit pas."""
+    if not report_id:
+        return
+    if not await cta_queue_ready(db):
+        return
+    await db.execute(text(_REFRESH_MEDIA.format(where="a.report_id = CAST(:id AS uuid)")), {"id": str(report_id)})
+
+
+async def refresh_cta_media_for_attachment(db: AsyncSession, attachment_id: str) -> None:
+    """Hook après mise à jour d'une pièce jointe (variantes). Ne commit pas."""
+    if not await cta_queue_ready(db):
+        return
+    await db.execute(text(_REFRESH_MEDIA.format(
+        where="a.report_id = (SELECT report_id FROM attachments WHERE id = :aid)",
+    )), {"aid": str(attachment_id)})
+
+
+async def refresh_cta_media_all(db: AsyncSession) -> int:
+    """Après un backfill des liens report ↔ pièces jointes. Ne commit pas."""
+    if not await cta_queue_ready(db):
+        return 0
+    res = await db.execute(text(_REFRESH_MEDIA.format(
+        where="a.report_id IN (SELECT report_id FROM cta_queue)",
+    )))
+    return res.rowcount or 0
+
+
+async def set_cta_status(db: AsyncSession, report_id: str, status: str) -> None:
+    """Hook de /cta/mark_status (même transaction). Ne commit pas."""
+    if not await cta_queue_ready(db):
+        return
+    res = await db.execute(text("""
+        UPDATE cta_queue
+           SET status      = :s,
+               resolved_at = CASE WHEN :s = 'resolved' THEN COALESCE(resolved_at, NOW()) END,
+               updated_at  = NOW()
+         WHERE report_id = CAST(:id AS uuid)
+    """), {"s": status, "id": str(report_id)})
+    # réouverture d'un report sorti de la file (résolu depuis longtemps)
+    if not res.rowcount and status != "resolved":
+        await add_report_to_cta_queue(db, report_id)
+
+
+# -----------------------------------------------------------------------------
+# Maintenance
+# -----------------------------------------------------------------------------
+_RECOUNT = text("""
+    UPDATE cta_queue q
+       SET reports_count = c.n,
+           updated_at    = NOW()
+      FROM (
+        SELECT a.report_id, COUNT(*)::int AS n
+          FROM cta_queue a
+          JOIN cta_queue b
+            ON b.kind = a.kind
+           AND ST_DWithin(a.geom, b.geom, :r)
+         GROUP BY a.report_id
+      ) c
+     WHERE q.report_id = c.report_id
+       AND q.reports_count <> c.n
+""")
+
+
+async def rebuild_cta_queue(db: AsyncSession) -> int:
+    """Reconstruction complète (set-based) depuis les reports de la fenêtre."""
+    await ensure_cta_queue_schema(db)
+    await db.execute(text("DELETE FROM cta_queue"))
+    res = await db.execute(text(_fill_sql("")), _PARAMS)
+    await db.execute(_RECOUNT, {"r": CTA_NEARBY_M})
+    return res.rowcount or 0
+
+
+async def expire_cta_queue(db: AsyncSession) -> Dict[str, int]:
+    """Sortie de fenêtre, résolus anciens, reports manqués, compteurs de voisinage."""
+    await ensure_cta_queue_schema(db)
+    gone = await db.execute(text("""
+        DELETE FROM cta_queue
+         WHERE created_at <= NOW() - make_interval(hours => :window)
+            OR (status = 'resolved' AND resolved_at <= NOW() - make_interval(hours => :keep))
+    """), _PARAMS)
+    # filet de sécurité : report inséré par un chemin sans hook (ou hook en échec)
+    added = await db.execute(text(_fill_sql("""
+           AND r.created_at > NOW() - INTERVAL '1 day'
+           AND NOT EXISTS (SELECT 1 FROM cta_queue q WHERE q.report_id = r.id)
+    """)), _PARAMS)
+    recount = await db.execute(_RECOUNT, {"r": CTA_NEARBY_M})
+    return {"expired": gone.rowcount or 0, "added": added.rowcount or 0, "recounted": recount.rowcount or 0}
+
+
+async def maintain_cta_queue(db: AsyncSession) -> None:
+    """Appelé par le scheduler : rebuild au premier passage du process, expiration ensuite."""
+    global _rebuilt
+    try:
+        if not _rebuilt:
+            n = await rebuild_cta_queue(db)
+            _rebuilt = True
+            if LOG_AGG:
+                print(f"[agg] cta_queue rebuilt -> {n}")
+        else:
+            st = await expire_cta_queue(db)
+            if LOG_AGG:
+                print(f"[agg] cta_queue -> {st}")
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        if LOG_AGG:
+            print(f"[agg] cta_queue error: {e}")
+
+
+# -----------------------------------------------------------------------------
+# Lecture
+# -----------------------------------------------------------------------------
+_COLUMNS = """
+    report_id AS id, kind, signal, lat, lng, created_at, status, phone,
+    photo_url, thumb_url, attachments_count, reports_count,
+    EXTRACT(EPOCH FROM (NOW() - created_at))::int / 60 AS age_min
+"""
+
+
+def _severity_tiers() -> List[Tuple[int, Optional[int], int]]:
+    """Paliers d'âge [lo, hi) en minutes (hi None = sans borne) et leur bonus."""
+    tiers: List[Tuple[int, Optional[int], int]] = []
+    lo = 0
+    for m, b in SEVERITY_AGE_BONUS:
+        tiers.append((lo, m + 1, b))
+        lo = m + 1
+    tiers.append((lo, None, 0))
+    return tiers
+
+
+async def read_cta_queue(
+    db: AsyncSession, status: str = "", limit: int = 20, order: str = "recent",
+) -> List[Dict[str, Any]]:
+    """Top-N par date de création (index (status, created_at DESC)) ou par
+    gravité (order="severity", un parcours d'index (status, base_score) par palier)."""
+    if not await cta_queue_ready(db):
+        return []
+    params: Dict[str, Any] = {"lim": int(limit)}
+    cond = ["status = :status"] if status else []
+    if status:
+        params["status"] = status
+
+    if order != "severity":
+        where = f"WHERE {' AND '.join(cond)}" if cond else ""
+        sql = f"""
+            SELECT {_COLUMNS},
+                   LEAST(100, base_score + {_age_bonus_sql()}) AS severity
+              FROM cta_queue
+              {where}
+             ORDER BY created_at DESC
+             LIMIT :lim
+        """
+    else:
+        # bonus constant dans un palier : son top-N est le top-N par base_score
+        parts = []
+        for lo, hi, bonus in _severity_tiers():
+            tw = list(cond)
+            if lo:
+                tw.append(f"created_at <= NOW() - INTERVAL '{lo} minutes'")
+            if hi is not None:
+                tw.append(f"created_at > NOW() - INTERVAL '{hi} minutes'")
+            parts.append(f"""
+              (SELECT {_COLUMNS}, base_score, {bonus} AS bonus
+                 FROM cta_queue
+                WHERE {' AND '.join(tw)}
+                ORDER BY base_score DESC, created_at DESC
+                LIMIT :lim)""")
+        sql = f"""
+            SELECT t.*, LEAST(100, t.base_score + t.bonus) AS severity
+              FROM ({" UNION ALL ".join(parts)}) t
+             ORDER BY severity DESC, t.created_at DESC
+             LIMIT :lim
+        """
+    rs = await db.execute(text(sql), params)
+    out = []
+    for r in rs.mappings().all():
+        d = dict(r)
+        d.pop("base_score", None)
+        d.pop("bonus", None)
+        out.append(d)
+    return out
@@ -0,0 +1,46 @@
+# app/services/ddl.py
+"""
+Outils de schéma partagés par les `ensure_*_schema` et les chemins de requête.
+
+- index sur les tables chaudes (reports, attachments) : CREATE INDEX
+  CONCURRENTLY sur une connexion dédiée en autocommit, depuis
+  /admin/ensure_schema ou le scheduler uniquement
+- chemins de requête (upload, listings, hooks) : sondes de présence sans DDL
+  ni commit ; une colonne pas encore créée est simplement ignorée
+"""
+from typing import Dict, Iterable, Set
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# colonnes vues par ce process (une colonne créée ne disparaît pas : cache positif)
+_seen_columns: Dict[str, Set[str]] = {}
+
+
+async def create_indexes_concurrently(db: AsyncSession, ddls: Iterable[str]) -> None:
+    """CREATE INDEX CONCURRENTLY sur une connexion dédiée en autocommit
+    (interdit dans une transaction) ; la session `db` n'est pas touchée.
+    Un build interrompu laisse un index INVALID → DROP INDEX puis relancer."""
+    async with db.bind.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        for ddl in ddls:
+            await conn.execute(text(ddl))
+
+
+async def present_columns(db: AsyncSession, table: str, columns: Iterable[str]) -> Set[str]:
+    """Colonnes de `columns` présentes dans `table` (catalogue, ni DDL ni commit).
+    Relu tant qu'il en manque, puis servi depuis le cache du process."""
+    wanted = set(columns)
+    known = _seen_columns.setdefault(table, set())
+    missing = wanted - known
+    if missing:
+        rs = await db.execute(text("""
+            SELECT attname
+              FROM pg_attribute
+             WHERE attrelid = to_regclass(:t)
+               AND attname = ANY(:c)
+               AND attnum > 0
+               AND NOT attisdropped
+        """), {"t": table, "c": sorted(missing)})
+        known.update(r[0] for r in rs)
+    return wanted & known
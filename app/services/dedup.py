@@ -0,0 +1,86 @@
+# app/services/dedup.py
+"""
+Déduplication des pièces jointes par contenu (SHA-256).
+
+Le hash est calculé sur le fichier déjà spoolé localement (pas de réseau) avant
+l'envoi au stockage. Si un blob identique existe déjà, le nouvel upload devient
+une simple insertion de métadonnées qui réutilise son URL (et ses variantes) :
+plusieurs lignes `attachments` référencent alors le même objet stocké.
+Un blob dont la dernière ligne arrive en fin de rétention n'est plus réutilisé
+(la purge pourrait le supprimer pendant l'upload).
+
+Colonne et index créés par /admin/ensure_schema uniquement ; tant que
+content_sha256 n'existe pas, pas de recherche (chaque upload est stocké).
+"""
+import os
+from typing import Any, Dict, Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.services.ddl import create_indexes_concurrently, present_columns
+from app.services.media import ensure_media_schema
+from app.services.retention import RETENTION_DAYS
+
+# -------- Parameters (override via env if needed) ----------
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "1") != "0"
+
+_DDL = [
+    "ALTER TABLE attachments ADD COLUMN IF NOT EXISTS content_sha256 text NULL",
+]
+
+# table chaude (uploads) : sans verrou bloquant les INSERT, hors transaction
+_CONCURRENT_DDL = [
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_attachments_content_sha256 ON attachments (content_sha256) WHERE content_sha256 IS NOT NULL",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_attachments_url ON attachments (url)",
+]
+
+# colonnes lues par find_blob (media : variantes)
+_LOOKUP_COLUMNS = ("content_sha256", "thumb_url", "medium_url", "original_url")
+
+_schema_ready = False
+_stats = {"lookups": 0, "hits": 0, "bytes_saved": 0}
+
+
+async def ensure_dedup_schema(db: AsyncSession) -> None:
+    """DDL + commit : /admin/ensure_schema uniquement."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    await ensure_media_schema(db)
+    for ddl in _DDL:
+        await db.execute(text(ddl))
+    await db.commit()
+    await create_indexes_concurrently(db, _CONCURRENT_DDL)
+    _schema_ready = True
+
+
+async def dedup_ready(db: AsyncSession) -> bool:
+    """Colonnes de la recherche présentes ? (chemin d'upload : ni DDL ni commit)."""
+    return len(await present_columns(db, "attachments", _LOOKUP_COLUMNS)) == len(_LOOKUP_COLUMNS)
+
+
+async def find_blob(db: AsyncSession, sha256: Optional[str], size: int = 0) -> Optional[Dict[str, Any]]:
+    """Ligne existante au même contenu → {url, thumb_url, medium_url, original_url}, sinon None."""
+    if not (DEDUP_ENABLED and sha256) or not await dedup_ready(db):
+        return None
+    _stats["lookups"] += 1
+    rs = await db.execute(text("""
+        SELECT url, thumb_url, medium_url, original_url
+          FROM attachments
+         WHERE content_sha256 = :h
+           AND url IS NOT NULL
+           AND created_at > NOW() - make_interval(days => :keep)
+         ORDER BY created_at DESC
+         LIMIT 1
+    """), {"h": sha256, "keep": max(1, RETENTION_DAYS - 1)})
+    row = rs.mappings().first()
+    if row is None:
+        return None
+    _stats["hits"] += 1
+    _stats["bytes_saved"] += int(size or 0)
+    return dict(row)
+
+
+def dedup_stats() -> Dict[str, Any]:
+    return {**_stats, "enabled": DEDUP_ENABLED}
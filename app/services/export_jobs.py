@@ -0,0 +1,338 @@
+# app/services/export_jobs.py
+"""
+Exports en tâche de fond (gros intervalles de dates).
+
+- POST   /admin/export_jobs                → soumet les filtres, renvoie un job id
+- GET    /admin/export_jobs/{id}           → statut + progression (lignes, octets)
+- GET    /admin/export_jobs/{id}/download  → fichier terminé (gzip), Range supporté
+- DELETE /admin/export_jobs/{id}           → annule / supprime
+
+Les jobs tournent dans la boucle d'événements, au plus EXPORT_JOBS_CONCURRENCY
+à la fois, sur le pool de connexions dédié aux exports. Le fichier est écrit
+en .tmp puis renommé à la fin ; l'état est un petit JSON à côté (comme les
+uploads reprenables), pour que les fichiers terminés survivent à un redémarrage.
+"""
+import asyncio
+import gzip
+import json
+import os
+import re
+import tempfile
+import time
+import uuid
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response, StreamingResponse
+
+# -------- Parameters (override via env if needed) ----------
+EXPORT_JOBS_DIR         = os.getenv("EXPORT_JOBS_DIR") or os.path.join(tempfile.gettempdir(), "ayii-exports")
+EXPORT_JOBS_CONCURRENCY = int(os.getenv("EXPORT_JOBS_CONCURRENCY", "2"))
+EXPORT_JOBS_MAX_PENDING = int(os.getenv("EXPORT_JOBS_MAX_PENDING", "20"))
+EXPORT_JOBS_TTL_H       = int(os.getenv("EXPORT_JOBS_TTL_H", "24"))
+EXPORT_GZIP_LEVEL       = int(os.getenv("EXPORT_GZIP_LEVEL", "6"))
+
+_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+_READ_BLOCK = 256 * 1024
+
+MakeBody = Callable[[Callable[[int], None]], AsyncIterator[bytes]]
+
+_jobs: Dict[str, Dict[str, Any]] = {}
+_tasks: Dict[str, asyncio.Task] = {}
+_sem = asyncio.Semaphore(max(1, EXPORT_JOBS_CONCURRENCY))
+_last_purge = 0.0
+
+
+def _meta_path(job_id: str) -> str:
+    return os.path.join(EXPORT_JOBS_DIR, f"{job_id}.json")
+
+
+def _data_path(job_id: str) -> str:
+    return os.path.join(EXPORT_JOBS_DIR, f"{job_id}.data")
+
+
+def _write_meta(meta: Dict[str, Any]) -> None:
+    os.makedirs(EXPORT_JOBS_DIR, exist_ok=True)
+    tmp = _meta_path(meta["id"]) + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp, _meta_path(meta["id"]))
+
+
+def _read_meta(job_id: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(_meta_path(job_id)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _remove_files(job_id: str) -> None:
+    for p in (_meta_path(job_id), _data_path(job_id), _data_path(job_id) + ".tmp"):
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+
+def _purge_expired_sync(max_age_s: float) -> int:
+    if not os.path.isdir(EXPORT_JOBS_DIR):
+        return 0
+    now = time.time()
+    n = 0
+    for name in os.listdir(EXPORT_JOBS_DIR):
+        if not name.endswith(".json"):
+            continue
+        job_id = name[:-5]
+        if job_id in _tasks:
+            continue
+        meta = _read_meta(job_id)
+        if meta is None or now - float(meta.get("updated_at", 0)) > max_age_s:
+            _remove_files(job_id)
+            _jobs.pop(job_id, None)
+            n += 1
+    return n
+
+
+async def purge_expired_jobs(force: bool = False) -> int:
+    """Supprime les exports expirés (au plus une passe toutes les 10 min)."""
+    global _last_purge
+    now = time.time()
+    if not force and now - _last_purge < 600:
+        return 0
+    _last_purge = now
+    return await run_in_threadpool(_purge_expired_sync, EXPORT_JOBS_TTL_H * 3600.0)
+
+
+# -----------------------------------------------------------------------------
+# Soumission / exécution
+# -----------------------------------------------------------------------------
+async def submit_job(
+    *,
+    subject: str,
+    fmt: str,
+    filters: Dict[str, Any],
+    filename: str,
+    make_body: MakeBody,
+    estimate: Optional[Callable[[], Awaitable[int]]] = None,
+    compress: bool = True,
+) -> Dict[str, Any]:
+    await purge_expired_jobs()
+    if len(_tasks) >= EXPORT_JOBS_MAX_PENDING:
+        raise HTTPException(status_code=429, detail="too many export jobs pending")
+    now = time.time()
+    meta = {
+        "id": uuid.uuid4().hex,
+        "subject": subject,
+        "format": fmt,
+        "filters": filters,
+        "filename": filename + (".gz" if compress else ""),
+        "compressed": compress,
+        "status": "queued",
+        "rows_total": None,
+        "rows_done": 0,
+        "bytes_raw": 0,
+        "size": None,
+        "error": None,
+        "created_at": now,
+        "started_at": None,
+        "finished_at": None,
+        "updated_at": now,
+    }
+    _jobs[meta["id"]] = meta
+    await run_in_threadpool(_write_meta, meta)
+    task = asyncio.get_running_loop().create_task(_run(meta, make_body, estimate))
+    _tasks[meta["id"]] = task
+    return meta
+
+
+def _open_output(path: str, compress: bool):
+    os.makedirs(EXPORT_JOBS_DIR, exist_ok=True)
+    if compress:
+        return gzip.open(path, "wb", compresslevel=EXPORT_GZIP_LEVEL)
+    return open(path, "wb")
+
+
+async def _run(meta: Dict[str, Any], make_body: MakeBody, estimate) -> None:
+    job_id = meta["id"]
+    tmp = _data_path(job_id) + ".tmp"
+    fp = None
+
+    def _progress(n: int) -> None:
+        meta["rows_done"] += n
+
+    try:
+        async with _sem:
+            meta.update({"status": "running", "started_at": time.time(), "updated_at": time.time()})
+            await run_in_threadpool(_write_meta, meta)
+            if estimate is not None:
+                try:
+                    meta["rows_total"] = await estimate()
+                except Exception as e:
+                    print(f"[export_jobs] estimate failed for {job_id}: {e}")
+            fp = await run_in_threadpool(_open_output, tmp, meta["compressed"])
+            async for chunk in make_body(_progress):
+                await run_in_threadpool(fp.write, chunk)
+                meta["bytes_raw"] += len(chunk)
+            await run_in_threadpool(fp.close)
+            fp = None
+            await run_in_threadpool(os.replace, tmp, _data_path(job_id))
+            meta["size"] = await run_in_threadpool(os.path.getsize, _data_path(job_id))
+            meta["status"] = "done"
+    except asyncio.CancelledError:
+        meta["status"] = "cancelled"
+        raise
+    except Exception as e:
+        meta["status"] = "failed"
+        meta["error"] = str(e)
+        print(f"[export_jobs] job {job_id} failed: {e}")
+    finally:
+        if fp is not None:
+            try:
+                fp.close()
+            except Exception:
+                pass
+        if meta["status"] != "done":
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+        meta["finished_at"] = meta["updated_at"] = time.time()
+        _tasks.pop(job_id, None)
+        if meta["status"] == "cancelled":
+            _jobs.pop(job_id, None)
+            _remove_files(job_id)
+        else:
+            _write_meta(meta)
+
+
+async def get_job(job_id: str) -> Dict[str, Any]:
+    job_id = (job_id or "").strip().lower()
+    if not _ID_RE.match(job_id):
+        raise HTTPException(status_code=404, detail="export job not found")
+    meta = _jobs.get(job_id)
+    if meta is None:
+        meta = await run_in_threadpool(_read_meta, job_id)
+        if meta is None:
+            raise HTTPException(status_code=404, detail="export job not found")
+        if meta["status"] in ("queued", "running"):
+            # le process qui l'exécutait a redémarré
+            meta.update({"status": "failed", "error": "interrupted (restart)"})
+        _jobs[job_id] = meta
+    return meta
+
+
+async def cancel_job(job_id: str) -> None:
+    meta = await get_job(job_id)
+    task = _tasks.get(meta["id"])
+    if task is not None:
+        task.cancel()
+        return
+    _jobs.pop(meta["id"], None)
+    await run_in_threadpool(_remove_files, meta["id"])
+
+
+def job_view(meta: Dict[str, Any]) -> Dict[str, Any]:
+    total = meta.get("rows_total")
+    done = int(meta.get("rows_done") or 0)
+    pct = None
+    if meta["status"] == "done":
+        pct = 100.0
+    elif total:
+        pct = round(min(99.9, 100.0 * done / total), 1)
+    started = meta.get("started_at")
+    elapsed = ((meta.get("finished_at") or time.time()) - started) if started else None
+    return {
+        "job_id": meta["id"],
+        "subject": meta["subject"],
+        "format": meta["format"],
+        "status": meta["status"],
+        "rows_done": done,
+        "rows_total": total,
+        "progress_pct": pct,
+        "bytes_raw": meta.get("bytes_raw", 0),
+        "size": meta.get("size"),
+        "rows_per_s": round(done / elapsed, 1) if elapsed else None,
+        "error": meta.get("error"),
+        "filename": meta["filename"],
+        "expires_at": float(meta["updated_at"]) + EXPORT_JOBS_TTL_H * 3600,
+    }
+
+
+def list_jobs() -> List[Dict[str, Any]]:
+    return [job_view(m) for m in sorted(_jobs.values(), key=lambda m: m["created_at"], reverse=True)]
+
+
+def shutdown_export_jobs() -> None:
+    for task in list(_tasks.values()):
+        task.cancel()
+
+
+def export_jobs_stats() -> Dict[str, Any]:
+    by_status: Dict[str, int] = {}
+    for m in _jobs.values():
+        by_status[m["status"]] = by_status.get(m["status"], 0) + 1
+    return {"jobs": by_status, "pending": len(_tasks), "concurrency": EXPORT_JOBS_CONCURRENCY}
+
+
+# -----------------------------------------------------------------------------
+# Téléchargement (Range)
+# -----------------------------------------------------------------------------
+def _parse_range(header: Optional[str], size: int) -> Optional[tuple]:
+    """'bytes=a-b' | 'bytes=a-' | 'bytes=-n' → (début, fin incluse) ; une seule plage."""
+    if not header:
+        return None
+    m = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", header)
+    if not m or (m.group(1) == "" and m.group(2) == ""):
+        raise HTTPException(status_code=416, detail="invalid range", headers={"Content-Range": f"bytes */{size}"})
+    if m.group(1) == "":
+        n = int(m.group(2))
+        start, end = max(0, size - n), size - 1
+    else:
+        start = int(m.group(1))
+        end = int(m.group(2)) if m.group(2) else size - 1
+    end = min(end, size - 1)
+    if start > end or start >= size:
+        raise HTTPException(status_code=416, detail="range not satisfiable", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+
+async def _read_slice(path: str, start: int, end: int) -> AsyncIterator[bytes]:
+    fp = await run_in_threadpool(open, path, "rb")
+    try:
+        await run_in_threadpool(fp.seek, start)
+        remaining = end - start + 1
+        while remaining > 0:
+            block = await run_in_threadpool(fp.read, min(_READ_BLOCK, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+    finally:
+        await run_in_threadpool(fp.close)
+
+
+async def download_response(meta: Dict[str, Any], range_header: Optional[str], if_range: Optional[str]) -> Response:
+    if meta["status"] != "done":
+        raise HTTPException(status_code=409, detail={"error": "export not ready", **job_view(meta)})
+    path = _data_path(meta["id"])
+    if not os.path.exists(path):
+        raise HTTPException(status_code=410, detail="export file expired")
+    size = int(meta["size"] or os.path.getsize(path))
+    etag = f'"{meta["id"]}-{size}"'
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Content-Disposition": f'attachment; filename="{meta["filename"]}"',
+    }
+    media = "application/gzip" if meta["compressed"] else "application/octet-stream"
+
+    rng = _parse_range(range_header, size) if size and (not if_range or if_range == etag) else None
+    if rng is None:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(_read_slice(path, 0, size - 1), media_type=media, headers=headers)
+    start, end = rng
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(_read_slice(path, start, end), status_code=206, media_type=media, headers=headers)
@@ -0,0 +1,248 @@
+# app/services/exports.py
+"""
+Exports admin en flux (CSV, GeoJSON / GeoJSON ligne à ligne, Parquet).
+
+- curseur côté serveur (AsyncSession.stream + yield_per) : les lignes arrivent
+  par paquets de EXPORT_FETCH_ROWS, mémoire constante quel que soit le volume
+- chaque paquet est formaté puis envoyé immédiatement ; l'en-tête part avant
+  même l'exécution de la requête (premier octet immédiat)
+- session dédiée ouverte dans le générateur (celle de la dépendance get_db est
+  fermée avant l'envoi du corps d'une StreamingResponse), sur le pool séparé
+  des exports : une longue lecture ne prend pas de connexion à /report et /map
+- GeoJSON : la géométrie produite par ST_AsGeoJSON est recopiée telle quelle
+  dans la Feature (pas de json.loads / json.dumps), seules les propriétés sont
+  sérialisées
+- Parquet (pyarrow, optionnel) : colonnes typées (dictionnaire pour les
+  libellés répétés, float64, timestamp UTC), un row group écrit et envoyé tous
+  les EXPORT_PARQUET_ROW_GROUP lignes
+"""
+import csv
+import io
+import json
+import os
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Sequence, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from app.db import ExportSessionLocal
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    _HAS_ARROW = True
+except Exception:
+    _HAS_ARROW = False
+
+# -------- Parameters (override via env if needed) ----------
+EXPORT_FETCH_ROWS = int(os.getenv("EXPORT_FETCH_ROWS", "2000"))
+EXPORT_MAX_ROWS   = int(os.getenv("EXPORT_MAX_ROWS", "200000"))
+
+EXPORT_PARQUET_ROW_GROUP   = int(os.getenv("EXPORT_PARQUET_ROW_GROUP", "50000"))
+EXPORT_PARQUET_COMPRESSION = os.getenv("EXPORT_PARQUET_COMPRESSION", "zstd")
+
+# (requête text(), paramètres, ligne SQL → valeurs CSV)
+ExportQuery = Tuple[Any, Dict[str, Any], Callable[[Any], List[Any]]]
+
+# (requête text() avec une colonne geom_json, paramètres, ligne SQL → propriétés)
+GeoQuery = Tuple[Any, Dict[str, Any], Callable[[Any], Dict[str, Any]]]
+
+# colonnes Parquet : (nom, type) avec type ∈ str | dict | float | int | ts
+ParquetColumns = Sequence[Tuple[str, str]]
+
+# progression : appelé avec le nombre de lignes de chaque paquet lu
+OnRows = Optional[Callable[[int], None]]
+
+_stats = {"started": 0, "completed": 0, "aborted": 0, "rows": 0, "bytes": 0}
+
+
+async def iter_row_batches(
+    queries: Sequence[Tuple[Any, Dict[str, Any]]],
+    fetch: int = EXPORT_FETCH_ROWS,
+    on_rows: OnRows = None,
+) -> AsyncIterator[Tuple[int, Sequence[Any]]]:
+    """Exécute les requêtes l'une après l'autre sur un curseur serveur.
+    → (index de la requête, paquet de lignes)"""
+    async with ExportSessionLocal() as db:
+        for i, (sql, params) in enumerate(queries):
+            result = await db.stream(sql, params, execution_options={"yield_per": fetch})
+            async for part in result.partitions():
+                if on_rows:
+                    on_rows(len(part))
+                yield i, part
+
+
+async def count_rows(queries: Sequence[Tuple[Any, Dict[str, Any]]]) -> int:
+    """Somme des COUNT(*) des requêtes (estimation de progression)."""
+    total = 0
+    async with ExportSessionLocal() as db:
+        for sql, params in queries:
+            total += int((await db.execute(sql, params)).scalar() or 0)
+    return total
+
+
+def _drain(buf: io.StringIO) -> bytes:
+    data = buf.getvalue().encode("utf-8")
+    buf.seek(0)
+    buf.truncate(0)
+    return data
+
+
+async def csv_chunks(header: Sequence[str], queries: Sequence[ExportQuery], on_rows: OnRows = None) -> AsyncIterator[bytes]:
+    """CSV en flux : en-tête, puis un morceau par paquet de lignes."""
+    _stats["started"] += 1
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(header)
+    chunk = _drain(buf)
+    _stats["bytes"] += len(chunk)
+    done = False
+    try:
+        yield chunk
+        async for i, part in iter_row_batches([(q[0], q[1]) for q in queries], on_rows=on_rows):
+            to_row = queries[i][2]
+            for r in part:
+                w.writerow(to_row(r))
+            chunk = _drain(buf)
+            _stats["rows"] += len(part)
+            _stats["bytes"] += len(chunk)
+            yield chunk
+        done = True
+    finally:
+        _stats["completed" if done else "aborted"] += 1
+
+
+def _feature(geom_json: str, props: Dict[str, Any]) -> str:
+    return (
+        '{"type":"Feature","geometry":' + geom_json
+        + ',"properties":' + json.dumps(props, ensure_ascii=False, default=str) + "}"
+    )
+
+
+async def geojson_chunks(queries: Sequence[GeoQuery], ndjson: bool = False, on_rows: OnRows = None) -> AsyncIterator[bytes]:
+    """FeatureCollection écrite au fil de l'eau : en-tête, features, fermeture.
+    ndjson=True → une Feature par ligne (GeoJSON délimité par des sauts de ligne)."""
+    _stats["started"] += 1
+    done = False
+    first = True
+    try:
+        if not ndjson:
+            head = b'{"type":"FeatureCollection","features":['
+            _stats["bytes"] += len(head)
+            yield head
+        async for i, part in iter_row_batches([(q[0], q[1]) for q in queries], on_rows=on_rows):
+            to_props = queries[i][2]
+            out: List[str] = []
+            for r in part:
+                if not r.geom_json:
+                    continue
+                feat = _feature(r.geom_json, to_props(r))
+                if ndjson:
+                    out.append(feat + "\n")
+                else:
+                    out.append(feat if first else "," + feat)
+                    first = False
+            if out:
+                chunk = "".join(out).encode("utf-8")
+                _stats["rows"] += len(out)
+                _stats["bytes"] += len(chunk)
+                yield chunk
+        if not ndjson:
+            yield b"]}"
+        done = True
+    finally:
+        _stats["completed" if done else "aborted"] += 1
+
+
+def parquet_available() -> bool:
+    return _HAS_ARROW
+
+
+class _ChunkSink:
+    """Fichier en écriture seule pour ParquetWriter : on vide le tampon après chaque row group."""
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._pos = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self._buf += data
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def flush(self) -> None:
+        pass
+
+    def writable(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = bytes(self._buf)
+        self._buf.clear()
+        return data
+
+
+def _arrow_type(kind: str):
+    return {
+        "str": pa.string(),
+        "dict": pa.dictionary(pa.int32(), pa.string()),
+        "float": pa.float64(),
+        "int": pa.int64(),
+        "ts": pa.timestamp("us", tz="UTC"),
+    }[kind]
+
+
+async def parquet_chunks(columns: ParquetColumns, queries: Sequence[ExportQuery], on_rows: OnRows = None) -> AsyncIterator[bytes]:
+    """Parquet en flux : chaque row group est encodé (threadpool) puis envoyé.
+    Les fonctions de ligne renvoient les valeurs dans l'ordre de `columns`."""
+    schema = pa.schema([(name, _arrow_type(kind)) for name, kind in columns])
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(
+        sink, schema, compression=EXPORT_PARQUET_COMPRESSION, use_dictionary=True,
+    )
+    cols: List[List[Any]] = [[] for _ in columns]
+
+    def _write_group() -> bytes:
+        arrays = [pa.array(values, type=field.type) for values, field in zip(cols, schema)]
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema), row_group_size=len(cols[0]))
+        for values in cols:
+            values.clear()
+        return sink.drain()
+
+    _stats["started"] += 1
+    done = False
+    try:
+        async for i, part in iter_row_batches([(q[0], q[1]) for q in queries], on_rows=on_rows):
+            to_row = queries[i][2]
+            for r in part:
+                for values, v in zip(cols, to_row(r)):
+                    values.append(v)
+            _stats["rows"] += len(part)
+            if len(cols[0]) >= EXPORT_PARQUET_ROW_GROUP:
+                chunk = await run_in_threadpool(_write_group)
+                _stats["bytes"] += len(chunk)
+                yield chunk
+        if cols[0]:
+            await run_in_threadpool(_write_group)
+        await run_in_threadpool(writer.close)  # pied de page (schéma + index des row groups)
+        chunk = sink.drain()
+        _stats["bytes"] += len(chunk)
+        yield chunk
+        done = True
+    finally:
+        _stats["completed" if done else "aborted"] += 1
+
+
+def export_stats() -> Dict[str, Any]:
+    return {
+        **_stats,
+        "fetch_rows": EXPORT_FETCH_ROWS,
+        "max_rows": EXPORT_MAX_ROWS,
+        "parquet": _HAS_ARROW,
+    }
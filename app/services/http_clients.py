@@ -0,0 +1,198 @@
+# app/services/http_clients.py
+"""
+Registre de clients httpx partagés (un client par service distant).
+
+- connexions poolées + keep-alive (plus de handshake TLS à chaque appel)
+- HTTP/2 si le paquet `h2` est installé
+- limites par client (= par hôte), timeouts par défaut surchargeables par requête
+- retry avec backoff exponentiel + jitter (uniquement si le corps est rejouable)
+- statistiques (requêtes, erreurs, retries, latences, état du pool)
+- injectable : override(name, client) ou set_transport(...) pour les tests /
+  un serveur stub local à la place de Supabase (SUPABASE_URL=http://127.0.0.1:...)
+
+Ouvert/fermé par le lifespan de l'app (app/main.py), création paresseuse sinon.
+"""
+import asyncio
+import os
+import random
+import time
+from typing import Any, Dict, Optional
+
+import httpx
+
+from app.services import tracing
+from app.services.telemetry import remote_latency
+
+# -------- Parameters (override via env if needed) ----------
+HTTP_TIMEOUT_S          = float(os.getenv("HTTP_TIMEOUT_S", "10"))
+HTTP_CONNECT_TIMEOUT_S  = float(os.getenv("HTTP_CONNECT_TIMEOUT_S", "5"))
+HTTP_MAX_CONNECTIONS    = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE      = int(os.getenv("HTTP_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY_S = float(os.getenv("HTTP_KEEPALIVE_EXPIRY_S", "30"))
+HTTP_RETRIES            = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_RETRY_BASE_S       = float(os.getenv("HTTP_RETRY_BASE_S", "0.2"))
+HTTP_RETRY_MAX_S        = float(os.getenv("HTTP_RETRY_MAX_S", "2"))
+HTTP2_ENABLED           = os.getenv("HTTP2_ENABLED", "1") != "0"
+
+try:
+    import h2  # noqa: F401
+    _HAS_H2 = True
+except Exception:
+    _HAS_H2 = False
+
+_RETRY_STATUSES = {502, 503, 504}
+
+# Profils par service : options httpx.AsyncClient spécifiques
+_PROFILES: Dict[str, Dict[str, Any]] = {
+    "supabase": {},
+    "nominatim": {
+        "headers": {"User-Agent": "AWO/1.0 (contact: support@awo.local)"},
+        "timeout": 8.0,
+    },
+}
+
+
+def _replayable(kwargs: Dict[str, Any]) -> bool:
+    content = kwargs.get("content")
+    return content is None or isinstance(content, (bytes, str))
+
+
+def _backoff(attempt: int) -> float:
+    # "full jitter" : uniforme dans [0, base * 2^attempt], plafonné
+    return random.uniform(0, min(HTTP_RETRY_MAX_S, HTTP_RETRY_BASE_S * (2 ** attempt)))
+
+
+class HttpClientRegistry:
+    def __init__(self):
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._stats: Dict[str, Dict[str, float]] = {}
+        self._transport: Optional[httpx.AsyncBaseTransport] = None
+
+    # ------------------------------------------------------------------ clients
+    def _build(self, name: str) -> httpx.AsyncClient:
+        prof = dict(_PROFILES.get(name, {}))
+        timeout = prof.pop("timeout", HTTP_TIMEOUT_S)
+        kwargs: Dict[str, Any] = {
+            "timeout": httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT_S),
+            "limits": httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY_S,
+            ),
+            "http2": HTTP2_ENABLED and _HAS_H2,
+        }
+        if self._transport is not None:
+            kwargs["transport"] = self._transport
+        kwargs.update(prof)
+        return httpx.AsyncClient(**kwargs)
+
+    def get(self, name: str) -> httpx.AsyncClient:
+        client = self._clients.get(name)
+        if client is None or client.is_closed:
+            client = self._build(name)
+            self._clients[name] = client
+        return client
+
+    def open(self) -> None:
+        for name in _PROFILES:
+            self.get(name)
+
+    def override(self, name: str, client: httpx.AsyncClient) -> None:
+        """Injection (tests) : remplace le client d'un service."""
+        self._clients[name] = client
+
+    def set_transport(self, transport: Optional[httpx.AsyncBaseTransport]) -> None:
+        """Injection (tests) : transport commun aux clients créés ensuite (ex. MockTransport)."""
+        self._transport = transport
+
+    async def aclose(self) -> None:
+        clients, self._clients = list(self._clients.values()), {}
+        for c in clients:
+            try:
+                await c.aclose()
+            except Exception:
+                pass
+
+    # ------------------------------------------------------------------ requêtes
+    def _st(self, name: str) -> Dict[str, float]:
+        st = self._stats.get(name)
+        if st is None:
+            st = {"requests": 0, "errors": 0, "retries": 0, "in_flight": 0,
+                  "latency_ms_sum": 0.0, "latency_ms_max": 0.0}
+            self._stats[name] = st
+        return st
+
+    async def request(
+        self,
+        name: str,
+        method: str,
+        url: str,
+        *,
+        retries: Optional[int] = None,
+        **kwargs: Any,
+    ) -> httpx.Response:
+        """Requête via le client `name` ; retry (erreurs transport, 502/503/504)
+        seulement si le corps est rejouable (pas de flux)."""
+        client = self.get(name)
+        st = self._st(name)
+        attempts = 1 + max(0, HTTP_RETRIES if retries is None else int(retries))
+        if not _replayable(kwargs):
+            attempts = 1
+
+        attempt = 0
+        while True:
+            t0 = time.perf_counter()
+            st["requests"] += 1
+            st["in_flight"] += 1
+            try:
+                resp = await client.request(method, url, **kwargs)
+            except httpx.TransportError:
+                st["errors"] += 1
+                if attempt + 1 >= attempts:
+                    raise
+                resp = None
+            finally:
+                st["in_flight"] -= 1
+                dt_ms = (time.perf_counter() - t0) * 1000.0
+                st["latency_ms_sum"] += dt_ms
+                st["latency_ms_max"] = max(st["latency_ms_max"], dt_ms)
+                remote_latency.observe(dt_ms / 1000.0, name)
+                tracing.add("ext", dt_ms / 1000.0, f"{name} {method}")
+
+            if resp is not None:
+                if resp.status_code not in _RETRY_STATUSES or attempt + 1 >= attempts:
+                    return resp
+                st["errors"] += 1
+                await resp.aclose()
+
+            st["retries"] += 1
+            await asyncio.sleep(_backoff(attempt))
+            attempt += 1
+
+    # ------------------------------------------------------------------ stats
+    @staticmethod
+    def _pool_info(client: httpx.AsyncClient) -> Dict[str, Any]:
+        # httpcore n'expose pas d'API publique stable → best effort
+        try:
+            conns = list(client._transport._pool.connections)  # type: ignore[attr-defined]
+            return {
+                "connections": len(conns),
+                "idle": sum(1 for c in conns if c.is_idle()),
+                "http2": sum(1 for c in conns if "HTTP/2" in repr(c)),
+            }
+        except Exception:
+            return {}
+
+    def stats(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {"http2_available": _HAS_H2, "clients": {}}
+        for name in sorted(set(self._clients) | set(self._stats)):
+            st = dict(self._st(name))
+            n = st["requests"] or 0
+            st["latency_ms_avg"] = round(st["latency_ms_sum"] / n, 2) if n else None
+            client = self._clients.get(name)
+            st["pool"] = self._pool_info(client) if client is not None else {}
+            out["clients"][name] = st
+        return out
+
+
+http_clients = HttpClientRegistry()
@@ -0,0 +1,299 @@
+# app/services/media.py
+"""
+Variantes d'images (miniature + taille moyenne) pour les pièces jointes.
+
+- générées après l'upload, hors requête, dans un pool de processus
+  (décodage/redimensionnement CPU → jamais sur la boucle d'événements)
+- orientation EXIF appliquée puis métadonnées supprimées (EXIF, GPS, ICC)
+- WebP (repli JPEG si l'encodeur WebP n'est pas disponible)
+- stockées à côté de l'original : <chemin>.thumb.webp / <chemin>.medium.webp
+- URLs écrites dans attachments.thumb_url / attachments.medium_url
+
+Ingestion optionnelle (MEDIA_INGEST_ENABLED=1) : avant stockage, l'image est
+redimensionnée à MEDIA_INGEST_MAX_PX et ré-encodée (WebP/JPEG, MEDIA_INGEST_QUALITY)
+dans le même pool ; l'original n'est conservé que si MEDIA_KEEP_ORIGINAL=1.
+Octets reçus / stockés écrits dans attachments.original_bytes / stored_bytes.
+
+Pillow est optionnel : sans lui, pas de variantes ni d'ingestion (l'original reste servi).
+
+Colonnes créées par /admin/ensure_schema uniquement ; tant qu'elles manquent,
+les variantes produites ne sont pas enregistrées et les listings n'ont pas de
+miniature.
+"""
+import asyncio
+import os
+import tempfile
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Set, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db import AsyncSessionLocal
+from app.services.cta_queue import refresh_cta_media_for_attachment
+from app.services.ddl import present_columns
+from app.services.storage import get_storage
+from app.services.uploads import UploadStream, save_stream_to_disk
+
+try:
+    from PIL import Image, ImageOps
+    _HAS_PIL = True
+except Exception:
+    _HAS_PIL = False
+
+# -------- Parameters (override via env if needed) ----------
+MEDIA_VARIANTS_ENABLED = os.getenv("MEDIA_VARIANTS_ENABLED", "1") != "0"
+MEDIA_WORKERS          = int(os.getenv("MEDIA_WORKERS", "2"))
+MEDIA_THUMB_PX         = int(os.getenv("MEDIA_THUMB_PX", "320"))
+MEDIA_MEDIUM_PX        = int(os.getenv("MEDIA_MEDIUM_PX", "1280"))
+MEDIA_QUALITY          = int(os.getenv("MEDIA_QUALITY", "75"))
+MEDIA_TMP_DIR          = os.getenv("MEDIA_TMP_DIR") or os.path.join(tempfile.gettempdir(), "ayii-media")
+
+MEDIA_INGEST_ENABLED    = os.getenv("MEDIA_INGEST_ENABLED", "0") == "1"
+MEDIA_INGEST_MAX_PX     = int(os.getenv("MEDIA_INGEST_MAX_PX", "2048"))
+MEDIA_INGEST_QUALITY    = int(os.getenv("MEDIA_INGEST_QUALITY", "80"))
+MEDIA_INGEST_FORMAT     = os.getenv("MEDIA_INGEST_FORMAT", "webp").strip().lower()  # webp | jpeg
+MEDIA_INGEST_MIN_SAVING = float(os.getenv("MEDIA_INGEST_MIN_SAVING", "0.1"))  # gain mini pour remplacer
+MEDIA_KEEP_ORIGINAL     = os.getenv("MEDIA_KEEP_ORIGINAL", "0") == "1"
+
+VARIANTS: Tuple[Tuple[str, int], ...] = (("thumb", MEDIA_THUMB_PX), ("medium", MEDIA_MEDIUM_PX))
+
+_DDL = [
+    "ALTER TABLE attachments ADD COLUMN IF NOT EXISTS thumb_url text NULL",
+    "ALTER TABLE attachments ADD COLUMN IF NOT EXISTS medium_url text NULL",
+    "ALTER TABLE attachments ADD COLUMN IF NOT EXISTS original_url text NULL",
+    "ALTER TABLE attachments ADD COLUMN IF NOT EXISTS original_bytes bigint NULL",
+    "ALTER TABLE attachments ADD COLUMN IF NOT EXISTS stored_bytes bigint NULL",
+]
+
+_schema_ready = False
+_pool: Optional[ProcessPoolExecutor] = None
+_tasks: Set[asyncio.Task] = set()
+_stats = {"scheduled": 0, "done": 0, "failed": 0, "skipped": 0}
+_ingest_stats = {"ingested": 0, "kept_as_is": 0, "failed": 0, "bytes_in": 0, "bytes_out": 0}
+
+
+def variants_available() -> bool:
+    return MEDIA_VARIANTS_ENABLED and _HAS_PIL
+
+
+def ingest_available() -> bool:
+    return MEDIA_INGEST_ENABLED and _HAS_PIL
+
+
+async def ensure_media_schema(db: AsyncSession) -> None:
+    global _schema_ready
+    if _schema_ready:
+        return
+    for ddl in _DDL:
+        await db.execute(text(ddl))
+    await db.commit()
+    _schema_ready = True
+
+
+async def media_ready(db: AsyncSession) -> bool:
+    """thumb_url / medium_url présentes ? (listings, variantes : ni DDL ni commit)."""
+    return len(await present_columns(db, "attachments", ("thumb_url", "medium_url"))) == 2
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=max(1, MEDIA_WORKERS))
+    return _pool
+
+
+def shutdown_media_pool() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def variant_path(original_path: str, name: str, ext: str) -> str:
+    stem = original_path.rsplit(".", 1)[0] if "." in os.path.basename(original_path) else original_path
+    return f"{stem}.{name}{ext}"
+
+
+# -----------------------------------------------------------------------------
+# Travail CPU (exécuté dans un processus du pool)
+# -----------------------------------------------------------------------------
+def _to_rgb(im):
+    if im.mode not in ("RGB", "RGBA"):
+        im = im.convert("RGBA" if "A" in im.getbands() else "RGB")
+    return im
+
+
+def _encode(im, dst: str, fmt: str, quality: int) -> Tuple[str, str, str]:
+    """→ (fichier produit, extension, content-type) ; repli JPEG si pas d'encodeur WebP."""
+    if fmt == "webp":
+        try:
+            im.save(dst + ".webp", "WEBP", quality=quality, method=4)
+            return dst + ".webp", ".webp", "image/webp"
+        except Exception:
+            pass
+    im.convert("RGB").save(dst + ".jpg", "JPEG", quality=quality, optimize=True, progressive=True)
+    return dst + ".jpg", ".jpg", "image/jpeg"
+
+
+def _recompress(src_path: str, out_dir: str, max_px: int, quality: int, fmt: str) -> Tuple[str, str, str]:
+    with Image.open(src_path) as im:
+        im = _to_rgb(ImageOps.exif_transpose(im))
+        if max(im.size) > max_px:
+            im.thumbnail((max_px, max_px), Image.LANCZOS)
+        im.info = {}  # pas d'EXIF/GPS/ICC
+        return _encode(im, os.path.join(out_dir, f"{uuid.uuid4().hex}.ingest"), fmt, quality)
+
+
+def _render_variants(src_path: str, out_dir: str, sizes: Tuple[Tuple[str, int], ...], quality: int) -> Dict[str, Tuple[str, str, str]]:
+    """→ {nom: (fichier produit, extension, content-type)}"""
+    out: Dict[str, Tuple[str, str, str]] = {}
+    token = uuid.uuid4().hex
+    with Image.open(src_path) as im:
+        im = _to_rgb(ImageOps.exif_transpose(im))
+        for name, px in sizes:
+            v = im.copy()
+            v.thumbnail((px, px), Image.LANCZOS)
+            v.info = {}  # pas d'EXIF/GPS/ICC dans les variantes
+            out[name] = _encode(v, os.path.join(out_dir, f"{token}.{name}"), "webp", quality)
+    return out
+
+
+# -----------------------------------------------------------------------------
+# Orchestration (boucle d'événements)
+# -----------------------------------------------------------------------------
+async def spool_upload(stream: UploadStream) -> str:
+    """Copie de travail locale de l'upload (à supprimer par l'appelant)."""
+    os.makedirs(MEDIA_TMP_DIR, exist_ok=True)
+    dst = os.path.join(MEDIA_TMP_DIR, f"{uuid.uuid4().hex}.src")
+    await save_stream_to_disk(stream, dst, account=False)
+    return dst
+
+
+async def spool_source(stream: UploadStream) -> Optional[str]:
+    """Source des variantes (backend distant : l'original n'est pas sur disque)."""
+    if not variants_available():
+        return None
+    return await spool_upload(stream)
+
+
+def discard_local(*paths: Optional[str]) -> None:
+    for path in paths:
+        if path:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+
+async def ingest_image(src_path: str) -> Optional[Dict[str, object]]:
+    """Réduit / ré-encode l'image spoolée (pool de processus).
+    → {path, ext, content_type, bytes_in, bytes_out}, ou None si le gain est
+    inférieur à MEDIA_INGEST_MIN_SAVING (on garde alors l'original tel quel)."""
+    if not ingest_available():
+        return None
+    bytes_in = os.path.getsize(src_path)
+    try:
+        loop = asyncio.get_running_loop()
+        out, ext, ctype = await loop.run_in_executor(
+            _get_pool(), _recompress, src_path, MEDIA_TMP_DIR,
+            MEDIA_INGEST_MAX_PX, MEDIA_INGEST_QUALITY, MEDIA_INGEST_FORMAT,
+        )
+    except Exception as e:
+        _ingest_stats["failed"] += 1
+        print(f"[media] ingest failed: {e}")
+        return None
+    bytes_out = os.path.getsize(out)
+    if bytes_out > bytes_in * (1.0 - MEDIA_INGEST_MIN_SAVING):
+        discard_local(out)
+        _ingest_stats["kept_as_is"] += 1
+        return None
+    _ingest_stats["ingested"] += 1
+    _ingest_stats["bytes_in"] += bytes_in
+    _ingest_stats["bytes_out"] += bytes_out
+    return {"path": out, "ext": ext, "content_type": ctype, "bytes_in": bytes_in, "bytes_out": bytes_out}
+
+
+async def generate_variants(
+    attachment_id: str,
+    src_path: str,
+    original_path: str,
+    *,
+    remove_src: bool,
+) -> Dict[str, str]:
+    """Génère, stocke et enregistre les variantes d'une pièce jointe."""
+    produced: Dict[str, Tuple[str, str, str]] = {}
+    urls: Dict[str, str] = {}
+    try:
+        os.makedirs(MEDIA_TMP_DIR, exist_ok=True)
+        loop = asyncio.get_running_loop()
+        produced = await loop.run_in_executor(
+            _get_pool(), _render_variants, src_path, MEDIA_TMP_DIR, VARIANTS, MEDIA_QUALITY,
+        )
+        storage = get_storage()
+        for name, (local, ext, ctype) in produced.items():
+            urls[name] = await storage.put_file(variant_path(original_path, name, ext), local, ctype, move=True)
+
+        async with AsyncSessionLocal() as db:
+            if not await media_ready(db):
+                print(f"[media] variants not recorded for {attachment_id}: columns missing (/admin/ensure_schema)")
+                return urls
+            await db.execute(
+                text("UPDATE attachments SET thumb_url = :t, medium_url = :m WHERE id = :id"),
+                {"t": urls.get("thumb"), "m": urls.get("medium"), "id": str(attachment_id)},
+            )
+            await refresh_cta_media_for_attachment(db, str(attachment_id))
+            await db.commit()
+        _stats["done"] += 1
+        return urls
+    except Exception as e:
+        _stats["failed"] += 1
+        print(f"[media] variants failed for {attachment_id}: {e}")
+        return urls
+    finally:
+        for local, _, _ in produced.values():
+            discard_local(local)  # no-op si déjà déplacé par le backend
+        if remove_src:
+            discard_local(src_path)
+
+
+def schedule_variants(
+    attachment_id: Optional[str],
+    src_path: Optional[str],
+    original_path: str,
+    *,
+    remove_src: bool,
+) -> bool:
+    """Lance la génération en tâche de fond (la réponse HTTP n'attend pas)."""
+    if not (attachment_id and src_path and variants_available()):
+        _stats["skipped"] += 1
+        if remove_src:
+            discard_local(src_path)
+        return False
+    task = asyncio.get_running_loop().create_task(generate_variants(
+        str(attachment_id), src_path, original_path, remove_src=remove_src,
+    ))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    _stats["scheduled"] += 1
+    return True
+
+
+def media_stats() -> Dict[str, object]:
+    return {
+        **_stats,
+        "pending": len(_tasks),
+        "pillow": _HAS_PIL,
+        "enabled": MEDIA_VARIANTS_ENABLED,
+        "workers": MEDIA_WORKERS,
+        "ingest": {
+            **_ingest_stats,
+            "bytes_saved": _ingest_stats["bytes_in"] - _ingest_stats["bytes_out"],
+            "enabled": MEDIA_INGEST_ENABLED,
+            "max_px": MEDIA_INGEST_MAX_PX,
+            "quality": MEDIA_INGEST_QUALITY,
+            "keep_original": MEDIA_KEEP_ORIGINAL,
+        },
+    }
@@ -0,0 +1,133 @@
+# app/services/recent_reports.py
+"""
+Index mémoire des reports récents, pour le contrôle de propriété des uploads.
+
+Clé (user_id, kind) → reports 'cut' / 'to_clean' des OWNERSHIP_LINK_HOURS
+dernières heures (id, position, signal, date). Alimenté à l'insertion d'un
+report (crud.insert_report) et par les résultats du repli SQL.
+
+Le contrôle de distance se fait en Python (haversine). L'index ne sert qu'à
+répondre « oui » vite : une absence (autre instance, redémarrage, cas limite
+au bord du rayon) retombe toujours sur la requête SQL, et un « oui » est
+confirmé par une lecture sur la clé primaire (report supprimé entre-temps).
+"""
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# -------- Parameters (override via env if needed) ----------
+RECENT_INDEX_ENABLED  = os.getenv("RECENT_INDEX_ENABLED", "1") != "0"
+RECENT_INDEX_MAX_KEYS = int(os.getenv("RECENT_INDEX_MAX_KEYS", "50000"))
+RECENT_INDEX_PER_KEY  = int(os.getenv("RECENT_INDEX_PER_KEY", "50"))
+OWNERSHIP_LINK_HOURS  = int(os.getenv("OWNERSHIP_LINK_HOURS", "48"))
+
+OWNERSHIP_SIGNALS = ("cut", "to_clean")
+
+_EARTH_R_M = 6_371_008.8
+# haversine (sphère) vs ST_DWithin (ellipsoïde) : < 0,5 % d'écart ; on ne
+# conclut en mémoire que nettement à l'intérieur du rayon, sinon repli SQL
+_EDGE_MARGIN = 0.995
+
+# (created_ts, report_id, lat, lng, signal)
+Entry = Tuple[float, str, float, float, str]
+
+
+def haversine_m(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lng2 - lng1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * _EARTH_R_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _norm(v: Any) -> str:
+    return str(v or "").strip().lower()
+
+
+class RecentReportIndex:
+    def __init__(self, max_keys: int = RECENT_INDEX_MAX_KEYS, per_key: int = RECENT_INDEX_PER_KEY,
+                 window_h: int = OWNERSHIP_LINK_HOURS):
+        self.max_keys = max(1, max_keys)
+        self.per_key = max(1, per_key)
+        self.window_s = window_h * 3600.0
+        self._data: "OrderedDict[Tuple[str, str], List[Entry]]" = OrderedDict()
+        self._stats = {"adds": 0, "hits": 0, "misses": 0, "edge": 0, "stale": 0, "evictions": 0}
+
+    def _prune(self, entries: List[Entry], now: float) -> List[Entry]:
+        cutoff = now - self.window_s
+        return [e for e in entries if e[0] > cutoff]
+
+    def add(self, user_id: Any, kind: str, signal: str, lat: float, lng: float,
+            report_id: Any, created_ts: Optional[float] = None) -> None:
+        sig = _norm(signal)
+        if not (user_id and report_id) or sig not in OWNERSHIP_SIGNALS:
+            return
+        now = time.time()
+        key = (_norm(user_id), _norm(kind))
+        entries = [e for e in self._data.pop(key, []) if e[1] != str(report_id)]
+        entries.append((float(created_ts or now), str(report_id), float(lat), float(lng), sig))
+        entries.sort(key=lambda e: e[0], reverse=True)
+        self._data[key] = self._prune(entries, now)[: self.per_key]
+        self._stats["adds"] += 1
+        while len(self._data) > self.max_keys:
+            self._data.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def find(self, user_id: Any, kind: str, lat: float, lng: float, radius_m: float,
+             signals: Iterable[str] = OWNERSHIP_SIGNALS, report_id: Any = None) -> Optional[str]:
+        """Report le plus récent de cet utilisateur/kind à ≤ radius_m → id, sinon None
+        (None = « pas trouvé ici », pas « pas propriétaire »)."""
+        key = (_norm(user_id), _norm(kind))
+        entries = self._data.get(key)
+        if not entries:
+            self._stats["misses"] += 1
+            return None
+        now = time.time()
+        entries = self._prune(entries, now)
+        if not entries:
+            self._data.pop(key, None)
+            self._stats["misses"] += 1
+            return None
+        self._data[key] = entries
+        self._data.move_to_end(key)
+        wanted = {_norm(s) for s in signals}
+        rid = str(report_id) if report_id else None
+        for ts, eid, elat, elng, sig in entries:  # du plus récent au plus ancien
+            if sig not in wanted or (rid and eid != rid):
+                continue
+            d = haversine_m(lat, lng, elat, elng)
+            if d <= radius_m * _EDGE_MARGIN:
+                self._stats["hits"] += 1
+                return eid
+            if d <= radius_m / _EDGE_MARGIN:
+                # bord du rayon : c'est ST_DWithin (ellipsoïde) qui tranche
+                self._stats["edge"] += 1
+                return None
+        self._stats["misses"] += 1
+        return None
+
+    def discard(self, report_id: Any) -> None:
+        rid = str(report_id)
+        for key in list(self._data):
+            entries = [e for e in self._data[key] if e[1] != rid]
+            if entries:
+                self._data[key] = entries
+            else:
+                del self._data[key]
+        self._stats["stale"] += 1
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self._stats,
+            "keys": len(self._data),
+            "entries": sum(len(v) for v in self._data.values()),
+            "enabled": RECENT_INDEX_ENABLED,
+        }
+
+
+recent_reports = RecentReportIndex()
@@ -0,0 +1,282 @@
+# app/services/resolution.py
+"""
+Historique des changements de status et délais de résolution.
+
+- chaque transition (/cta/mark_status) est journalisée dans
+  `report_status_events` (ancien → nouveau status, horodatage, âge du report)
+- à chaque passage à 'resolved', le délai (création → résolution) est ajouté
+  à un histogramme par (jour de résolution, kind, line_code) :
+  `resolution_rollups`, bornes fixes en minutes → incrément O(1) à l'écriture
+- p50 / p90 / p99 et part sous l'objectif SLA calculés depuis les
+  histogrammes (interpolation linéaire dans l'intervalle), sans relire
+  l'historique ; précision = largeur des intervalles
+"""
+import os
+from bisect import bisect_left
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Sequence
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# -------- Parameters (override via env if needed) ----------
+SLA_TARGET_MIN = int(os.getenv("SLA_TARGET_MIN", "120"))
+
+# bornes hautes des intervalles (minutes) ; un dernier intervalle ouvert au-delà
+RESOLUTION_BOUNDS_MIN = (
+    1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 240, 360, 480, 720,
+    1080, 1440, 2880, 4320, 10080,
+)
+
+_DDL = [
+    "ALTER TABLE reports ADD COLUMN IF NOT EXISTS status text",
+    """
+    CREATE TABLE IF NOT EXISTS report_status_events (
+      id          bigserial   PRIMARY KEY,
+      report_id   uuid        NOT NULL,
+      from_status text        NOT NULL,
+      to_status   text        NOT NULL,
+      at          timestamptz NOT NULL DEFAULT NOW(),
+      age_min     double precision NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_report_status_events_report ON report_status_events (report_id, at)",
+    "CREATE INDEX IF NOT EXISTS idx_report_status_events_at ON report_status_events (at)",
+    """
+    CREATE TABLE IF NOT EXISTS resolution_rollups (
+      day       date             NOT NULL,
+      kind      text             NOT NULL,
+      line_code text             NOT NULL,
+      bucket    smallint         NOT NULL,
+      n         integer          NOT NULL,
+      sum_min   double precision NOT NULL,
+      PRIMARY KEY (day, kind, line_code, bucket)
+    )
+    """,
+]
+
+_schema_ready = False
+_tables_ready = False
+
+
+async def ensure_resolution_schema(db: AsyncSession) -> None:
+    global _schema_ready, _tables_ready
+    if _schema_ready:
+        return
+    for ddl in _DDL:
+        await db.execute(text(ddl))
+    await db.commit()
+    _schema_ready = _tables_ready = True
+
+
+async def resolution_ready(db: AsyncSession) -> bool:
+    """Journal présent ? (/cta/mark_status, lectures /metrics : ni DDL ni commit)."""
+    global _tables_ready
+    if not _tables_ready and (await db.execute(text(
+        "SELECT to_regclass('report_status_events') IS NOT NULL AND to_regclass('resolution_rollups') IS NOT NULL"
+    ))).scalar():
+        _tables_ready = True
+    return _tables_ready
+
+
+def bucket_of(minutes: float) -> int:
+    return bisect_left(RESOLUTION_BOUNDS_MIN, max(0.0, float(minutes)))
+
+
+# -----------------------------------------------------------------------------
+# Écriture
+# -----------------------------------------------------------------------------
+_SET_STATUS = text("""
+    WITH prev AS (
+      SELECT id, COALESCE(status, 'new') AS s
+        FROM reports
+       WHERE id = CAST(:id AS uuid)
+       FOR UPDATE
+    )
+    UPDATE reports r
+       SET status = :s
+      FROM prev
+     WHERE r.id = prev.id
+    RETURNING r.id,
+              prev.s                                           AS prev_status,
+              r.kind::text                                     AS kind,
+              COALESCE(r.line_code, '')                        AS line_code,
+              EXTRACT(EPOCH FROM (NOW() - r.created_at)) / 60.0 AS age_min
+""")
+
+_LOG_EVENT = text("""
+    INSERT INTO report_status_events (report_id, from_status, to_status, age_min)
+    VALUES (CAST(:id AS uuid), :f, :t, :age)
+""")
+
+_ADD_RESOLUTION = text("""
+    INSERT INTO resolution_rollups (day, kind, line_code, bucket, n, sum_min)
+    VALUES (CURRENT_DATE, :kind, :line, :b, 1, :m)
+    ON CONFLICT (day, kind, line_code, bucket) DO UPDATE
+       SET n       = resolution_rollups.n + 1,
+           sum_min = resolution_rollups.sum_min + EXCLUDED.sum_min
+""")
+
+
+async def set_report_status(db: AsyncSession, report_id: str, new_status: str) -> Optional[Dict[str, Any]]:
+    """Change le status, journalise la transition et, sur 'resolved', alimente
+    l'histogramme des délais. None si le report n'existe pas. Ne commit pas ;
+    tant que /admin/ensure_schema n'a pas créé le journal, seul le status change."""
+    logged = await resolution_ready(db)
+    row = (await db.execute(_SET_STATUS, {"id": report_id, "s": new_status})).mappings().first()
+    if not row:
+        return None
+    prev = row["prev_status"]
+    age = float(row["age_min"]) if row["age_min"] is not None else None
+    if prev != new_status and logged:
+        await db.execute(_LOG_EVENT, {"id": report_id, "f": prev, "t": new_status, "age": age})
+        # chaque passage à 'resolved' compte (une réouverture puis re-résolution = deux résolutions)
+        if new_status == "resolved" and age is not None:
+            await db.execute(_ADD_RESOLUTION, {
+                "kind": row["kind"] or "", "line": row["line_code"], "b": bucket_of(age), "m": age,
+            })
+    return {"id": str(row["id"]), "prev_status": prev, "status": new_status, "age_min": age}
+
+
+async def reset_resolution(db: AsyncSession) -> None:
+    """Après un wipe des reports. Ne commit pas."""
+    await ensure_resolution_schema(db)
+    await db.execute(text("DELETE FROM report_status_events"))
+    await db.execute(text("DELETE FROM resolution_rollups"))
+
+
+# -----------------------------------------------------------------------------
+# Lecture
+# -----------------------------------------------------------------------------
+def _interval(i: int):
+    lo = RESOLUTION_BOUNDS_MIN[i - 1] if i > 0 else 0
+    hi = RESOLUTION_BOUNDS_MIN[i] if i < len(RESOLUTION_BOUNDS_MIN) else None
+    return lo, hi
+
+
+def percentile(counts: Sequence[int], q: float) -> Optional[float]:
+    total = sum(counts)
+    if not total:
+        return None
+    target = q * total
+    acc = 0
+    for i, c in enumerate(counts):
+        if c and acc + c >= target:
+            lo, hi = _interval(i)
+            if hi is None:
+                return float(lo)  # au-delà de la dernière borne : borne basse
+            return round(lo + (hi - lo) * (target - acc) / c, 1)
+        acc += c
+    return float(RESOLUTION_BOUNDS_MIN[-1])
+
+
+def share_within(counts: Sequence[int], minutes: float) -> Optional[float]:
+    total = sum(counts)
+    if not total:
+        return None
+    inside = 0.0
+    for i, c in enumerate(counts):
+        lo, hi = _interval(i)
+        if hi is not None and hi <= minutes:
+            inside += c
+        elif lo < minutes and hi is not None:
+            inside += c * (minutes - lo) / (hi - lo)
+    return round(inside / total, 4)
+
+
+_DIMS = {
+    "all": [],
+    "kind": ["kind"],
+    "line": ["line_code"],
+    "day": ["day"],
+    "kind_day": ["day", "kind"],
+}
+
+
+async def resolution_stats(
+    db: AsyncSession,
+    *,
+    days: int = 30,
+    by: str = "kind",
+    kind: Optional[str] = None,
+    target_min: int = SLA_TARGET_MIN,
+) -> List[Dict[str, Any]]:
+    """Distribution des délais de résolution (minutes) groupée par `by`.
+    Tables pas encore créées (/admin/ensure_schema) → []."""
+    if not await resolution_ready(db):
+        return []
+    dims = _DIMS.get(by, _DIMS["kind"])
+    where = ["day >= CURRENT_DATE - CAST(:days AS int)"]
+    params: Dict[str, Any] = {"days": int(days)}
+    if kind:
+        where.append("LOWER(kind) = LOWER(:k)")
+        params["k"] = kind
+    cols = ", ".join(dims + ["bucket"])
+    rs = await db.execute(text(f"""
+        SELECT {cols}, SUM(n)::int AS n, SUM(sum_min) AS sum_min
+          FROM resolution_rollups
+         WHERE {" AND ".join(where)}
+         GROUP BY {cols}
+    """), params)
+
+    groups: Dict[tuple, Dict[str, Any]] = {}
+    for r in rs.mappings().all():
+        key = tuple(r[d] for d in dims)
+        g = groups.get(key)
+        if g is None:
+            g = groups[key] = {"counts": [0] * (len(RESOLUTION_BOUNDS_MIN) + 1), "sum": 0.0}
+        g["counts"][int(r["bucket"])] += int(r["n"])
+        g["sum"] += float(r["sum_min"] or 0)
+
+    out: List[Dict[str, Any]] = []
+    for key, g in sorted(groups.items(), key=lambda kv: tuple(str(k) for k in kv[0])):
+        n = sum(g["counts"])
+        item: Dict[str, Any] = {d: (str(v) if d == "day" else v) for d, v in zip(dims, key)}
+        item.update({
+            "n": n,
+            "avg_min": round(g["sum"] / n, 1) if n else None,
+            "p50_min": percentile(g["counts"], 0.50),
+            "p90_min": percentile(g["counts"], 0.90),
+            "p99_min": percentile(g["counts"], 0.99),
+            "within_sla": share_within(g["counts"], target_min),
+        })
+        out.append(item)
+    return out
+
+
+async def avg_resolution_min(db: AsyncSession, since: datetime) -> Optional[float]:
+    """Délai moyen des résolutions depuis `since` (au jour près) ; None sans données
+    ou tant que les tables n'existent pas."""
+    if not await resolution_ready(db):
+        return None
+    rs = await db.execute(text("""
+        SELECT SUM(n)::int AS n, SUM(sum_min) AS s
+          FROM resolution_rollups
+         WHERE day >= CAST(:d AS date)
+    """), {"d": since.date()})
+    row = rs.mappings().first()
+    if not row or not row["n"]:
+        return None
+    return round(float(row["s"]) / int(row["n"]), 1)
+
+
+async def open_over_sla(
+    db: AsyncSession, *, days: int = 30, kind: Optional[str] = None, target_min: int = SLA_TARGET_MIN,
+) -> int:
+    """Reports à traiter encore ouverts au-delà de l'objectif (créés dans la fenêtre)."""
+    now = datetime.now(timezone.utc)
+    params: Dict[str, Any] = {"since": now - timedelta(days=days), "limit": now - timedelta(minutes=target_min)}
+    kind_sql = ""
+    if kind:
+        kind_sql = "AND LOWER(kind::text) = LOWER(:k)"
+        params["k"] = kind
+    rs = await db.execute(text(f"""
+        SELECT COUNT(*)::int
+          FROM reports
+         WHERE created_at >= :since
+           AND created_at <  :limit
+           AND LOWER(TRIM(signal::text)) = 'to_clean'
+           AND COALESCE(status, 'new') <> 'resolved'
+           {kind_sql}
+    """), params)
+    return int(rs.scalar() or 0)
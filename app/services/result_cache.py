@@ -0,0 +1,175 @@
+# app/services/result_cache.py
+"""
+Cache de résultats pour les lectures admin lourdes (métriques, file CTA).
+
+- TTL court (RESULT_CACHE_TTL_S) par jeu de paramètres
+- single-flight : des ratés concurrents sur la même clé → un seul calcul,
+  les autres attendent son résultat
+- stale-while-revalidate : pendant RESULT_CACHE_STALE_S après le TTL, la
+  valeur périmée est servie immédiatement et un seul rafraîchissement part
+  en tâche de fond (avec sa propre session : celle de la requête est fermée
+  après la réponse)
+- borné (LRU), invalidable (après une écriture qui change le résultat)
+- compteurs par cache (/admin/http_stats, /internal/metrics)
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Set, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db import AsyncSessionLocal
+from app.services import tracing
+
+# -------- Parameters (override via env if needed) ----------
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "1") != "0"
+RESULT_CACHE_TTL_S   = float(os.getenv("RESULT_CACHE_TTL_S", "10"))
+RESULT_CACHE_STALE_S = float(os.getenv("RESULT_CACHE_STALE_S", "60"))
+RESULT_CACHE_MAX     = int(os.getenv("RESULT_CACHE_MAX", "256"))
+
+Loader = Callable[[AsyncSession], Awaitable[Any]]
+
+_caches: List["ResultCache"] = []
+
+
+class ResultCache:
+    def __init__(self, name: str, ttl_s: float = RESULT_CACHE_TTL_S, stale_s: float = RESULT_CACHE_STALE_S,
+                 max_entries: int = RESULT_CACHE_MAX):
+        self.name = name
+        self.ttl_s = float(ttl_s)
+        self.stale_s = float(stale_s)
+        self.max_entries = max(1, int(max_entries))
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()  # clé → (calculé à, valeur)
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._refreshing: Set[Hashable] = set()
+        self._generation = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.refreshes = 0
+        self.errors = 0
+        _caches.append(self)
+
+    # ------------------------------------------------------------------ LRU
+    def _put(self, key: Hashable, value: Any) -> None:
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def invalidate(self) -> None:
+        """Oublie toutes les valeurs ; un calcul en cours ne sera pas mis en cache."""
+        self._data.clear()
+        self._generation += 1
+
+    # ------------------------------------------------------------------ lecture
+    async def get(self, key: Hashable, loader: Loader, db: AsyncSession) -> Any:
+        """Valeur de `key` ; `loader(db)` calcule le résultat (appelé avec la
+        session de la requête, ou une session dédiée pour un rafraîchissement)."""
+        with tracing.span(f"cache:{self.name}", "cache"):
+            return await self._get(key, loader, db)
+
+    async def _get(self, key: Hashable, loader: Loader, db: AsyncSession) -> Any:
+        if not RESULT_CACHE_ENABLED:
+            return await loader(db)
+
+        entry = self._data.get(key)
+        if entry is not None:
+            age = time.monotonic() - entry[0]
+            if age < self.ttl_s:
+                self.hits += 1
+                self._data.move_to_end(key)
+                return entry[1]
+            if age < self.ttl_s + self.stale_s:
+                self.stale_hits += 1
+                if key not in self._inflight and key not in self._refreshing:
+                    self._refresh_in_background(key, loader)
+                return entry[1]
+
+        fut = self._inflight.get(key)
+        if fut is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                if not fut.cancelled():
+                    raise
+                # calcul partagé abandonné (client parti) : on le relance
+                return await self._load(key, loader, db)
+
+        self.misses += 1
+        return await self._load(key, loader, db)
+
+    async def _load(self, key: Hashable, loader: Loader, db: AsyncSession) -> Any:
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        gen = self._generation
+        try:
+            value = await loader(db)
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except BaseException as e:
+            self.errors += 1
+            if not fut.done():
+                fut.set_exception(e)
+                fut.exception()  # évite « exception never retrieved » sans attente
+            raise
+        else:
+            if gen == self._generation:
+                self._put(key, value)
+            if not fut.done():
+                fut.set_result(value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    def _refresh_in_background(self, key: Hashable, loader: Loader) -> None:
+        async def _run():
+            self.refreshes += 1
+            try:
+                async with AsyncSessionLocal() as db:
+                    await self._load(key, loader, db)
+            except Exception as e:
+                print(f"[result_cache] {self.name} refresh failed: {e}")
+            finally:
+                self._refreshing.discard(key)
+
+        self._refreshing.add(key)
+        task = asyncio.get_running_loop().create_task(_run())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    # ------------------------------------------------------------------ stats
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.stale_hits + self.misses + self.coalesced
+        return {
+            "size": len(self._data),
+            "ttl_s": self.ttl_s,
+            "stale_s": self.stale_s,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "refreshes": self.refreshes,
+            "errors": self.errors,
+            "inflight": len(self._inflight),
+            "hit_ratio": round((self.hits + self.stale_hits + self.coalesced) / lookups, 3) if lookups else None,
+        }
+
+
+def result_cache_stats() -> Dict[str, Any]:
+    return {c.name: c.stats() for c in _caches}
+
+
+def all_result_caches() -> List[ResultCache]:
+    return list(_caches)
+
+
+# caches partagés
+metrics_cache = ResultCache("metrics")
+cta_queue_cache = ResultCache("cta_incidents", ttl_s=float(os.getenv("CTA_CACHE_TTL_S", "5")))
@@ -0,0 +1,314 @@
+# app/services/resumable.py
+"""
+Uploads vidéo reprenables (protocole session/offset inspiré de tus).
+
+- POST   /upload_video/sessions            → crée la session (taille totale annoncée)
+- HEAD|GET /upload_video/sessions/{id}     → offset courant (header Upload-Offset)
+- PATCH  /upload_video/sessions/{id}       → un morceau ; Upload-Offset doit valoir
+                                              l'offset courant, Upload-Checksum optionnel
+                                              ("sha256 <base64>", sha1/md5 acceptés)
+- POST   /upload_video/sessions/{id}/complete → vérifie taille + sha256 global, stocke
+                                              (ou réutilise un blob identique),
+                                              insère dans attachments
+- DELETE /upload_video/sessions/{id}       → abandon
+
+Les morceaux sont écrits directement à leur offset dans un fichier partiel sur
+disque (jamais le fichier entier en mémoire) ; l'état de la session est un petit
+JSON à côté, pour survivre à un redémarrage du process.
+
+Un seul morceau à la fois par session : verrou flock non bloquant sur le
+fichier partiel, valable entre workers d'une même machine (RESUMABLE_DIR
+partagé) et relâché à la fermeture, même si le process meurt ; aucun état
+par session en mémoire.
+"""
+import base64
+import binascii
+import fcntl
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+import uuid
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+
+from fastapi import HTTPException
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect
+
+# -------- Parameters (override via env if needed) ----------
+RESUMABLE_DIR       = os.getenv("RESUMABLE_DIR") or os.path.join(tempfile.gettempdir(), "ayii-resumable")
+RESUMABLE_CHUNK_MAX = int(os.getenv("RESUMABLE_CHUNK_MAX", str(5 * 1024 * 1024)))
+RESUMABLE_TTL_H     = int(os.getenv("RESUMABLE_TTL_H", "24"))
+
+_CHECKSUM_ALGOS = {"sha256", "sha1", "md5"}
+_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+_last_purge = 0.0
+
+
+def _meta_path(sid: str) -> str:
+    return os.path.join(RESUMABLE_DIR, f"{sid}.json")
+
+
+def part_path(sid: str) -> str:
+    return os.path.join(RESUMABLE_DIR, f"{sid}.part")
+
+
+def _write_meta(meta: Dict[str, Any]) -> None:
+    tmp = _meta_path(meta["id"]) + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp, _meta_path(meta["id"]))
+
+
+def _read_meta(sid: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(_meta_path(sid)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _create_files(meta: Dict[str, Any]) -> None:
+    os.makedirs(RESUMABLE_DIR, exist_ok=True)
+    open(part_path(meta["id"]), "wb").close()
+    _write_meta(meta)
+
+
+def _remove_files(sid: str) -> None:
+    for p in (_meta_path(sid), part_path(sid)):
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+
+def _purge_stale_sync(max_age_s: float) -> int:
+    if not os.path.isdir(RESUMABLE_DIR):
+        return 0
+    now = time.time()
+    n = 0
+    for name in os.listdir(RESUMABLE_DIR):
+        if not name.endswith(".json"):
+            continue
+        sid = name[:-5]
+        meta = _read_meta(sid)
+        if meta is None or now - float(meta.get("updated_at", 0)) > max_age_s:
+            _remove_files(sid)
+            n += 1
+    return n
+
+
+async def purge_stale_sessions(force: bool = False) -> int:
+    """Supprime les sessions abandonnées (au plus une passe toutes les 10 min)."""
+    global _last_purge
+    now = time.time()
+    if not force and now - _last_purge < 600:
+        return 0
+    _last_purge = now
+    return await run_in_threadpool(_purge_stale_sync, RESUMABLE_TTL_H * 3600.0)
+
+
+# -----------------------------------------------------------------------------
+# Sessions
+# -----------------------------------------------------------------------------
+async def create_session(
+    *,
+    kind: str,
+    lat: float,
+    lng: float,
+    user_id: Optional[str],
+    report_id: Optional[str],
+    idempotency_key: Optional[str],
+    content_type: str,
+    size: int,
+    sha256: Optional[str],
+    max_bytes: int,
+) -> Dict[str, Any]:
+    if size <= 0:
+        raise HTTPException(status_code=400, detail="empty file")
+    if size > max_bytes:
+        raise HTTPException(status_code=413, detail="video too large")
+    digest = (sha256 or "").strip().lower() or None
+    if digest and not re.fullmatch(r"[0-9a-f]{64}", digest):
+        raise HTTPException(status_code=400, detail="invalid sha256")
+
+    await purge_stale_sessions()
+    now = time.time()
+    meta = {
+        "id": uuid.uuid4().hex,
+        "kind": kind,
+        "lat": float(lat),
+        "lng": float(lng),
+        "user_id": user_id,
+        "report_id": report_id,
+        "idempotency_key": idempotency_key,
+        "content_type": content_type,
+        "size": int(size),
+        "sha256": digest,
+        "offset": 0,
+        "created_at": now,
+        "updated_at": now,
+    }
+    await run_in_threadpool(_create_files, meta)
+    return meta
+
+
+async def get_session(sid: str) -> Dict[str, Any]:
+    sid = (sid or "").strip().lower()
+    if not _ID_RE.match(sid):
+        raise HTTPException(status_code=404, detail="upload session not found")
+    meta = await run_in_threadpool(_read_meta, sid)
+    if meta is None:
+        raise HTTPException(status_code=404, detail="upload session not found")
+    if time.time() - float(meta.get("updated_at", 0)) > RESUMABLE_TTL_H * 3600:
+        await run_in_threadpool(_remove_files, sid)
+        raise HTTPException(status_code=410, detail="upload session expired")
+    return meta
+
+
+async def delete_session(sid: str) -> None:
+    await run_in_threadpool(_remove_files, sid)
+
+
+def session_view(meta: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "session_id": meta["id"],
+        "offset": int(meta["offset"]),
+        "size": int(meta["size"]),
+        "complete": int(meta["offset"]) >= int(meta["size"]),
+        "chunk_max": RESUMABLE_CHUNK_MAX,
+        "expires_at": float(meta["updated_at"]) + RESUMABLE_TTL_H * 3600,
+    }
+
+
+# -----------------------------------------------------------------------------
+# Morceaux
+# -----------------------------------------------------------------------------
+def parse_checksum(header: Optional[str]) -> Optional[Tuple[str, bytes]]:
+    """'sha256 <base64>' (tus) ou 'sha256 <hex>' → (algo, digest)."""
+    if not header:
+        return None
+    parts = header.strip().split(None, 1)
+    if len(parts) != 2 or parts[0].lower() not in _CHECKSUM_ALGOS:
+        raise HTTPException(status_code=400, detail="unsupported Upload-Checksum")
+    algo, value = parts[0].lower(), parts[1].strip()
+    size = hashlib.new(algo).digest_size
+    try:
+        if len(value) == size * 2 and re.fullmatch(r"[0-9a-fA-F]+", value):
+            return algo, bytes.fromhex(value)
+        digest = base64.b64decode(value, validate=True)
+    except (ValueError, binascii.Error):
+        raise HTTPException(status_code=400, detail="invalid Upload-Checksum")
+    if len(digest) != size:
+        raise HTTPException(status_code=400, detail="invalid Upload-Checksum")
+    return algo, digest
+
+
+def _lock_part(path: str):
+    """Ouvre le fichier partiel et le verrouille (flock exclusif, non bloquant).
+    None si un autre morceau est en cours, dans ce process ou un autre worker."""
+    try:
+        fp = open(path, "r+b")
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="upload session not found")
+    try:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        fp.close()
+        return None
+    return fp
+
+
+def _seek_at(fp, offset: int) -> None:
+    fp.truncate(offset)  # octets orphelins d'un crash entre écriture et mise à jour du JSON
+    fp.seek(offset)
+
+
+def _truncate(fp, offset: int) -> None:
+    fp.flush()
+    fp.truncate(offset)
+
+
+async def write_chunk(
+    meta: Dict[str, Any],
+    offset: int,
+    body: AsyncIterator[bytes],
+    checksum: Optional[Tuple[str, bytes]] = None,
+) -> Dict[str, Any]:
+    """Ajoute un morceau à l'offset courant. Rien n'est conservé en cas d'erreur,
+    sauf coupure réseau sur un morceau sans checksum (on garde le reçu).
+    Le JSON est mis à jour avant de relâcher le verrou."""
+    sid = meta["id"]
+    fp = await run_in_threadpool(_lock_part, part_path(sid))
+    if fp is None:
+        raise HTTPException(status_code=409, detail="chunk already in progress")
+    try:
+        meta = await get_session(sid)  # état à jour (autre requête, autre worker, redémarrage)
+        current = int(meta["offset"])
+        if offset != current:
+            raise HTTPException(status_code=409, detail={"error": "offset mismatch", "offset": current})
+
+        remaining = int(meta["size"]) - current
+        hasher = hashlib.new(checksum[0]) if checksum else None
+        written = 0
+        await run_in_threadpool(_seek_at, fp, current)
+        try:
+            async for piece in body:
+                if not piece:
+                    continue
+                written += len(piece)
+                if written > RESUMABLE_CHUNK_MAX:
+                    raise HTTPException(status_code=413, detail="chunk too large")
+                if written > remaining:
+                    raise HTTPException(status_code=413, detail="chunk exceeds declared size")
+                if hasher:
+                    hasher.update(piece)
+                await run_in_threadpool(fp.write, piece)
+            if hasher and hasher.digest() != checksum[1]:
+                # 460 = "Checksum Mismatch" (tus)
+                raise HTTPException(status_code=460, detail="checksum mismatch")
+        except ClientDisconnect:
+            # connexion coupée : sans checksum on garde ce qui est arrivé (reprise au bon offset)
+            if hasher is not None:
+                await run_in_threadpool(_truncate, fp, current)
+                raise
+        except BaseException:
+            await run_in_threadpool(_truncate, fp, current)
+            raise
+        await run_in_threadpool(fp.flush)
+
+        meta["offset"] = current + written
+        meta["updated_at"] = time.time()
+        await run_in_threadpool(_write_meta, meta)
+        return meta
+    finally:
+        await run_in_threadpool(fp.close)  # relâche le verrou
+
+
+# -----------------------------------------------------------------------------
+# Finalisation
+# -----------------------------------------------------------------------------
+def _sha256_file(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+async def verify_complete(meta: Dict[str, Any]) -> Tuple[str, str]:
+    """Taille atteinte + sha256 global (comparé à celui annoncé, s'il y en a un).
+    Renvoie (chemin du fichier assemblé, sha256 hex)."""
+    if int(meta["offset"]) != int(meta["size"]):
+        raise HTTPException(
+            status_code=409,
+            detail={"error": "upload incomplete", "offset": int(meta["offset"]), "size": int(meta["size"])},
+        )
+    path = part_path(meta["id"])
+    digest = await run_in_threadpool(_sha256_file, path)
+    if meta.get("sha256") and digest != meta["sha256"]:
+        raise HTTPException(status_code=460, detail="checksum mismatch")
+    return path, digest
@@ -0,0 +1,368 @@
+# app/services/retention.py
+"""
+Rétention des pièces jointes (49 jours par défaut).
+
+- suppression en base par lots bornés (LIMIT … FOR UPDATE SKIP LOCKED) :
+  plusieurs instances peuvent tourner en parallèle sans se bloquer
+- objets de stockage (fichier servi + variantes + original conservé)
+  supprimés ensuite, en parallèle et avec retries ; un blob partagé par
+  déduplication n'est supprimé que lorsque plus aucune ligne ne référence son URL
+- réconciliation : inventaire du stockage → blobs que plus aucune ligne ne
+  référence (échecs de suppression, uploads interrompus), dry-run par défaut ;
+  comparaison sur le chemin de stockage (path_of des URLs en base : attachments
+  + reports.photo_url), pas sur l'URL, et limitée aux préfixes d'upload des
+  pièces jointes
+- progression / débit exposés via retention_stats()
+"""
+import asyncio
+import os
+import time
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+from urllib.parse import unquote, urlsplit
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.services.ddl import present_columns
+from app.services.media import ensure_media_schema
+from app.services.storage import StorageBackend, get_storage, local_storage, storage_for_url
+
+# -------- Parameters (override via env if needed) ----------
+RETENTION_DAYS           = int(os.getenv("RETENTION_DAYS", "49"))
+RETENTION_BATCH          = int(os.getenv("RETENTION_BATCH", "500"))
+RETENTION_DELETE_CONC    = int(os.getenv("RETENTION_DELETE_CONCURRENCY", "4"))
+RETENTION_DELETE_CHUNK   = int(os.getenv("RETENTION_DELETE_CHUNK", "100"))
+RETENTION_RETRIES        = int(os.getenv("RETENTION_RETRIES", "3"))
+RETENTION_ORPHAN_GRACE_H = int(os.getenv("RETENTION_ORPHAN_GRACE_H", "24"))
+RETENTION_REF_FETCH      = int(os.getenv("RETENTION_REF_FETCH", "5000"))
+
+_DDL = [
+    "CREATE INDEX IF NOT EXISTS idx_attachments_created_at ON attachments (created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_attachments_url ON attachments (url)",
+]
+
+_schema_ready = False
+_run_lock = asyncio.Lock()
+_progress: Dict[str, Any] = {
+    "running": False,
+    "started_at": None,
+    "finished_at": None,
+    "batches": 0,
+    "rows_deleted": 0,
+    "blobs_deleted": 0,
+    "blobs_shared_kept": 0,
+    "blobs_failed": 0,
+    "last_error": None,
+}
+_totals = {"runs": 0, "rows_deleted": 0, "blobs_deleted": 0, "blobs_failed": 0, "orphans_deleted": 0}
+
+
+async def ensure_retention_schema(db: AsyncSession) -> None:
+    global _schema_ready
+    if _schema_ready:
+        return
+    await ensure_media_schema(db)
+    for ddl in _DDL:
+        await db.execute(text(ddl))
+    await db.commit()
+    _schema_ready = True
+
+
+# -----------------------------------------------------------------------------
+# Suppression des objets de stockage
+# -----------------------------------------------------------------------------
+async def _delete_with_retry(backend: StorageBackend, paths: List[str]) -> int:
+    delay = 0.5
+    for attempt in range(RETENTION_RETRIES + 1):
+        try:
+            return await backend.delete(paths)
+        except Exception:
+            if attempt >= RETENTION_RETRIES:
+                raise
+            await asyncio.sleep(delay)
+            delay *= 2
+    return 0
+
+
+async def delete_blobs(urls: Iterable[Optional[str]]) -> Tuple[int, int]:
+    """Supprime les objets (groupés par backend, par paquets, en parallèle).
+    → (supprimés, en échec). Les échecs restent pour la réconciliation."""
+    grouped: Dict[StorageBackend, Set[str]] = defaultdict(set)
+    for u in urls:
+        backend, path = storage_for_url(u)
+        if backend is not None and path:
+            grouped[backend].add(path)
+
+    sem = asyncio.Semaphore(max(1, RETENTION_DELETE_CONC))
+    jobs: List[Tuple[StorageBackend, List[str]]] = []
+    for backend, paths in grouped.items():
+        ordered = sorted(paths)
+        for i in range(0, len(ordered), RETENTION_DELETE_CHUNK):
+            jobs.append((backend, ordered[i:i + RETENTION_DELETE_CHUNK]))
+
+    async def _one(backend: StorageBackend, chunk: List[str]) -> int:
+        async with sem:
+            return await _delete_with_retry(backend, chunk)
+
+    results = await asyncio.gather(*(_one(b, c) for b, c in jobs), return_exceptions=True)
+    deleted = failed = 0
+    for (backend, chunk), res in zip(jobs, results):
+        if isinstance(res, BaseException):
+            failed += len(chunk)
+            _progress["last_error"] = f"{backend.name}: {res}"
+            print(f"[retention] storage delete failed ({backend.name}, {len(chunk)} objets): {res}")
+        else:
+            deleted += int(res or 0)
+    return deleted, failed
+
+
+# -----------------------------------------------------------------------------
+# Purge par lots
+# -----------------------------------------------------------------------------
+_PURGE_SQL = text("""
+    WITH victims AS (
+      SELECT id
+        FROM attachments
+       WHERE created_at < NOW() - make_interval(days => :days)
+       ORDER BY created_at
+       LIMIT :batch
+       FOR UPDATE SKIP LOCKED
+    )
+    DELETE FROM attachments a
+     USING victims v
+     WHERE a.id = v.id
+    RETURNING a.url, a.thumb_url, a.medium_url, a.original_url
+""")
+
+# URLs qui ne sont plus référencées par aucune ligne (après la suppression du lot)
+_UNREFERENCED_SQL = text("""
+    SELECT u
+      FROM unnest(CAST(:urls AS text[])) AS u
+     WHERE NOT EXISTS (SELECT 1 FROM attachments a WHERE a.url = u)
+""")
+
+
+async def purge_batch(db: AsyncSession, batch: int = RETENTION_BATCH, days: int = RETENTION_DAYS) -> Dict[str, int]:
+    """Un lot : DELETE borné + contrôle des références dans la même transaction,
+    commit, puis suppression des blobs devenus orphelins."""
+    await ensure_retention_schema(db)
+    rows = (await db.execute(_PURGE_SQL, {"days": int(days), "batch": int(batch)})).mappings().all()
+    if not rows:
+        await db.commit()
+        return {"rows": 0, "blobs_deleted": 0, "blobs_shared_kept": 0, "blobs_failed": 0}
+
+    # un blob = l'URL servie ; variantes et original conservé suivent le même sort
+    variants: Dict[str, Set[str]] = defaultdict(set)
+    for r in rows:
+        if not r["url"]:
+            continue
+        variants[r["url"]].update(v for v in (r["thumb_url"], r["medium_url"], r["original_url"]) if v)
+
+    free: List[str] = []
+    if variants:
+        rs = await db.execute(_UNREFERENCED_SQL, {"urls": list(variants)})
+        free = [row[0] for row in rs.all()]
+    await db.commit()  # lignes supprimées avant les objets : au pire un orphelin, jamais un lien mort
+
+    targets: List[str] = []
+    for u in free:
+        targets.append(u)
+        targets.extend(variants[u])
+    deleted, failed = await delete_blobs(targets) if targets else (0, 0)
+    return {
+        "rows": len(rows),
+        "blobs_deleted": deleted,
+        "blobs_shared_kept": len(variants) - len(free),
+        "blobs_failed": failed,
+    }
+
+
+async def run_retention(
+    db: AsyncSession,
+    *,
+    batch: int = RETENTION_BATCH,
+    max_batches: int = 0,
+    max_seconds: float = 0,
+    days: int = RETENTION_DAYS,
+) -> Dict[str, Any]:
+    """Enchaîne les lots jusqu'à épuisement (ou max_batches / max_seconds)."""
+    if _run_lock.locked():
+        return {"busy": True, **retention_stats()}
+    async with _run_lock:
+        t0 = time.time()
+        _progress.update({
+            "running": True, "started_at": t0, "finished_at": None, "batches": 0,
+            "rows_deleted": 0, "blobs_deleted": 0, "blobs_shared_kept": 0, "blobs_failed": 0,
+            "last_error": None,
+        })
+        try:
+            while True:
+                res = await purge_batch(db, batch=batch, days=days)
+                _progress["batches"] += 1
+                _progress["rows_deleted"] += res["rows"]
+                _progress["blobs_deleted"] += res["blobs_deleted"]
+                _progress["blobs_shared_kept"] += res["blobs_shared_kept"]
+                _progress["blobs_failed"] += res["blobs_failed"]
+                if res["rows"] < batch:
+                    break
+                if max_batches and _progress["batches"] >= max_batches:
+                    break
+                if max_seconds and time.time() - t0 >= max_seconds:
+                    break
+        except Exception as e:
+            await db.rollback()
+            _progress["last_error"] = str(e)
+            raise
+        finally:
+            _progress["running"] = False
+            _progress["finished_at"] = time.time()
+            _totals["runs"] += 1
+            _totals["rows_deleted"] += _progress["rows_deleted"]
+            _totals["blobs_deleted"] += _progress["blobs_deleted"]
+            _totals["blobs_failed"] += _progress["blobs_failed"]
+        return retention_stats()
+
+
+# -----------------------------------------------------------------------------
+# Réconciliation des blobs orphelins
+# -----------------------------------------------------------------------------
+# toutes les URLs stockées (un seul parcours, curseur serveur) ; colonnes
+# optionnelles des pièces jointes ajoutées si présentes
+_REF_COLUMNS = ("url", "thumb_url", "medium_url", "original_url")
+
+
+def _url_tails(url: str) -> Set[str]:
+    """Suffixes du chemin d'une URL de forme inconnue (ancienne URL signée…) :
+    un objet listé dont le chemin en est un suffixe est considéré référencé."""
+    parts = [unquote(p) for p in urlsplit(url).path.split("/") if p]
+    return {"/".join(parts[i:]) for i in range(len(parts))}
+
+
+async def _referenced_paths(db: AsyncSession, backends: List[StorageBackend]) -> Tuple[Dict[StorageBackend, Set[str]], Set[str], int]:
+    """URLs en base → (chemins par backend, suffixes des URLs non reconnues, nb d'URLs)."""
+    cols = [c for c in _REF_COLUMNS if c in await present_columns(db, "attachments", _REF_COLUMNS)]
+    selects = [f"SELECT {c} AS u FROM attachments WHERE {c} IS NOT NULL" for c in cols]
+    if "photo_url" in await present_columns(db, "reports", ("photo_url",)):
+        selects.append("SELECT photo_url AS u FROM reports WHERE photo_url IS NOT NULL AND photo_url <> ''")
+
+    paths: Dict[StorageBackend, Set[str]] = {b: set() for b in backends}
+    tails: Set[str] = set()
+    n = 0
+    result = await db.stream(text(" UNION ALL ".join(selects)), execution_options={"yield_per": RETENTION_REF_FETCH})
+    async for part in result.partitions():
+        for (u,) in part:
+            n += 1
+            known = False
+            for b in backends:
+                p = b.path_of(u)
+                if p:
+                    paths[b].add(p)
+                    known = True
+            if not known:
+                tails |= _url_tails(u)
+    return paths, tails, n
+
+
+def _scan_prefixes(prefix: str, upload_prefixes: Iterable[str]) -> List[str]:
+    """Préfixes parcourus : ceux des uploads de pièces jointes (<kind>/…),
+    restreints à `prefix` s'il est fourni."""
+    allowed = sorted({p.strip("/") for p in upload_prefixes if p and p.strip("/")})
+    prefix = (prefix or "").strip("/")
+    if not prefix:
+        return allowed
+    if prefix.split("/", 1)[0] not in allowed:
+        raise ValueError(f"prefix outside attachment uploads: {prefix!r}")
+    return [prefix]
+
+
+async def reconcile_orphans(
+    db: AsyncSession,
+    *,
+    upload_prefixes: Iterable[str],
+    dry_run: bool = True,
+    prefix: str = "",
+    max_objects: int = 0,
+    grace_hours: int = RETENTION_ORPHAN_GRACE_H,
+) -> Dict[str, Any]:
+    """Parcourt les préfixes d'upload du stockage et supprime (hors dry_run) les
+    objets dont le chemin n'est celui d'aucune URL en base. Les objets récents
+    (< grace_hours) sont ignorés : upload ou génération de variantes peut-être
+    encore en cours (et absents de l'instantané des références, pris avant)."""
+    await ensure_retention_schema(db)
+    t0 = time.time()
+    cutoff = t0 - grace_hours * 3600
+    scan = _scan_prefixes(prefix, upload_prefixes)
+    backends: List[StorageBackend] = [get_storage()]
+    if local_storage() is not backends[0]:
+        backends.append(local_storage())  # repli disque des uploads vidéo
+
+    referenced, tails, n_refs = await _referenced_paths(db, backends)
+    await db.commit()  # fin du curseur : pas de transaction ouverte pendant l'inventaire
+
+    scanned = orphans = deleted = failed = 0
+    sample: List[str] = []
+    for backend in backends:
+        for pfx in scan:
+            async for page in backend.list(pfx):
+                scanned += len(page)
+                lost = [
+                    p for p, mtime in page
+                    if mtime < cutoff and p not in referenced[backend] and p not in tails
+                ]
+                orphans += len(lost)
+                sample.extend(backend.public_url(p) for p in lost[: max(0, 20 - len(sample))])
+                if lost and not dry_run:
+                    n_ok, n_ko = await _delete_paths(backend, lost)
+                    deleted += n_ok
+                    failed += n_ko
+                if max_objects and scanned >= max_objects:
+                    break
+            if max_objects and scanned >= max_objects:
+                break
+        if max_objects and scanned >= max_objects:
+            break
+
+    _totals["orphans_deleted"] += deleted
+    dt = time.time() - t0
+    return {
+        "dry_run": dry_run,
+        "prefixes": scan,
+        "referenced_urls": n_refs,
+        "scanned": scanned,
+        "orphans": orphans,
+        "deleted": deleted,
+        "failed": failed,
+        "sample": sample,
+        "elapsed_s": round(dt, 2),
+        "objects_per_s": round(scanned / dt, 1) if dt > 0 else None,
+    }
+
+
+async def _delete_paths(backend: StorageBackend, paths: List[str]) -> Tuple[int, int]:
+    """Suppression par chemins dans un backend donné → (supprimés, en échec)."""
+    deleted = failed = 0
+    for i in range(0, len(paths), RETENTION_DELETE_CHUNK):
+        chunk = paths[i:i + RETENTION_DELETE_CHUNK]
+        try:
+            deleted += int(await _delete_with_retry(backend, chunk) or 0)
+        except Exception as e:
+            failed += len(chunk)
+            _progress["last_error"] = f"{backend.name}: {e}"
+            print(f"[retention] storage delete failed ({backend.name}, {len(chunk)} objets): {e}")
+    return deleted, failed
+
+
+def retention_stats() -> Dict[str, Any]:
+    p = dict(_progress)
+    if p["started_at"]:
+        dt = (p["finished_at"] or time.time()) - p["started_at"]
+        p["elapsed_s"] = round(dt, 2)
+        p["rows_per_s"] = round(p["rows_deleted"] / dt, 1) if dt > 0 else None
+        p["blobs_per_s"] = round(p["blobs_deleted"] / dt, 1) if dt > 0 else None
+    return {
+        "progress": p,
+        "totals": dict(_totals),
+        "retention_days": RETENTION_DAYS,
+        "batch": RETENTION_BATCH,
+    }
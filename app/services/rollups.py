@@ -0,0 +1,509 @@
+# app/services/rollups.py
+"""
+Agrégats horaires matérialisés pour les métriques et l'export agrégé.
+
+- `report_rollups` : une ligne par (heure, kind, signal, status, line_code) → n
+- `event_rollups`  : une ligne par (heure de début, table, kind, status) → n,
+  nombre d'événements clos, somme / min / max des durées (minutes)
+- maintenance incrémentale (étape de run_aggregation) : les heures closes
+  depuis le filigrane (`rollup_state.done_until`) sont calculées, et une fenêtre
+  récente est recalculée à chaque passage (changements de status, clôtures)
+- hook d'écriture : un changement de status d'un report plus ancien que la
+  fenêtre recalcule son heure
+- événements plus anciens que la fenêtre : restored_at est écrit à de nombreux
+  endroits (crud, admin, /map, agrégation, réouvertures), souvent en UPDATE de
+  masse ; plutôt qu'un hook par site, chaque passage recalcule les heures figées
+  touchées depuis le passage précédent :
+    · restored_at postérieur au filigrane `events_restored` (clôtures, re-datations)
+    · nombre d'actifs par heure ≠ agrégat (réouvertures : restored_at → NULL)
+- lecture : agrégats pour les heures entières de l'intervalle, lignes brutes
+  pour les bords (heure partielle de début / fin) et pour ce qui est plus
+  récent que le filigrane → résultat exact, sans balayer l'historique ;
+  tables pas encore créées (/admin/ensure_schema, scheduler) → tout en brut
+
+Les agrégats survivent aux purges de reports au-delà de la fenêtre de
+recalcul (l'historique des métriques reste disponible) ; /admin/rollups/rebuild
+recalcule une plage à la demande.
+"""
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# -------- Parameters (override via env if needed) ----------
+LOG_AGG = os.getenv("LOG_AGG", "0") == "1"
+
+# Fenêtre recalculée à chaque passage (heures)
+ROLLUP_RECHECK_H       = int(os.getenv("ROLLUP_RECHECK_H", "48"))
+ROLLUP_EVENT_RECHECK_H = int(os.getenv("ROLLUP_EVENT_RECHECK_H", "72"))
+# Taille d'une tranche de calcul (heures) et budget par passage (secondes)
+ROLLUP_STEP_H          = int(os.getenv("ROLLUP_STEP_H", "168"))
+ROLLUP_MAX_SECONDS     = float(os.getenv("ROLLUP_MAX_SECONDS", "20"))
+# Recouvrement du filigrane restored_at (transactions encore ouvertes au passage précédent)
+ROLLUP_RESTORED_LAG_MIN = int(os.getenv("ROLLUP_RESTORED_LAG_MIN", "15"))
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_FAR   = datetime(9999, 1, 1, tzinfo=timezone.utc)
+_HOUR  = timedelta(hours=1)
+
+EVENT_TABLES = ("incidents", "outages")
+
+_DDL = [
+    "ALTER TABLE reports ADD COLUMN IF NOT EXISTS status text",
+    "ALTER TABLE incidents ADD COLUMN IF NOT EXISTS restored_at timestamp NULL",
+    "ALTER TABLE outages   ADD COLUMN IF NOT EXISTS restored_at timestamp NULL",
+    """
+    CREATE TABLE IF NOT EXISTS report_rollups (
+      bucket    timestamptz NOT NULL,
+      kind      text        NOT NULL,
+      signal    text        NOT NULL,
+      status    text        NOT NULL,
+      line_code text        NOT NULL,
+      n         integer     NOT NULL,
+      PRIMARY KEY (bucket, kind, signal, status, line_code)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS event_rollups (
+      bucket  timestamptz      NOT NULL,
+      tbl     text             NOT NULL,
+      kind    text             NOT NULL,
+      status  text             NOT NULL,
+      n       integer          NOT NULL,
+      dur_n   integer          NOT NULL,
+      dur_sum double precision NOT NULL,
+      dur_min double precision NULL,
+      dur_max double precision NULL,
+      PRIMARY KEY (bucket, tbl, kind, status)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rollup_state (
+      name       text        PRIMARY KEY,
+      done_until timestamptz NOT NULL,
+      updated_at timestamptz NOT NULL DEFAULT NOW()
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_reports_created_at ON reports (created_at)",
+    "CREATE INDEX IF NOT EXISTS idx_incidents_started_at ON incidents (started_at)",
+    "CREATE INDEX IF NOT EXISTS idx_outages_started_at ON outages (started_at)",
+    "CREATE INDEX IF NOT EXISTS idx_incidents_restored_at ON incidents (restored_at)",
+    "CREATE INDEX IF NOT EXISTS idx_outages_restored_at ON outages (restored_at)",
+]
+
+_schema_ready = False
+_tables_ready = False  # sonde hooks/lectures, distincte : ne court-circuite pas le DDL
+_stats: Dict[str, Any] = {
+    "passes": 0,
+    "hours_built": 0,
+    "hooks": 0,
+    "event_hours_refreshed": 0,
+    "errors": 0,
+    "last_error": None,
+    "last_pass_s": None,
+}
+
+
+async def ensure_rollups_schema(db: AsyncSession) -> None:
+    """DDL + commit : /admin/ensure_schema, scheduler et endpoints admin."""
+    global _schema_ready, _tables_ready
+    if _schema_ready:
+        return
+    for ddl in _DDL:
+        await db.execute(text(ddl))
+    await db.commit()
+    _schema_ready = _tables_ready = True
+
+
+async def rollups_ready(db: AsyncSession) -> bool:
+    """Tables présentes ? (hooks d'écriture, lectures /metrics : ni DDL ni commit)."""
+    global _tables_ready
+    if not _tables_ready and (await db.execute(text("SELECT to_regclass('rollup_state') IS NOT NULL"))).scalar():
+        _tables_ready = True
+    return _tables_ready
+
+
+def _aware(dt: datetime) -> datetime:
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+def _floor_hour(dt: datetime) -> datetime:
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+def _ceil_hour(dt: datetime) -> datetime:
+    f = _floor_hour(dt)
+    return f if f == dt else f + _HOUR
+
+
+# -----------------------------------------------------------------------------
+# Calcul des agrégats
+# -----------------------------------------------------------------------------
+_REPORT_SRC = """
+    SELECT date_trunc('hour', created_at)  AS bucket,
+           kind::text                      AS kind,
+           LOWER(TRIM(signal::text))       AS signal,
+           COALESCE(status, 'new')         AS status,
+           COALESCE(line_code, '')         AS line_code
+      FROM reports
+"""
+
+_EVENT_SRC = """
+    SELECT date_trunc('hour', started_at)  AS bucket,
+           '{tbl}'                         AS tbl,
+           kind::text                      AS kind,
+           CASE WHEN restored_at IS NULL THEN 'active' ELSE 'restored' END AS status,
+           EXTRACT(EPOCH FROM (restored_at - started_at)) / 60.0 AS dur
+      FROM {tbl}
+"""
+
+_BUILD_REPORTS = text(f"""
+    INSERT INTO report_rollups (bucket, kind, signal, status, line_code, n)
+    SELECT bucket, kind, signal, status, line_code, COUNT(*)::int
+      FROM ({_REPORT_SRC}
+             WHERE created_at >= CAST(:r0 AS timestamptz) AND created_at < CAST(:r1 AS timestamptz)) s
+     GROUP BY 1, 2, 3, 4, 5
+""")
+
+_BUILD_EVENTS = [
+    text(f"""
+        INSERT INTO event_rollups (bucket, tbl, kind, status, n, dur_n, dur_sum, dur_min, dur_max)
+        SELECT bucket, tbl, kind, status,
+               COUNT(*)::int, COUNT(dur)::int, COALESCE(SUM(dur), 0), MIN(dur), MAX(dur)
+          FROM ({_EVENT_SRC.format(tbl=tbl)}
+                 WHERE started_at >= CAST(:r0 AS timestamptz) AND started_at < CAST(:r1 AS timestamptz)) s
+         GROUP BY 1, 2, 3, 4
+    """)
+    for tbl in EVENT_TABLES
+]
+
+
+async def _rebuild_range(db: AsyncSession, name: str, r0: datetime, r1: datetime) -> None:
+    """Remplace les agrégats des heures [r0, r1). Ne commit pas."""
+    params = {"r0": r0, "r1": r1}
+    if name == "reports":
+        await db.execute(text("""
+            DELETE FROM report_rollups
+             WHERE bucket >= CAST(:r0 AS timestamptz) AND bucket < CAST(:r1 AS timestamptz)
+        """), params)
+        await db.execute(_BUILD_REPORTS, params)
+    else:
+        await db.execute(text("""
+            DELETE FROM event_rollups
+             WHERE bucket >= CAST(:r0 AS timestamptz) AND bucket < CAST(:r1 AS timestamptz)
+        """), params)
+        for q in _BUILD_EVENTS:
+            await db.execute(q, params)
+
+
+async def _done_until(db: AsyncSession, name: str) -> Optional[datetime]:
+    rs = await db.execute(text("SELECT done_until FROM rollup_state WHERE name = :n"), {"n": name})
+    return rs.scalar_one_or_none()
+
+
+async def _set_done_until(db: AsyncSession, name: str, until: datetime) -> None:
+    await db.execute(text("""
+        INSERT INTO rollup_state (name, done_until, updated_at)
+        VALUES (:n, :u, NOW())
+        ON CONFLICT (name) DO UPDATE
+           SET done_until = GREATEST(rollup_state.done_until, EXCLUDED.done_until),
+               updated_at = NOW()
+    """), {"n": name, "u": until})
+
+
+async def _first_hour(db: AsyncSession, name: str) -> Optional[datetime]:
+    if name == "reports":
+        sql = "SELECT MIN(created_at) FROM reports"
+    else:
+        sql = " UNION ALL ".join(f"SELECT MIN(started_at) FROM {t}" for t in EVENT_TABLES)
+        sql = f"SELECT MIN(m) FROM ({sql}) x(m)"
+    first = (await db.execute(text(sql))).scalar()
+    if first is None:
+        return None
+    return _floor_hour(_aware(first))
+
+
+async def _advance(db: AsyncSession, name: str, recheck_h: int, deadline: float) -> int:
+    """Calcule les heures closes depuis le filigrane (moins la fenêtre de recalcul)."""
+    now_h = _floor_hour(datetime.now(timezone.utc))
+    done = await _done_until(db, name)
+    if done is None:
+        start = await _first_hour(db, name)
+        if start is None:
+            await _set_done_until(db, name, now_h)
+            await db.commit()
+            return 0
+    else:
+        start = min(done, now_h) - timedelta(hours=recheck_h)
+
+    hours = 0
+    while start < now_h:
+        end = min(start + timedelta(hours=ROLLUP_STEP_H), now_h)
+        await _rebuild_range(db, name, start, end)
+        await _set_done_until(db, name, end)
+        await db.commit()
+        hours += int((end - start) / _HOUR)
+        start = end
+        if time.time() >= deadline:
+            break
+    return hours
+
+
+async def _changed_event_hours(db: AsyncSession, frozen: datetime) -> List[datetime]:
+    """Heures figées (< frozen) dont un événement a changé depuis le passage précédent."""
+    hours = set()
+    mark = await _done_until(db, "events_restored")
+    if mark is not None:
+        # clôtures / re-datations : restored_at récent (index sur restored_at)
+        for tbl in EVENT_TABLES:
+            rs = await db.execute(text(f"""
+                SELECT DISTINCT CAST(date_trunc('hour', started_at) AS timestamptz)
+                  FROM {tbl}
+                 WHERE restored_at > CAST(:mark AS timestamptz) - make_interval(mins => :lag)
+                   AND started_at < CAST(:frozen AS timestamptz)
+            """), {"mark": mark, "lag": ROLLUP_RESTORED_LAG_MIN, "frozen": frozen})
+            hours.update(_aware(r[0]) for r in rs.fetchall() if r[0] is not None)
+
+    # réouvertures (restored_at → NULL) et clôtures manquées : actifs par heure,
+    # source vs agrégat (peu de lignes des deux côtés)
+    src = " UNION ALL ".join(
+        f"""SELECT CAST(date_trunc('hour', started_at) AS timestamptz) AS bucket, '{tbl}' AS tbl, COUNT(*)::int AS n
+              FROM {tbl}
+             WHERE restored_at IS NULL AND started_at < CAST(:frozen AS timestamptz)
+             GROUP BY 1"""
+        for tbl in EVENT_TABLES
+    )
+    rs = await db.execute(text(f"""
+        WITH src AS ({src}),
+        agg AS (
+          SELECT bucket, tbl, SUM(n)::int AS n
+            FROM event_rollups
+           WHERE status = 'active' AND bucket < CAST(:frozen AS timestamptz)
+           GROUP BY 1, 2
+        )
+        SELECT COALESCE(s.bucket, a.bucket) AS bucket
+          FROM src s
+          FULL JOIN agg a ON a.bucket = s.bucket AND a.tbl = s.tbl
+         WHERE COALESCE(s.n, 0) <> COALESCE(a.n, 0)
+    """), {"frozen": frozen})
+    hours.update(_aware(r[0]) for r in rs.fetchall() if r[0] is not None)
+    return sorted(hours)
+
+
+async def _refresh_changed_events(db: AsyncSession) -> int:
+    """Recalcule les heures d'événements hors fenêtre de recalcul touchées
+    depuis le passage précédent, puis avance le filigrane restored_at."""
+    done = await _done_until(db, "events")
+    if done is None:
+        return 0
+    frozen = done - timedelta(hours=ROLLUP_EVENT_RECHECK_H)
+    # filigrane lu avant le recalcul : une clôture concurrente sera revue au passage suivant
+    latest = (await db.execute(text(
+        "SELECT MAX(m) FROM (" + " UNION ALL ".join(
+            f"SELECT CAST(MAX(restored_at) AS timestamptz) FROM {t}" for t in EVENT_TABLES
+        ) + ") x(m)"
+    ))).scalar()
+    hours = await _changed_event_hours(db, frozen)
+    for h in hours:
+        await _rebuild_range(db, "events", h, h + _HOUR)
+    if latest is not None:
+        await _set_done_until(db, "events_restored", latest)
+    await db.commit()
+    _stats["event_hours_refreshed"] += len(hours)
+    return len(hours)
+
+
+async def maintain_rollups(db: AsyncSession, max_seconds: float = ROLLUP_MAX_SECONDS) -> None:
+    """Étape de run_aggregation : avance les agrégats reports puis événements.
+    Un premier passage sur une base existante construit l'historique par
+    tranches de ROLLUP_STEP_H, en reprenant au passage suivant si le budget est épuisé."""
+    t0 = time.time()
+    try:
+        await ensure_rollups_schema(db)
+        built = await _advance(db, "reports", ROLLUP_RECHECK_H, t0 + max_seconds)
+        built += await _advance(db, "events", ROLLUP_EVENT_RECHECK_H, t0 + max_seconds)
+        built += await _refresh_changed_events(db)
+        _stats["passes"] += 1
+        _stats["hours_built"] += built
+        if LOG_AGG:
+            print(f"[agg] rollups -> {built} h recalculées")
+    except Exception as e:
+        await db.rollback()
+        _stats["errors"] += 1
+        _stats["last_error"] = str(e)
+        print(f"[rollups] maintain error: {e}")
+    finally:
+        _stats["last_pass_s"] = round(time.time() - t0, 3)
+
+
+async def rebuild_rollups(
+    db: AsyncSession,
+    *,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+) -> Dict[str, Any]:
+    """Recalcule les agrégats d'une plage (défaut : tout l'historique jusqu'au filigrane)."""
+    await ensure_rollups_schema(db)
+    out: Dict[str, Any] = {}
+    for name in ("reports", "events"):
+        done = await _done_until(db, name)
+        r0 = _floor_hour(_aware(since)) if since else (await _first_hour(db, name))
+        r1 = min(_ceil_hour(_aware(until)), done) if (until and done) else done
+        if r0 is None or r1 is None or r0 >= r1:
+            out[name] = 0
+            continue
+        hours = 0
+        start = r0
+        while start < r1:
+            end = min(start + timedelta(hours=ROLLUP_STEP_H), r1)
+            await _rebuild_range(db, name, start, end)
+            await db.commit()
+            hours += int((end - start) / _HOUR)
+            start = end
+        out[name] = hours
+    _stats["hours_built"] += sum(out.values())
+    return {"hours": out}
+
+
+async def reset_rollups(db: AsyncSession) -> None:
+    """Après un wipe des tables sources. Ne commit pas."""
+    await ensure_rollups_schema(db)
+    await db.execute(text("DELETE FROM report_rollups"))
+    await db.execute(text("DELETE FROM event_rollups"))
+    await db.execute(text("DELETE FROM rollup_state"))
+
+
+async def refresh_report_rollup_for(db: AsyncSession, report_id: str) -> None:
+    """Hook après changement de status (transaction de l'appelant déjà validée) :
+    recalcule l'heure du report si elle est déjà figée (plus ancienne que la
+    fenêtre de recalcul). Tables absentes → rien (le scheduler les créera)."""
+    if not await rollups_ready(db):
+        return
+    rs = await db.execute(text("""
+        SELECT date_trunc('hour', r.created_at) AS bucket, s.done_until
+          FROM reports r
+          LEFT JOIN rollup_state s ON s.name = 'reports'
+         WHERE r.id = CAST(:id AS uuid)
+    """), {"id": report_id})
+    row = rs.first()
+    if not row or row.bucket is None or row.done_until is None:
+        return
+    bucket = _aware(row.bucket)
+    if bucket + _HOUR > row.done_until:
+        return  # encore lu en brut
+    await _rebuild_range(db, "reports", bucket, bucket + _HOUR)
+    await db.commit()
+    _stats["hooks"] += 1
+
+
+# -----------------------------------------------------------------------------
+# Lecture
+# -----------------------------------------------------------------------------
+def _split(
+    done: Optional[datetime], since: Optional[datetime], until: Optional[datetime],
+) -> Dict[str, datetime]:
+    """Heures entières [r0, r1) lues dans les agrégats ; [since, r0) et [r1, until]
+    lus dans la table source."""
+    since = _aware(since) if since else _EPOCH
+    until = _aware(until) if until else _FAR
+    r0 = _ceil_hour(since)
+    r1 = min(done or _EPOCH, _floor_hour(until))
+    if r1 < r0:
+        r1 = r0
+    return {"since": since, "until": until, "r0": r0, "r1": r1}
+
+
+async def report_counts(
+    db: AsyncSession,
+    dims: Sequence[Tuple[str, str]],
+    *,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    where: Sequence[str] = (),
+    params: Optional[Dict[str, Any]] = None,
+    order: str = "",
+) -> List[Dict[str, Any]]:
+    """COUNT(*) des reports groupé par `dims` ((alias, expression) sur les colonnes
+    bucket / kind / signal / status / line_code). `where` porte sur ces mêmes colonnes."""
+    ready = await rollups_ready(db)
+    p = {**(params or {}), **_split(await _done_until(db, "reports") if ready else None, since, until)}
+    agg = """
+          SELECT bucket, kind, signal, status, line_code, n
+            FROM report_rollups
+           WHERE bucket >= CAST(:r0 AS timestamptz) AND bucket < CAST(:r1 AS timestamptz)
+          UNION ALL""" if ready else ""
+    cols = ", ".join(f"{expr} AS {alias}" for alias, expr in dims)
+    group = ", ".join(str(i + 1) for i in range(len(dims)))
+    cond = " AND ".join(where) if where else "TRUE"
+    q = text(f"""
+        WITH src AS ({agg}
+          SELECT bucket, kind, signal, status, line_code, 1
+            FROM ({_REPORT_SRC}
+                   WHERE (created_at >= CAST(:since AS timestamptz) AND created_at < CAST(:r0 AS timestamptz))
+                      OR (created_at >= CAST(:r1 AS timestamptz) AND created_at <= CAST(:until AS timestamptz))) raw
+        )
+        SELECT {cols + ", " if cols else ""}COALESCE(SUM(n), 0)::int AS n
+          FROM src
+         WHERE {cond}
+         {"GROUP BY " + group if dims else ""}
+         {"ORDER BY " + (order or group) if dims else ""}
+    """)
+    return [dict(r) for r in (await db.execute(q, p)).mappings().all()]
+
+
+async def event_stats(
+    db: AsyncSession,
+    dims: Sequence[Tuple[str, str]],
+    *,
+    tables: Sequence[str] = EVENT_TABLES,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    where: Sequence[str] = (),
+    params: Optional[Dict[str, Any]] = None,
+) -> List[Dict[str, Any]]:
+    """Événements (incidents / outages) groupés par `dims` sur les colonnes
+    bucket / tbl / kind / status → n, dur_n, dur_sum, dur_min, dur_max (minutes)."""
+    tables = [t for t in tables if t in EVENT_TABLES]
+    if not tables:
+        return []
+    ready = await rollups_ready(db)
+    p = {**(params or {}), **_split(await _done_until(db, "events") if ready else None, since, until), "tbls": list(tables)}
+    agg = """
+          SELECT bucket, tbl, kind, status, n, dur_n, dur_sum, dur_min, dur_max
+            FROM event_rollups
+           WHERE bucket >= CAST(:r0 AS timestamptz) AND bucket < CAST(:r1 AS timestamptz)
+             AND tbl = ANY(:tbls)
+          UNION ALL""" if ready else ""
+    raw = " UNION ALL ".join(
+        f"""SELECT bucket, tbl, kind, status, 1, (dur IS NOT NULL)::int, COALESCE(dur, 0), dur, dur
+              FROM ({_EVENT_SRC.format(tbl=t)}
+                     WHERE (started_at >= CAST(:since AS timestamptz) AND started_at < CAST(:r0 AS timestamptz))
+                        OR (started_at >= CAST(:r1 AS timestamptz) AND started_at <= CAST(:until AS timestamptz))) raw_{t}"""
+        for t in tables
+    )
+    cols = ", ".join(f"{expr} AS {alias}" for alias, expr in dims)
+    group = ", ".join(str(i + 1) for i in range(len(dims)))
+    cond = " AND ".join(where) if where else "TRUE"
+    q = text(f"""
+        WITH src (bucket, tbl, kind, status, n, dur_n, dur_sum, dur_min, dur_max) AS ({agg}
+          {raw}
+        )
+        SELECT {cols + "," if cols else ""}
+               SUM(n)::int AS n, SUM(dur_n)::int AS dur_n, SUM(dur_sum) AS dur_sum,
+               MIN(dur_min) AS dur_min, MAX(dur_max) AS dur_max
+          FROM src
+         WHERE {cond}
+         {"GROUP BY " + group + " ORDER BY " + group if dims else ""}
+    """)
+    return [dict(r) for r in (await db.execute(q, p)).mappings().all()]
+
+
+def rollups_stats() -> Dict[str, Any]:
+    return {
+        **_stats,
+        "recheck_h": ROLLUP_RECHECK_H,
+        "event_recheck_h": ROLLUP_EVENT_RECHECK_H,
+    }
@@ -0,0 +1,253 @@
+# app/services/signed_cache.py
+"""
+Cache partagé des URLs signées (map, admin_cta, cta).
+
+- borné (SIGNED_CACHE_MAX entrées) avec éviction LRU
+- TTL dérivé de l'expiration du lien (on ne sert jamais un lien qui expire
+  dans moins de SIGNED_CACHE_MARGIN_S secondes)
+- single-flight : des ratés concurrents sur la même clé → un seul appel de signature
+- compteurs hits / misses / evictions / coalesced
+- persistance optionnelle (SIGNED_URL_PERSIST=1) dans attachments.signed_url
+  pour survivre aux redémarrages : lecture sur une session courte dédiée,
+  écriture en tâche de fond (jamais dans la transaction de l'appelant) ;
+  colonnes créées par /admin/ensure_schema, ignorées tant qu'elles manquent
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db import AsyncSessionLocal
+from app.services import tracing
+from app.services.ddl import present_columns
+from app.services.storage import get_storage
+
+# -------- Parameters (override via env if needed) ----------
+SIGNED_CACHE_MAX      = int(os.getenv("SIGNED_CACHE_MAX", "5000"))
+SIGNED_CACHE_MARGIN_S = int(os.getenv("SIGNED_CACHE_MARGIN_S", "30"))
+SIGNED_URL_PERSIST    = os.getenv("SIGNED_URL_PERSIST", "0") == "1"
+
+_Key = Tuple[str, int]  # (url brute, durée du lien)
+
+_DDL = [
+    "ALTER TABLE attachments ADD COLUMN IF NOT EXISTS signed_url text NULL",
+    "ALTER TABLE attachments ADD COLUMN IF NOT EXISTS signed_url_expires_at timestamptz NULL",
+]
+
+_schema_ready = False
+_tasks: Set[asyncio.Task] = set()
+
+
+async def ensure_signed_url_schema(db: AsyncSession) -> None:
+    """DDL + commit : /admin/ensure_schema uniquement."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    for ddl in _DDL:
+        await db.execute(text(ddl))
+    await db.commit()
+    _schema_ready = True
+
+
+async def _persist_ready(db: AsyncSession) -> bool:
+    cols = ("signed_url", "signed_url_expires_at")
+    return len(await present_columns(db, "attachments", cols)) == len(cols)
+
+
+class SignedUrlCache:
+    def __init__(self, max_entries: int, margin_s: int):
+        self.max_entries = max(1, int(max_entries))
+        self.margin_s = max(0, int(margin_s))
+        self._data: "OrderedDict[_Key, Tuple[float, str]]" = OrderedDict()
+        self._inflight: Dict[_Key, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+        self.coalesced = 0
+        self.persisted_hits = 0
+
+    def _ttl(self, link_ttl_sec: int) -> int:
+        # au moins la moitié de la durée du lien si la marge est trop grande
+        return max(link_ttl_sec // 2, link_ttl_sec - self.margin_s)
+
+    # ------------------------------------------------------------------ LRU
+    def _get(self, key: _Key, now: float) -> Optional[str]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if now >= entry[0]:
+            del self._data[key]
+            self.expired += 1
+            return None
+        self._data.move_to_end(key)
+        return entry[1]
+
+    def _put(self, key: _Key, signed: str, expires_at: float) -> None:
+        self._data[key] = (expires_at, signed)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    # ------------------------------------------------------------------ lecture
+    async def get_many(
+        self,
+        urls: Iterable[Optional[str]],
+        link_ttl_sec: int = 300,
+        db: Optional[AsyncSession] = None,
+    ) -> Dict[str, Optional[str]]:
+        """{url brute: url signée | None}. Les ratés sont signés en un seul lot."""
+        with tracing.span("cache:signed_url", "cache"):
+            return await self._get_many(urls, link_ttl_sec, db)
+
+    async def _get_many(
+        self,
+        urls: Iterable[Optional[str]],
+        link_ttl_sec: int,
+        db: Optional[AsyncSession],
+    ) -> Dict[str, Optional[str]]:
+        link_ttl_sec = int(link_ttl_sec)
+        now = time.time()
+        out: Dict[str, Optional[str]] = {}
+        mine: List[str] = []
+        waiting: Dict[str, asyncio.Future] = {}
+
+        for url in dict.fromkeys(u for u in urls if u):
+            key = (url, link_ttl_sec)
+            hit = self._get(key, now)
+            if hit is not None:
+                self.hits += 1
+                out[url] = hit
+                continue
+            fut = self._inflight.get(key)
+            if fut is not None:
+                self.coalesced += 1
+                waiting[url] = fut
+                continue
+            self.misses += 1
+            self._inflight[key] = asyncio.get_running_loop().create_future()
+            mine.append(url)
+
+        if mine:
+            results: Dict[str, Optional[str]] = {}
+            try:
+                results = await self._fill(mine, link_ttl_sec, db)
+            finally:
+                for url in mine:
+                    fut = self._inflight.pop((url, link_ttl_sec), None)
+                    if fut is not None and not fut.done():
+                        fut.set_result(results.get(url))
+            out.update({u: results.get(u) for u in mine})
+
+        for url, fut in waiting.items():
+            try:
+                out[url] = await asyncio.shield(fut)
+            except Exception:
+                out[url] = None
+        return out
+
+    async def get(self, url: Optional[str], link_ttl_sec: int = 300, db: Optional[AsyncSession] = None) -> Optional[str]:
+        if not url:
+            return None
+        return (await self.get_many([url], link_ttl_sec, db)).get(url)
+
+    async def _fill(self, urls: List[str], link_ttl_sec: int, db: Optional[AsyncSession]) -> Dict[str, Optional[str]]:
+        ttl = self._ttl(link_ttl_sec)
+        out: Dict[str, Optional[str]] = {}
+        todo = list(urls)
+
+        # `db` (appelant) : simple accord pour la persistance, la session n'est pas utilisée
+        persist = SIGNED_URL_PERSIST and db is not None
+        if persist:
+            found = await self._load_persisted(todo)
+            for url, (signed, expires_at) in found.items():
+                out[url] = signed
+                self._put((url, link_ttl_sec), signed, expires_at)
+                self.persisted_hits += 1
+            todo = [u for u in todo if u not in found]
+
+        if todo:
+            signed = await get_storage().sign_many(todo, expires_sec=link_ttl_sec)
+            expires_at = time.time() + ttl
+            fresh = {}
+            for url in todo:
+                s = signed.get(url)
+                out[url] = s
+                if s:
+                    self._put((url, link_ttl_sec), s, expires_at)
+                    fresh[url] = s
+            if persist and fresh:
+                self._schedule_store(fresh, link_ttl_sec)
+        return out
+
+    # ------------------------------------------------------------------ persistance
+    async def _load_persisted(self, urls: List[str]) -> Dict[str, Tuple[str, float]]:
+        # lien réutilisable s'il lui reste plus de 2× la marge ; gardé en mémoire jusqu'à exp - marge
+        try:
+            async with AsyncSessionLocal() as db:
+                if not await _persist_ready(db):
+                    return {}
+                rs = await db.execute(text("""
+                    SELECT DISTINCT ON (url) url, signed_url,
+                           EXTRACT(EPOCH FROM signed_url_expires_at) AS exp
+                      FROM attachments
+                     WHERE url = ANY(CAST(:urls AS text[]))
+                       AND signed_url IS NOT NULL
+                       AND signed_url_expires_at > NOW() + make_interval(secs => :left)
+                     ORDER BY url, signed_url_expires_at DESC
+                """), {"urls": urls, "left": 2 * self.margin_s})
+                return {r.url: (r.signed_url, float(r.exp) - self.margin_s) for r in rs.fetchall()}
+        except Exception as e:
+            print(f"[signed_cache] load failed: {e}")
+            return {}
+
+    def _schedule_store(self, fresh: Dict[str, str], link_ttl_sec: int) -> None:
+        task = asyncio.get_running_loop().create_task(self._store_persisted(fresh, link_ttl_sec))
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+
+    async def _store_persisted(self, fresh: Dict[str, str], link_ttl_sec: int) -> None:
+        try:
+            async with AsyncSessionLocal() as db:
+                if not await _persist_ready(db):
+                    return
+                await db.execute(text("""
+                    UPDATE attachments a
+                       SET signed_url = v.s,
+                           signed_url_expires_at = NOW() + make_interval(secs => :ttl)
+                      FROM (SELECT unnest(CAST(:urls AS text[])) AS u,
+                                   unnest(CAST(:signed AS text[])) AS s) v
+                     WHERE a.url = v.u
+                """), {"urls": list(fresh), "signed": list(fresh.values()), "ttl": int(link_ttl_sec)})
+                await db.commit()
+        except Exception as e:
+            print(f"[signed_cache] store failed: {e}")
+
+    # ------------------------------------------------------------------ stats
+    def stats(self) -> Dict[str, int]:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "size": len(self._data),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "expired": self.expired,
+            "persisted_hits": self.persisted_hits,
+            "inflight": len(self._inflight),
+            "pending_stores": len(_tasks),
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else None,
+            "persist": SIGNED_URL_PERSIST,
+        }
+
+
+signed_url_cache = SignedUrlCache(SIGNED_CACHE_MAX, SIGNED_CACHE_MARGIN_S)
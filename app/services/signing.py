@@ -0,0 +1,166 @@
+# app/services/signing.py
+"""
+Génération d'URLs signées Supabase en lot.
+
+- dédoublonnage des chemins
+- API multi-chemins de Supabase (POST /object/sign/{bucket} {"paths": [...]})
+- repli : signatures individuelles concurrentes sous sémaphore borné
+"""
+import asyncio
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from app.services.http_clients import http_clients
+
+# -------- Parameters (override via env if needed) ----------
+SIGN_CONCURRENCY   = int(os.getenv("SIGN_CONCURRENCY", "8"))
+SIGN_BATCH_ENABLED = os.getenv("SIGN_BATCH_ENABLED", "1") != "0"
+
+_PUBLIC_MARKER = "/storage/v1/object/public/"
+
+_sign_sem: Optional[asyncio.Semaphore] = None
+
+
+def _sem() -> asyncio.Semaphore:
+    global _sign_sem
+    if _sign_sem is None:
+        _sign_sem = asyncio.Semaphore(max(1, SIGN_CONCURRENCY))
+    return _sign_sem
+
+
+def supabase_config(allow_anon: bool = False) -> Optional[Tuple[str, str, str]]:
+    """(url, clé, bucket) Supabase, None si non configuré. Source unique, aussi
+    utilisée par app/services/storage.py ; la clé anon ne suffit que pour signer."""
+    supa_url = (os.getenv("SUPABASE_URL") or "").rstrip("/")
+    supa_key = (
+        os.getenv("SUPABASE_SERVICE_ROLE")
+        or os.getenv("SUPABASE_SERVICE_KEY")
+        or (os.getenv("SUPABASE_ANON_KEY") if allow_anon else None)
+    )
+    bucket = os.getenv("SUPABASE_BUCKET", "attachments")
+    if not supa_url or not supa_key:
+        return None
+    return supa_url, supa_key, bucket
+
+
+def _config() -> Optional[Tuple[str, str, str]]:
+    return supabase_config(allow_anon=True)
+
+
+def parse_storage_ref(public_or_path: Optional[str], default_bucket: str) -> Optional[Tuple[str, str]]:
+    """URL publique Supabase OU simple chemin → (bucket, chemin dans le bucket).
+    None si ce n'est ni l'un ni l'autre (ex. URL /static locale)."""
+    if not public_or_path:
+        return None
+    if _PUBLIC_MARKER in public_or_path:
+        after = public_or_path.split(_PUBLIC_MARKER, 1)[1]
+    elif "://" in public_or_path or public_or_path.startswith("/static/"):
+        return None
+    else:
+        p = public_or_path.strip().lstrip("/")
+        after = p if p.startswith(default_bucket + "/") else f"{default_bucket}/{p}"
+    parts = after.split("/", 1)
+    if len(parts) != 2 or not parts[1]:
+        return None
+    return parts[0], parts[1]
+
+
+def _absolute(supa_url: str, signed_path: str, bucket: str, path: str) -> Optional[str]:
+    # Supabase renvoie selon les versions "/object/sign/...", "object/sign/..." ou "/storage/v1/..."
+    if not signed_path:
+        return None
+    if signed_path.startswith("http"):
+        return signed_path
+    if signed_path.startswith("/storage/v1/"):
+        return f"{supa_url}{signed_path}"
+    if signed_path.startswith("/object/"):
+        return f"{supa_url}/storage/v1{signed_path}"
+    if signed_path.startswith("object/"):
+        return f"{supa_url}/storage/v1/{signed_path}"
+    if "?" in signed_path:
+        return f"{supa_url}/storage/v1/object/sign/{bucket}/{path}?{signed_path.split('?', 1)[-1]}"
+    return None
+
+
+async def _sign_single(cfg, bucket: str, path: str, expires_sec: int) -> Optional[str]:
+    supa_url, supa_key, _ = cfg
+    headers = {"Authorization": f"Bearer {supa_key}", "Content-Type": "application/json"}
+    async with _sem():
+        try:
+            r = await http_clients.request(
+                "supabase", "POST", f"{supa_url}/storage/v1/object/sign/{bucket}/{path}",
+                headers=headers, json={"expiresIn": int(expires_sec)},
+            )
+        except Exception:
+            return None
+    if r.status_code not in (200, 201):
+        return None
+    try:
+        data = r.json()
+    except Exception:
+        return None
+    return _absolute(supa_url, data.get("signedURL") or data.get("signedUrl") or "", bucket, path)
+
+
+async def _sign_batch(cfg, bucket: str, paths: List[str], expires_sec: int) -> Optional[Dict[str, Optional[str]]]:
+    """API multi-chemins ; None si indisponible (→ repli individuel)."""
+    supa_url, supa_key, _ = cfg
+    headers = {"Authorization": f"Bearer {supa_key}", "Content-Type": "application/json"}
+    try:
+        r = await http_clients.request(
+            "supabase", "POST", f"{supa_url}/storage/v1/object/sign/{bucket}",
+            headers=headers, json={"expiresIn": int(expires_sec), "paths": paths},
+        )
+        if r.status_code not in (200, 201):
+            return None
+        data = r.json()
+    except Exception:
+        return None
+    if not isinstance(data, list):
+        return None
+    out: Dict[str, Optional[str]] = {p: None for p in paths}
+    for item in data:
+        if not isinstance(item, dict) or item.get("error"):
+            continue
+        p = item.get("path")
+        if p in out:
+            out[p] = _absolute(supa_url, item.get("signedURL") or item.get("signedUrl") or "", bucket, p)
+    return out
+
+
+async def sign_many(urls: Iterable[Optional[str]], expires_sec: int = 300) -> Dict[str, Optional[str]]:
+    """Signe un ensemble d'URLs/chemins → {entrée: url signée | None}."""
+    uniq = list(dict.fromkeys(u for u in urls if u))
+    out: Dict[str, Optional[str]] = {u: None for u in uniq}
+    cfg = _config()
+    if not cfg or not uniq:
+        return out
+
+    by_bucket: Dict[str, Dict[str, List[str]]] = {}
+    for u in uniq:
+        ref = parse_storage_ref(u, cfg[2])
+        if ref is None:
+            continue
+        bucket, path = ref
+        by_bucket.setdefault(bucket, {}).setdefault(path, []).append(u)
+
+    async def _bucket(bucket: str, path_map: Dict[str, List[str]]) -> None:
+        paths = list(path_map)
+        signed = None
+        if SIGN_BATCH_ENABLED and len(paths) > 1:
+            signed = await _sign_batch(cfg, bucket, paths, expires_sec)
+        if signed is None:
+            results = await asyncio.gather(*(_sign_single(cfg, bucket, p, expires_sec) for p in paths))
+            signed = dict(zip(paths, results))
+        for p, s in signed.items():
+            for u in path_map.get(p, []):
+                out[u] = s
+
+    await asyncio.gather(*(_bucket(b, pm) for b, pm in by_bucket.items()))
+    return out
+
+
+async def sign_one(url: Optional[str], expires_sec: int = 300) -> Optional[str]:
+    if not url:
+        return None
+    return (await sign_many([url], expires_sec)).get(url)
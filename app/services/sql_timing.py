@@ -0,0 +1,277 @@
+# app/services/sql_timing.py
+"""
+Chronométrage des requêtes SQL (événements d'engine SQLAlchemy).
+
+- chaque exécution est mesurée (before/after_cursor_execute) et rattachée à
+  un nom stable : « module.fonction VERBE table » — la fonction appelante est
+  capturée par TimedAsyncSession (une frame, pas de parcours de pile), le
+  verbe et la table sont lus une fois par texte SQL (cache borné)
+- attribution à la route HTTP / au job en cours (app/services/telemetry.py)
+- percentiles glissants par nom (SQL_TIMING_WINDOW dernières durées)
+- requêtes lentes (≥ SQL_SLOW_MS) : log + anneau des dernières, paramètres
+  masqués (clés sensibles, chaînes tronquées, listes résumées)
+- durée ajoutée à la trace de la requête (Server-Timing db, app/services/tracing.py)
+- sql_top() pour /admin/sql_stats ; temps cumulé exposé à /internal/metrics
+"""
+import os
+import re
+import sys
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.services import tracing
+from app.services.telemetry import current_route, register_collector
+
+# -------- Parameters (override via env if needed) ----------
+SQL_TIMING_ENABLED = os.getenv("SQL_TIMING_ENABLED", "1") != "0"
+SQL_SLOW_MS        = float(os.getenv("SQL_SLOW_MS", "500"))
+SQL_WINDOW         = int(os.getenv("SQL_TIMING_WINDOW", "512"))
+SQL_MAX_NAMES      = int(os.getenv("SQL_TIMING_MAX_NAMES", "500"))
+SQL_SLOW_KEEP      = int(os.getenv("SQL_SLOW_KEEP", "50"))
+
+_SENSITIVE = re.compile(r"token|secret|pass|sig|email|phone|device|ip\b|user_id|uid|auth|key", re.I)
+_VERB  = re.compile(r"\b(SELECT|INSERT|UPDATE|DELETE|ALTER|CREATE|DROP|TRUNCATE)\b", re.I)
+_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE|ON)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?([A-Za-z_][\w.]*)", re.I)
+
+_caller: ContextVar[Optional[str]] = ContextVar("ayii_sql_caller", default=None)
+
+_shapes: Dict[str, str] = {}          # texte SQL → « VERBE table »
+_by_name: Dict[str, Dict[str, Any]] = {}
+_slow: Deque[Dict[str, Any]] = deque(maxlen=SQL_SLOW_KEEP)
+_totals = {"statements": 0, "errors": 0, "slow": 0}
+
+
+# -----------------------------------------------------------------------------
+# Nommage
+# -----------------------------------------------------------------------------
+def _frame_name(frame) -> str:
+    mod = (frame.f_globals.get("__name__") or "?").rsplit(".", 1)[-1]
+    return f"{mod}.{frame.f_code.co_name}"
+
+
+def _strip_comments(sql: str) -> str:
+    return re.sub(r"--[^\n]*", " ", sql)
+
+
+def _shape(sql: str) -> str:
+    shape = _shapes.get(sql)
+    if shape is None:
+        body = _strip_comments(sql)
+        # WITH … : le verbe principal suit la parenthèse fermante des CTE
+        if re.match(r"\s*WITH\b", body, re.I):
+            m = re.search(r"\)\s*(?=(?:SELECT|INSERT|UPDATE|DELETE)\b)", body, re.I)
+            body = body[m.end():] if m else body
+        v = _VERB.search(body)
+        if v:
+            t = _TABLE.search(body, v.start())
+            shape = f"{v.group(1).upper()} {t.group(1) if t else '-'}"
+        else:
+            shape = (body.split() or ["?"])[0].upper()
+        if len(_shapes) >= 4 * SQL_MAX_NAMES:
+            _shapes.clear()
+        _shapes[sql] = shape
+    return shape
+
+
+def _collapse(sql: str, limit: int = 400) -> str:
+    s = " ".join(_strip_comments(sql).split())
+    return s if len(s) <= limit else s[:limit] + "…"
+
+
+def redact(params: Any) -> Any:
+    """Paramètres liés lisibles sans fuite : clés sensibles masquées, chaînes
+    tronquées, listes et binaires résumés."""
+    if isinstance(params, dict):
+        return {k: ("***" if _SENSITIVE.search(str(k)) else redact(v)) for k, v in params.items()}
+    if isinstance(params, (list, tuple)):
+        return f"<{type(params).__name__} len={len(params)}>"
+    if isinstance(params, (bytes, bytearray, memoryview)):
+        return f"<bytes len={len(params)}>"
+    if isinstance(params, str):
+        return params if len(params) <= 32 else params[:32] + "…"
+    return params
+
+
+# -----------------------------------------------------------------------------
+# Session : capture de la fonction appelante
+# -----------------------------------------------------------------------------
+class TimedAsyncSession(AsyncSession):
+    """AsyncSession qui note la fonction appelante (une frame) dans un
+    ContextVar, relu par les événements d'engine (le greenlet de SQLAlchemy
+    hérite du contexte de la coroutine)."""
+
+    async def execute(self, *args, **kw):
+        tok = _caller.set(_frame_name(sys._getframe(1)))
+        try:
+            return await super().execute(*args, **kw)
+        finally:
+            _caller.reset(tok)
+
+    async def stream(self, *args, **kw):
+        tok = _caller.set(_frame_name(sys._getframe(1)))
+        try:
+            return await super().stream(*args, **kw)
+        finally:
+            _caller.reset(tok)
+
+    async def scalar(self, *args, **kw):
+        tok = _caller.set(_frame_name(sys._getframe(1)))
+        try:
+            return await super().scalar(*args, **kw)
+        finally:
+            _caller.reset(tok)
+
+
+# -----------------------------------------------------------------------------
+# Événements d'engine
+# -----------------------------------------------------------------------------
+def _entry(name: str) -> Dict[str, Any]:
+    st = _by_name.get(name)
+    if st is None:
+        if len(_by_name) >= SQL_MAX_NAMES:
+            name = "other"
+            st = _by_name.get(name)
+        if st is None:
+            st = _by_name[name] = {
+                "count": 0, "errors": 0, "ms_sum": 0.0, "ms_max": 0.0,
+                "recent": deque(maxlen=SQL_WINDOW), "routes": {}, "sample": None,
+            }
+    return st
+
+
+def _record(pool: str, statement: str, ms: float, params: Any, error: bool = False) -> None:
+    name = f"{_caller.get() or '?'} {_shape(statement)}"
+    route = current_route()
+    st = _entry(name)
+    st["count"] += 1
+    st["ms_sum"] += ms
+    st["ms_max"] = max(st["ms_max"], ms)
+    st["recent"].append(ms)
+    r = st["routes"].get(route)
+    if r is None:
+        if len(st["routes"]) < 20:
+            r = st["routes"][route] = [0, 0.0]
+    if r is not None:
+        r[0] += 1
+        r[1] += ms
+    if st["sample"] is None:
+        st["sample"] = _collapse(statement)
+    tracing.add("db", ms / 1000.0, name)
+    _totals["statements"] += 1
+    if error:
+        st["errors"] += 1
+        _totals["errors"] += 1
+    if ms >= SQL_SLOW_MS:
+        _totals["slow"] += 1
+        entry = {
+            "at": time.time(), "ms": round(ms, 1), "name": name, "route": route, "pool": pool,
+            "sql": _collapse(statement), "params": redact(params),
+        }
+        _slow.append(entry)
+        print(f"[sql] slow {entry['ms']} ms name={name} route={route} pool={pool} "
+              f"params={entry['params']} sql={_collapse(statement, 200)}")
+
+
+def _params_of(context, parameters: Any) -> Any:
+    # paramètres nommés (text() → :nom) plutôt que le tuple positionnel du driver
+    try:
+        cp = context.compiled_parameters if context is not None else None
+        if cp:
+            return cp[0] if len(cp) == 1 else f"<executemany n={len(cp)}>"
+    except Exception:
+        pass
+    return parameters
+
+
+def install_sql_timing(sync_engine, pool: str) -> None:
+    if not SQL_TIMING_ENABLED:
+        return
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("ayii_sql_t0", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        stack = conn.info.get("ayii_sql_t0")
+        if not stack:
+            return
+        ms = (time.perf_counter() - stack.pop()) * 1000.0
+        _record(pool, statement, ms, _params_of(context, parameters))
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _error(ctx):
+        conn = ctx.connection
+        stack = conn.info.get("ayii_sql_t0") if conn is not None else None
+        if not stack or not ctx.statement:
+            return
+        ms = (time.perf_counter() - stack.pop()) * 1000.0
+        _record(pool, ctx.statement, ms, _params_of(ctx.execution_context, ctx.parameters), error=True)
+
+
+# -----------------------------------------------------------------------------
+# Lecture
+# -----------------------------------------------------------------------------
+def _pct(sorted_ms: List[float], q: float) -> Optional[float]:
+    if not sorted_ms:
+        return None
+    i = min(len(sorted_ms) - 1, max(0, int(round(q * (len(sorted_ms) - 1)))))
+    return round(sorted_ms[i], 2)
+
+
+def sql_top(limit: int = 20, sort: str = "total") -> Dict[str, Any]:
+    rows: List[Dict[str, Any]] = []
+    for name, st in list(_by_name.items()):
+        recent = sorted(st["recent"])
+        routes = sorted(st["routes"].items(), key=lambda kv: kv[1][1], reverse=True)
+        rows.append({
+            "name": name,
+            "count": st["count"],
+            "errors": st["errors"],
+            "total_ms": round(st["ms_sum"], 1),
+            "avg_ms": round(st["ms_sum"] / st["count"], 2) if st["count"] else None,
+            "p50_ms": _pct(recent, 0.50),
+            "p95_ms": _pct(recent, 0.95),
+            "p99_ms": _pct(recent, 0.99),
+            "max_ms": round(st["ms_max"], 2),
+            "routes": [{"route": r, "count": c, "total_ms": round(ms, 1)} for r, (c, ms) in routes[:5]],
+            "sql": st["sample"],
+        })
+    key = {
+        "total": lambda r: r["total_ms"],
+        "p95": lambda r: r["p95_ms"] or 0,
+        "max": lambda r: r["max_ms"],
+        "count": lambda r: r["count"],
+    }.get(sort, lambda r: r["total_ms"])
+    rows.sort(key=key, reverse=True)
+    return {
+        **_totals,
+        "names": len(_by_name),
+        "slow_ms": SQL_SLOW_MS,
+        "window": SQL_WINDOW,
+        "top": rows[:limit],
+        "slow_recent": list(_slow)[-limit:][::-1],
+    }
+
+
+def sql_reset() -> None:
+    _by_name.clear()
+    _slow.clear()
+    for k in _totals:
+        _totals[k] = 0
+
+
+def _sql_families():
+    items = list(_by_name.items())
+    yield ("ayii_sql_statements_total", "counter", "Exécutions SQL par nom de requête.",
+           [({"query": n}, float(st["count"])) for n, st in items])
+    yield ("ayii_sql_seconds_total", "counter", "Temps SQL cumulé par nom de requête.",
+           [({"query": n}, st["ms_sum"] / 1000.0) for n, st in items])
+
+
+register_collector(_sql_families)
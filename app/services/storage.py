@@ -0,0 +1,522 @@
+# app/services/storage.py
+"""
+Couche de stockage des pièces jointes (backends interchangeables).
+
+Interface commune : put_stream / put_bytes / put_file, read, sign_many, delete, exists,
+list (inventaire pour la réconciliation des blobs orphelins).
+- SupabaseStorage : Supabase Storage (HTTP via le client partagé)
+- LocalStorage    : système de fichiers (STATIC_DIR servi sous /static)
+- MemoryStorage   : en mémoire, pour tests / benchmarks sans réseau
+
+Chaque opération passe par StorageBackend._timed → latences et erreurs par
+backend et par opération (exposées dans /admin/http_stats).
+
+Sélection : STORAGE_BACKEND = auto (Supabase si configuré, sinon local) |
+supabase | local | memory ; set_storage(...) pour injecter un backend.
+"""
+import os
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Tuple
+
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+
+from app.config import BASE_PUBLIC_URL, STATIC_DIR, STATIC_URL_PATH
+from app.services.http_clients import http_clients
+from app.services.signing import parse_storage_ref, sign_many, supabase_config
+from app.services import tracing
+from app.services.telemetry import storage_latency, upload_bytes
+from app.services.uploads import (
+    StorageUploadError, UploadStream, save_stream_to_disk, upload_budget,
+)
+
+# -------- Parameters (override via env if needed) ----------
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "auto").strip().lower()
+LIST_PAGE       = int(os.getenv("STORAGE_LIST_PAGE", "1000"))
+
+
+def _clean_path(path: str) -> str:
+    p = (path or "").replace("\\", "/").lstrip("/")
+    if not p or any(part in ("", ".", "..") for part in p.split("/")):
+        raise ValueError(f"invalid storage path: {path!r}")
+    return p
+
+
+class StorageBackend:
+    """Méthodes publiques instrumentées ; les sous-classes implémentent les `_xxx`."""
+
+    name = "base"
+
+    def __init__(self):
+        self._ops: Dict[str, Dict[str, float]] = {}
+
+    @asynccontextmanager
+    async def _timed(self, op: str):
+        st = self._ops.setdefault(op, {"count": 0, "errors": 0, "ms_sum": 0.0, "ms_max": 0.0})
+        t0 = time.perf_counter()
+        st["count"] += 1
+        try:
+            yield
+        except BaseException:
+            st["errors"] += 1
+            raise
+        finally:
+            dt = (time.perf_counter() - t0) * 1000.0
+            st["ms_sum"] += dt
+            st["ms_max"] = max(st["ms_max"], dt)
+            storage_latency.observe(dt / 1000.0, self.name, op)
+            tracing.add("ext", dt / 1000.0, f"storage:{self.name}.{op}")
+
+    # ------------------------------------------------------------------ API
+    async def put_stream(self, path: str, stream: UploadStream, content_type: str, *, upsert: bool = False, timeout: float = 60) -> str:
+        """Écrit le flux (mémoire bornée), renvoie l'URL publique/brute à stocker en base."""
+        async with self._timed("put"):
+            url = await self._put_stream(_clean_path(path), stream, content_type, upsert=upsert, timeout=timeout)
+        upload_budget.bytes_total += stream.total
+        upload_bytes.observe(stream.total)
+        return url
+
+    async def put_bytes(self, path: str, data: bytes, content_type: str, *, upsert: bool = True) -> str:
+        async with self._timed("put"):
+            return await self._put_bytes(_clean_path(path), data, content_type, upsert=upsert)
+
+    async def put_file(self, path: str, local_path: str, content_type: str, *, move: bool = False) -> str:
+        """Fichier local déjà assemblé (upload reprenable, variantes)."""
+        async with self._timed("put"):
+            return await self._put_file(_clean_path(path), local_path, content_type, move=move)
+
+    async def read(self, path: str) -> Optional[bytes]:
+        async with self._timed("read"):
+            return await self._read(_clean_path(path))
+
+    async def sign_many(self, urls: Iterable[Optional[str]], expires_sec: int = 300) -> Dict[str, Optional[str]]:
+        async with self._timed("sign"):
+            return await self._sign_many([u for u in urls if u], int(expires_sec))
+
+    async def delete(self, paths: Iterable[str]) -> int:
+        paths = [_clean_path(p) for p in paths if p]
+        if not paths:
+            return 0
+        async with self._timed("delete"):
+            return await self._delete(paths)
+
+    async def exists(self, path: str) -> bool:
+        async with self._timed("exists"):
+            return await self._exists(_clean_path(path))
+
+    async def list(self, prefix: str = "") -> AsyncIterator[List[Tuple[str, float]]]:
+        """Inventaire par pages : [(chemin, mtime epoch), ...]."""
+        prefix = (prefix or "").strip("/")
+        if prefix:
+            prefix = _clean_path(prefix)
+        async for page in self._list(prefix):
+            yield page
+
+    def public_url(self, path: str) -> str:
+        """URL telle qu'elle est écrite en base pour ce chemin."""
+        raise NotImplementedError
+
+    def path_of(self, url: Optional[str]) -> Optional[str]:
+        """URL stockée en base → chemin dans ce backend (None si l'URL n'en vient pas)."""
+        raise NotImplementedError
+
+    # ------------------------------------------------------------------ impl
+    async def _put_stream(self, path, stream, content_type, *, upsert, timeout) -> str:
+        raise NotImplementedError
+
+    async def _put_bytes(self, path, data, content_type, *, upsert) -> str:
+        raise NotImplementedError
+
+    async def _put_file(self, path, local_path, content_type, *, move) -> str:
+        raise NotImplementedError
+
+    async def _read(self, path) -> Optional[bytes]:
+        raise NotImplementedError
+
+    async def _sign_many(self, urls: List[str], expires_sec: int) -> Dict[str, Optional[str]]:
+        raise NotImplementedError
+
+    async def _delete(self, paths: List[str]) -> int:
+        raise NotImplementedError
+
+    async def _exists(self, path) -> bool:
+        raise NotImplementedError
+
+    async def _list(self, prefix: str) -> AsyncIterator[List[Tuple[str, float]]]:
+        raise NotImplementedError
+        yield []
+
+    # ------------------------------------------------------------------ stats
+    def stats(self) -> Dict[str, Any]:
+        ops = {}
+        for op, st in self._ops.items():
+            n = st["count"] or 0
+            ops[op] = {**st, "ms_avg": round(st["ms_sum"] / n, 2) if n else None}
+        return {"backend": self.name, "ops": ops}
+
+
+# -----------------------------------------------------------------------------
+# Supabase
+# -----------------------------------------------------------------------------
+class SupabaseStorage(StorageBackend):
+    name = "supabase"
+
+    def _cfg(self) -> Tuple[str, str, str]:
+        cfg = supabase_config()
+        if not cfg:
+            raise RuntimeError("supabase credentials missing")
+        return cfg
+
+    def _headers(self, key: str, content_type: Optional[str] = None, upsert: Optional[bool] = None) -> Dict[str, str]:
+        h = {"Authorization": f"Bearer {key}"}
+        if content_type is not None:
+            h["Content-Type"] = content_type or "application/octet-stream"
+        if upsert is not None:
+            h["x-upsert"] = "true" if upsert else "false"
+        return h
+
+    def _public(self, path: str) -> str:
+        supa_url, _, bucket = self._cfg()
+        return f"{supa_url}/storage/v1/object/public/{bucket}/{path}"
+
+    def path_of(self, url: Optional[str]) -> Optional[str]:
+        cfg = supabase_config()
+        if not cfg:
+            return None
+        ref = parse_storage_ref(url, cfg[2])
+        if ref is None or ref[0] != cfg[2]:
+            return None
+        return ref[1]
+
+    async def _put_stream(self, path, stream, content_type, *, upsert, timeout) -> str:
+        supa_url, supa_key, bucket = self._cfg()
+        await stream.prime()
+        headers = self._headers(supa_key, content_type, upsert)
+        if stream.size_hint is not None:
+            headers["Content-Length"] = str(stream.size_hint)
+        # corps en flux → pas de retry possible
+        r = await http_clients.request(
+            "supabase", "POST", f"{supa_url}/storage/v1/object/{bucket}/{path}",
+            headers=headers, content=stream, timeout=timeout, retries=0,
+        )
+        if r.status_code not in (200, 201):
+            raise StorageUploadError(r.status_code, r.text)
+        return self._public(path)
+
+    async def _put_bytes(self, path, data, content_type, *, upsert) -> str:
+        supa_url, supa_key, bucket = self._cfg()
+        # corps rejouable → retries du client partagé
+        r = await http_clients.request(
+            "supabase", "POST", f"{supa_url}/storage/v1/object/{bucket}/{path}",
+            headers=self._headers(supa_key, content_type, upsert), content=data,
+        )
+        if r.status_code not in (200, 201):
+            raise StorageUploadError(r.status_code, r.text)
+        return self._public(path)
+
+    async def _put_file(self, path, local_path, content_type, *, move) -> str:
+        fp = await run_in_threadpool(open, local_path, "rb")
+        try:
+            size = os.fstat(fp.fileno()).st_size
+            upload = UploadFile(fp, size=size, headers=Headers({"content-type": content_type}))
+            stream = UploadStream(upload, size)
+            url = await self._put_stream(path, stream, content_type, upsert=True, timeout=60)
+        finally:
+            await run_in_threadpool(fp.close)
+        if move:
+            await run_in_threadpool(_unlink, local_path)
+        return url
+
+    async def _read(self, path) -> Optional[bytes]:
+        supa_url, supa_key, bucket = self._cfg()
+        r = await http_clients.request(
+            "supabase", "GET", f"{supa_url}/storage/v1/object/{bucket}/{path}", headers=self._headers(supa_key),
+        )
+        return r.content if r.status_code == 200 else None
+
+    async def _sign_many(self, urls, expires_sec) -> Dict[str, Optional[str]]:
+        return await sign_many(urls, expires_sec=expires_sec)
+
+    async def _delete(self, paths) -> int:
+        supa_url, supa_key, bucket = self._cfg()
+        r = await http_clients.request(
+            "supabase", "DELETE", f"{supa_url}/storage/v1/object/{bucket}",
+            headers=self._headers(supa_key, "application/json"), json={"prefixes": paths},
+        )
+        if r.status_code not in (200, 204):
+            raise StorageUploadError(r.status_code, r.text)
+        try:
+            data = r.json()
+            return len(data) if isinstance(data, list) else len(paths)
+        except Exception:
+            return len(paths)
+
+    async def _exists(self, path) -> bool:
+        supa_url, supa_key, bucket = self._cfg()
+        r = await http_clients.request(
+            "supabase", "HEAD", f"{supa_url}/storage/v1/object/{bucket}/{path}", headers=self._headers(supa_key),
+        )
+        return r.status_code == 200
+
+    def public_url(self, path: str) -> str:
+        return self._public(_clean_path(path))
+
+    async def _list(self, prefix):
+        supa_url, supa_key, bucket = self._cfg()
+        # l'API liste un "dossier" à la fois : parcours en largeur
+        folders = [prefix]
+        while folders:
+            folder = folders.pop(0)
+            offset = 0
+            while True:
+                r = await http_clients.request(
+                    "supabase", "POST", f"{supa_url}/storage/v1/object/list/{bucket}",
+                    headers=self._headers(supa_key, "application/json"),
+                    json={"prefix": folder, "limit": LIST_PAGE, "offset": offset,
+                          "sortBy": {"column": "name", "order": "asc"}},
+                )
+                if r.status_code != 200:
+                    raise StorageUploadError(r.status_code, r.text)
+                items = r.json() or []
+                page: List[Tuple[str, float]] = []
+                for it in items:
+                    name = it.get("name")
+                    if not name:
+                        continue
+                    full = f"{folder}/{name}" if folder else name
+                    if it.get("id") is None:  # sous-dossier
+                        folders.append(full)
+                        continue
+                    page.append((full, _iso_epoch(it.get("updated_at") or it.get("created_at"))))
+                if page:
+                    yield page
+                if len(items) < LIST_PAGE:
+                    break
+                offset += LIST_PAGE
+
+
+def _iso_epoch(value: Optional[str]) -> float:
+    if not value:
+        return 0.0
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return 0.0
+
+
+# -----------------------------------------------------------------------------
+# Système de fichiers local (STATIC_DIR servi sous /static)
+# -----------------------------------------------------------------------------
+def static_public_url(name: str) -> str:
+    base = (BASE_PUBLIC_URL or "").rstrip("/")
+    return f"{base}{STATIC_URL_PATH}/{name}" if base else f"{STATIC_URL_PATH}/{name}"
+
+
+def _unlink(path: str) -> bool:
+    try:
+        os.remove(path)
+        return True
+    except OSError:
+        return False
+
+
+class LocalStorage(StorageBackend):
+    name = "local"
+
+    def __init__(self, root: str = STATIC_DIR):
+        super().__init__()
+        self.root = root
+
+    def local_path(self, path: str) -> str:
+        return os.path.join(self.root, *_clean_path(path).split("/"))
+
+    def path_of(self, url: Optional[str]) -> Optional[str]:
+        if not url:
+            return None
+        marker = f"{STATIC_URL_PATH}/"
+        if marker not in url:
+            return None
+        return url.split(marker, 1)[1].split("?", 1)[0] or None
+
+    async def _put_stream(self, path, stream, content_type, *, upsert, timeout) -> str:
+        await save_stream_to_disk(stream, self.local_path(path), account=False)
+        return static_public_url(path)
+
+    async def _put_bytes(self, path, data, content_type, *, upsert) -> str:
+        dst = self.local_path(path)
+
+        def _write():
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            with open(dst, "wb") as f:
+                f.write(data)
+
+        await run_in_threadpool(_write)
+        return static_public_url(path)
+
+    async def _put_file(self, path, local_path, content_type, *, move) -> str:
+        dst = self.local_path(path)
+
+        def _place():
+            import shutil
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if move:
+                shutil.move(local_path, dst)
+            else:
+                shutil.copyfile(local_path, dst)
+
+        await run_in_threadpool(_place)
+        return static_public_url(path)
+
+    async def _read(self, path) -> Optional[bytes]:
+        def _load():
+            try:
+                with open(self.local_path(path), "rb") as f:
+                    return f.read()
+            except OSError:
+                return None
+
+        return await run_in_threadpool(_load)
+
+    async def _sign_many(self, urls, expires_sec) -> Dict[str, Optional[str]]:
+        # fichiers servis tels quels par /static : rien à signer
+        return {u: (u if self.path_of(u) else None) for u in urls}
+
+    async def _delete(self, paths) -> int:
+        return sum([await run_in_threadpool(_unlink, self.local_path(p)) for p in paths])
+
+    async def _exists(self, path) -> bool:
+        return await run_in_threadpool(os.path.exists, self.local_path(path))
+
+    def public_url(self, path: str) -> str:
+        return static_public_url(_clean_path(path))
+
+    def _walk(self, prefix: str) -> List[Tuple[str, float]]:
+        base = self.local_path(prefix) if prefix else self.root
+        out: List[Tuple[str, float]] = []
+        for dirpath, _, files in os.walk(base):
+            for f in files:
+                full = os.path.join(dirpath, f)
+                try:
+                    mtime = os.path.getmtime(full)
+                except OSError:
+                    continue
+                out.append((os.path.relpath(full, self.root).replace(os.sep, "/"), mtime))
+        return out
+
+    async def _list(self, prefix):
+        entries = await run_in_threadpool(self._walk, prefix)
+        for i in range(0, len(entries), LIST_PAGE):
+            yield entries[i:i + LIST_PAGE]
+
+
+# -----------------------------------------------------------------------------
+# Mémoire (tests / benchmarks)
+# -----------------------------------------------------------------------------
+class MemoryStorage(StorageBackend):
+    name = "memory"
+    prefix = "memory://"
+
+    def __init__(self):
+        super().__init__()
+        self.objects: Dict[str, Tuple[bytes, str]] = {}
+
+    def path_of(self, url: Optional[str]) -> Optional[str]:
+        if not url or not url.startswith(self.prefix):
+            return None
+        return url[len(self.prefix):].split("?", 1)[0] or None
+
+    async def _put_stream(self, path, stream, content_type, *, upsert, timeout) -> str:
+        await stream.prime()
+        parts = [chunk async for chunk in stream]
+        self.objects[path] = (b"".join(parts), content_type)
+        return self.prefix + path
+
+    async def _put_bytes(self, path, data, content_type, *, upsert) -> str:
+        self.objects[path] = (bytes(data), content_type)
+        return self.prefix + path
+
+    async def _put_file(self, path, local_path, content_type, *, move) -> str:
+        with open(local_path, "rb") as f:
+            self.objects[path] = (f.read(), content_type)
+        if move:
+            _unlink(local_path)
+        return self.prefix + path
+
+    async def _read(self, path) -> Optional[bytes]:
+        obj = self.objects.get(path)
+        return obj[0] if obj else None
+
+    async def _sign_many(self, urls, expires_sec) -> Dict[str, Optional[str]]:
+        exp = int(time.time()) + expires_sec
+        return {u: (f"{u}?exp={exp}" if self.path_of(u) in self.objects else None) for u in urls}
+
+    async def _delete(self, paths) -> int:
+        return sum(1 for p in paths if self.objects.pop(p, None) is not None)
+
+    async def _exists(self, path) -> bool:
+        return path in self.objects
+
+    def public_url(self, path: str) -> str:
+        return self.prefix + _clean_path(path)
+
+    async def _list(self, prefix):
+        keys = sorted(k for k in self.objects if not prefix or k.startswith(prefix + "/"))
+        for i in range(0, len(keys), LIST_PAGE):
+            yield [(k, 0.0) for k in keys[i:i + LIST_PAGE]]
+
+
+# -----------------------------------------------------------------------------
+# Sélection
+# -----------------------------------------------------------------------------
+_storage: Optional[StorageBackend] = None
+_local: Optional[LocalStorage] = None
+
+
+def local_storage() -> LocalStorage:
+    """Backend disque (repli quand Supabase échoue)."""
+    global _local
+    if isinstance(_storage, LocalStorage):
+        return _storage
+    if _local is None:
+        _local = LocalStorage()
+    return _local
+
+
+def get_storage() -> StorageBackend:
+    global _storage
+    if _storage is None:
+        kind = STORAGE_BACKEND
+        if kind == "auto":
+            kind = "supabase" if supabase_config() else "local"
+        if kind == "supabase":
+            _storage = SupabaseStorage()
+        elif kind == "memory":
+            _storage = MemoryStorage()
+        else:
+            _storage = local_storage()
+    return _storage
+
+
+def set_storage(backend: Optional[StorageBackend]) -> None:
+    """Injection (tests / benchmarks) ; None → re-sélection depuis l'env."""
+    global _storage
+    _storage = backend
+
+
+def storage_for_url(url: Optional[str]) -> Tuple[Optional[StorageBackend], Optional[str]]:
+    """Backend + chemin d'une URL stockée en base (objets Supabase ou /static)."""
+    for backend in (get_storage(), local_storage()):
+        path = backend.path_of(url)
+        if path:
+            return backend, path
+    return None, None
+
+
+def storage_stats() -> Dict[str, Any]:
+    out = {"active": get_storage().stats()}
+    if _local is not None and _local is not _storage:
+        out["local_fallback"] = _local.stats()
+    return out
@@ -0,0 +1,272 @@
+# app/services/telemetry.py
+"""
+Métriques opérationnelles au format d'exposition texte Prometheus.
+
+- Counter / Histogram en mémoire, sans dépendance : un incrément ou un
+  bisect sur des bornes fixes par observation (assez léger pour rester actif)
+- collecteurs appelés au moment du scrape pour les jauges déjà tenues
+  ailleurs (pools SQLAlchemy, clients HTTP, caches, budget d'upload)
+- middleware ASGI : latence et statut par route (gabarit de la route, pas le
+  chemin brut → cardinalité bornée)
+- exposé par GET /internal/metrics (app/main.py), protégé par METRICS_TOKEN ;
+  sans jeton : 404, sauf accès public explicite (METRICS_PUBLIC=1) ; les
+  métriques métier restent sous /metrics/*
+
+Compteurs par processus (chaque worker uvicorn expose les siens).
+"""
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# -------- Parameters (override via env if needed) ----------
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+METRICS_TOKEN   = (os.getenv("METRICS_TOKEN") or "").strip()
+METRICS_PUBLIC  = os.getenv("METRICS_PUBLIC", "0") == "1"  # sans jeton : servi à tous (réseau privé)
+
+# bornes (secondes) : requêtes, appels distants, jobs
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+JOB_BUCKETS     = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+BYTES_BUCKETS   = (16e3, 64e3, 256e3, 1e6, 4e6, 16e6, 64e6)
+
+LabelValues = Tuple[str, ...]
+# (nom, type, aide, [(labels, valeur)])
+Family = Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]
+
+
+def _esc(v: Any) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_esc(v)}"' for k, v in labels.items()) + "}"
+
+
+def _fmt_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) and not v.is_integer() else str(int(v))
+
+
+class Counter:
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, *values: str, amount: float = 1.0) -> None:
+        key = tuple(values)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        for key, v in sorted(self._values.items()):
+            out.append(f"{self.name}{_fmt_labels(dict(zip(self.labels, key)))} {_fmt_value(v)}")
+        return out
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # par série : [compte par intervalle (+Inf en dernier), somme]
+        self._series: Dict[LabelValues, List[Any]] = {}
+
+    def observe(self, value: float, *values: str) -> None:
+        key = tuple(values)
+        s = self._series.get(key)
+        if s is None:
+            s = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        s[0][bisect_left(self.buckets, value)] += 1
+        s[1] += value
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total) in sorted(self._series.items()):
+            base = dict(zip(self.labels, key))
+            acc = 0
+            for le, c in zip(self.buckets + (float("inf"),), counts):
+                acc += c
+                out.append(f"{self.name}_bucket{_fmt_labels({**base, 'le': _fmt_value(le)})} {acc}")
+            out.append(f"{self.name}_sum{_fmt_labels(base)} {_fmt_value(round(total, 6))}")
+            out.append(f"{self.name}_count{_fmt_labels(base)} {acc}")
+        return out
+
+
+# -----------------------------------------------------------------------------
+# Registre
+# -----------------------------------------------------------------------------
+_metrics: List[Any] = []
+_collectors: List[Callable[[], Iterable[Family]]] = []
+
+
+def counter(name: str, doc: str, labels: Sequence[str] = ()) -> Counter:
+    m = Counter(name, doc, labels)
+    _metrics.append(m)
+    return m
+
+
+def histogram(name: str, doc: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+    m = Histogram(name, doc, labels, buckets)
+    _metrics.append(m)
+    return m
+
+
+def register_collector(fn: Callable[[], Iterable[Family]]) -> None:
+    """fn() → familles (nom, gauge|counter, aide, [(labels, valeur)]) lues au scrape."""
+    _collectors.append(fn)
+
+
+http_requests = counter(
+    "ayii_http_requests_total", "Requêtes HTTP par route, méthode et statut.", ("method", "route", "status"))
+http_latency = histogram(
+    "ayii_http_request_duration_seconds", "Durée des requêtes HTTP (jusqu'au dernier octet).", ("method", "route"))
+db_pool_wait = histogram(
+    "ayii_db_pool_acquire_seconds", "Attente d'une connexion du pool SQLAlchemy.", ("pool",))
+job_duration = histogram(
+    "ayii_job_duration_seconds", "Durée des jobs planifiés.", ("job",), JOB_BUCKETS)
+job_runs = counter(
+    "ayii_job_runs_total", "Exécutions des jobs planifiés par résultat.", ("job", "result"))
+upload_duration = histogram(
+    "ayii_upload_duration_seconds", "Durée d'un upload (slot du budget d'upload).", ("kind",), JOB_BUCKETS)
+upload_bytes = histogram(
+    "ayii_upload_bytes", "Taille des fichiers envoyés au stockage.", (), BYTES_BUCKETS)
+remote_latency = histogram(
+    "ayii_remote_request_duration_seconds", "Latence des appels HTTP sortants par service (par tentative).", ("service",))
+storage_latency = histogram(
+    "ayii_storage_op_duration_seconds", "Latence des opérations de stockage par backend.", ("backend", "op"))
+
+
+def _builtin_families() -> Iterable[Family]:
+    # imports tardifs : ces modules importent eux-mêmes la télémétrie
+    from app.services.dedup import dedup_stats
+    from app.services.http_clients import http_clients
+    from app.services.recent_reports import recent_reports
+    from app.services.result_cache import all_result_caches
+    from app.services.signed_cache import signed_url_cache
+    from app.services.uploads import upload_budget
+
+    dd = dedup_stats()
+    caches = {
+        "signed_url": signed_url_cache.stats(),
+        "ownership_index": recent_reports.stats(),
+        "dedup": {"hits": dd["hits"], "misses": dd["lookups"] - dd["hits"]},
+    }
+    for rc in all_result_caches():
+        st = rc.stats()
+        caches[f"result:{rc.name}"] = {
+            "hits": st["hits"] + st["stale_hits"] + st["coalesced"], "misses": st["misses"],
+        }
+    hits = [({"cache": k}, float(v.get("hits", 0))) for k, v in caches.items()]
+    misses = [({"cache": k}, float(v.get("misses", 0))) for k, v in caches.items()]
+    ratio = []
+    for k, v in caches.items():
+        n = v.get("hits", 0) + v.get("misses", 0)
+        if n:
+            ratio.append(({"cache": k}, v.get("hits", 0) / n))
+    yield ("ayii_cache_hits_total", "counter", "Lookups servis par le cache.", hits)
+    yield ("ayii_cache_misses_total", "counter", "Lookups non servis par le cache.", misses)
+    yield ("ayii_cache_hit_ratio", "gauge", "hits / (hits + misses) depuis le démarrage.", ratio)
+
+    clients = http_clients.stats()["clients"]
+    yield ("ayii_remote_in_flight", "gauge", "Appels HTTP sortants en cours.",
+           [({"service": k}, float(v["in_flight"])) for k, v in clients.items()])
+    yield ("ayii_remote_errors_total", "counter", "Erreurs des appels HTTP sortants (transport, 5xx rejouables).",
+           [({"service": k}, float(v["errors"])) for k, v in clients.items()])
+    yield ("ayii_remote_retries_total", "counter", "Tentatives rejouées des appels HTTP sortants.",
+           [({"service": k}, float(v["retries"])) for k, v in clients.items()])
+
+    up = upload_budget.stats()
+    yield ("ayii_uploads_in_flight", "gauge", "Uploads en cours.", [({}, float(up["in_flight"]))])
+    yield ("ayii_uploads_rejected_total", "counter", "Uploads refusés (budget épuisé).", [({}, float(up["rejected"]))])
+
+
+def _render_family(name: str, kind: str, doc: str, samples: List[Tuple[Dict[str, str], float]]) -> List[str]:
+    out = [f"# HELP {name} {doc}", f"# TYPE {name} {kind}"]
+    for labels, v in samples:
+        out.append(f"{name}{_fmt_labels(labels)} {_fmt_value(v)}")
+    return out
+
+
+def render() -> str:
+    lines: List[str] = []
+    for m in _metrics:
+        lines.extend(m.render())
+    for fn in [_builtin_families, *_collectors]:
+        try:
+            for fam in fn():
+                lines.extend(_render_family(*fam))
+        except Exception as e:
+            lines.append(f"# collector error: {_esc(e)}")
+    return "\n".join(lines) + "\n"
+
+
+# -----------------------------------------------------------------------------
+# Attribution (route HTTP ou job) pour les mesures faites plus bas dans la pile
+# -----------------------------------------------------------------------------
+_scope_var: ContextVar[Optional[Dict[str, Any]]] = ContextVar("ayii_scope", default=None)
+_label_var: ContextVar[Optional[str]] = ContextVar("ayii_label", default=None)
+
+
+def current_route() -> str:
+    """« GET /map » pendant une requête, « job:… » dans un job, sinon « - »."""
+    label = _label_var.get()
+    if label:
+        return label
+    scope = _scope_var.get()
+    if scope is None:
+        return "-"
+    route = getattr(scope.get("route"), "path", None) or "unmatched"
+    return f"{scope.get('method', '')} {route}"
+
+
+@contextmanager
+def attribute(label: str):
+    tok = _label_var.set(label)
+    try:
+        yield
+    finally:
+        _label_var.reset(tok)
+
+
+# -----------------------------------------------------------------------------
+# Middleware ASGI
+# -----------------------------------------------------------------------------
+class RequestMetricsMiddleware:
+    """Latence + statut par route. ASGI pur (pas de BaseHTTPMiddleware) : le
+    corps des réponses en flux n'est pas bufferisé, la durée court jusqu'au
+    dernier octet envoyé."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        t0 = time.perf_counter()
+        status = {"code": 500}
+
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        tok = _scope_var.set(scope)
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            _scope_var.reset(tok)
+            # la route est posée dans le scope par le routeur FastAPI après correspondance
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            method = scope.get("method", "")
+            http_latency.observe(time.perf_counter() - t0, method, route)
+            http_requests.inc(method, route, str(status["code"]))
@@ -0,0 +1,295 @@
+# app/services/tracing.py
+"""
+Traceur léger par requête (ContextVar) → en-tête Server-Timing + traces.
+
+- une Trace par requête HTTP, posée dans un ContextVar par le middleware ;
+  hors requête (jobs, scripts) tout est no-op (un .get() sur le ContextVar)
+- temps cumulés par catégorie, ajoutés là où ils sont déjà mesurés :
+    db    : requêtes SQL (app/services/sql_timing.py)
+    pool  : attente d'une connexion (app/db.py)
+    ext   : appels HTTP sortants, opérations de stockage
+    cache : lookups des caches (un raté inclut son chargement → recouvre db/ext)
+    ser   : fin de l'endpoint → début de la réponse (sérialisation JSON)
+    app   : total jusqu'à l'envoi des en-têtes
+- chaque réponse porte `Server-Timing: db;dur=…;desc="n", …` (visible dans
+  les devtools, et en JS via Timing-Allow-Origin)
+- arbre de spans (parent = span courant du ContextVar, SQL/HTTP en feuilles),
+  borné à TRACE_MAX_SPANS ; conservé dans un anneau (TRACE_KEEP) si la
+  requête est échantillonnée (TRACE_SAMPLE_RATE), forcée (en-tête
+  x-ayii-trace: 1) ou lente (≥ TRACE_SLOW_MS) → /admin/traces
+- coût par mesure : un append de liste ; pas de dépendance
+"""
+import asyncio
+import os
+import random
+import secrets
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, Deque, Dict, List, Optional
+
+# -------- Parameters (override via env if needed) ----------
+TRACING_ENABLED       = os.getenv("TRACING_ENABLED", "1") != "0"
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "1") != "0"
+TIMING_ALLOW_ORIGIN   = os.getenv("TIMING_ALLOW_ORIGIN", "*").strip()
+TRACE_SAMPLE_RATE     = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_SLOW_MS         = float(os.getenv("TRACE_SLOW_MS", "1000"))
+TRACE_KEEP            = int(os.getenv("TRACE_KEEP", "200"))
+TRACE_MAX_SPANS       = int(os.getenv("TRACE_MAX_SPANS", "128"))
+
+_FORCE_HEADER = b"x-ayii-trace"
+_ORDER = ("db", "pool", "ext", "cache", "ser")
+
+_trace_var: ContextVar[Optional["Trace"]] = ContextVar("ayii_trace", default=None)
+_span_var: ContextVar[int] = ContextVar("ayii_span", default=0)
+
+_ring: Deque[Dict[str, Any]] = deque(maxlen=TRACE_KEEP)
+_stats = {"traced": 0, "kept": 0, "spans_dropped": 0}
+
+
+class Trace:
+    __slots__ = ("id", "t0", "at", "sampled", "totals", "counts", "spans", "dropped", "endpoint_done", "head")
+
+    def __init__(self, sampled: bool):
+        self.id = secrets.token_hex(8)
+        self.t0 = time.perf_counter()
+        self.at = time.time()
+        self.sampled = sampled
+        self.totals: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        # span : [id, parent, nom, catégorie, début (s depuis t0), durée (s) | None]
+        self.spans: List[List[Any]] = []
+        self.dropped = 0
+        self.endpoint_done: Optional[float] = None
+        self.head: Optional[float] = None
+
+    def _open(self, parent: int, name: str, cat: Optional[str], start: float, dur: Optional[float]) -> int:
+        if len(self.spans) >= TRACE_MAX_SPANS:
+            self.dropped += 1
+            return 0
+        sid = len(self.spans) + 1
+        self.spans.append([sid, parent, name, cat, start - self.t0, dur])
+        return sid
+
+    def _count(self, cat: str, seconds: float) -> None:
+        self.totals[cat] = self.totals.get(cat, 0.0) + seconds
+        self.counts[cat] = self.counts.get(cat, 0) + 1
+
+    def timings(self) -> Dict[str, float]:
+        """Durées (s) par catégorie à l'instant des en-têtes."""
+        head = self.head or time.perf_counter()
+        out = dict(self.totals)
+        if self.endpoint_done is not None:
+            out["ser"] = max(0.0, head - self.endpoint_done)
+        out["app"] = head - self.t0
+        return out
+
+    def server_timing(self) -> str:
+        t = self.timings()
+        parts = []
+        for cat in _ORDER:
+            if cat in t:
+                n = self.counts.get(cat)
+                desc = f';desc="{n}"' if n else ""
+                parts.append(f"{cat};dur={t[cat] * 1000.0:.1f}{desc}")
+        parts.append(f"app;dur={t['app'] * 1000.0:.1f}")
+        return ", ".join(parts)
+
+
+# -----------------------------------------------------------------------------
+# API de mesure
+# -----------------------------------------------------------------------------
+def current_trace() -> Optional[Trace]:
+    return _trace_var.get()
+
+
+def add(cat: str, seconds: float, name: Optional[str] = None) -> None:
+    """Durée déjà mesurée (SQL, appel distant…) : cumul par catégorie et, si
+    `name`, feuille sous le span courant."""
+    tr = _trace_var.get()
+    if tr is None:
+        return
+    tr._count(cat, seconds)
+    if name is not None:
+        tr._open(_span_var.get(), name, cat, time.perf_counter() - seconds, seconds)
+
+
+@contextmanager
+def span(name: str, cat: Optional[str] = None):
+    """Bloc chronométré ; les mesures faites dedans deviennent ses enfants."""
+    tr = _trace_var.get()
+    if tr is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    sid = tr._open(_span_var.get(), name, cat, t0, None)
+    tok = _span_var.set(sid) if sid else None
+    try:
+        yield
+    finally:
+        dt = time.perf_counter() - t0
+        if tok is not None:
+            _span_var.reset(tok)
+        if sid:
+            tr.spans[sid - 1][5] = dt
+        if cat:
+            tr._count(cat, dt)
+
+
+def _mark_endpoint_done(call):
+    """Enveloppe un endpoint : note la fin de son exécution (début de la
+    sérialisation de son résultat par FastAPI)."""
+    if asyncio.iscoroutinefunction(call):
+        @wraps(call)
+        async def _async(*args, **kw):
+            try:
+                return await call(*args, **kw)
+            finally:
+                tr = _trace_var.get()
+                if tr is not None:
+                    tr.endpoint_done = time.perf_counter()
+        wrapped = _async
+    else:
+        # endpoint sync : exécuté dans le threadpool avec une copie du contexte
+        # (la Trace est partagée, la mutation est visible)
+        @wraps(call)
+        def _sync(*args, **kw):
+            try:
+                return call(*args, **kw)
+            finally:
+                tr = _trace_var.get()
+                if tr is not None:
+                    tr.endpoint_done = time.perf_counter()
+        wrapped = _sync
+    wrapped._ayii_traced = True
+    return wrapped
+
+
+def instrument_routes(app) -> None:
+    """À appeler une fois les routers inclus : chaque endpoint note sa fin
+    (FastAPI relit dependant.call à chaque requête)."""
+    from fastapi.routing import APIRoute
+
+    for route in app.routes:
+        if isinstance(route, APIRoute) and not getattr(route.dependant.call, "_ayii_traced", False):
+            route.dependant.call = _mark_endpoint_done(route.dependant.call)
+
+
+# -----------------------------------------------------------------------------
+# Middleware ASGI
+# -----------------------------------------------------------------------------
+class ServerTimingMiddleware:
+    """Pose la Trace de la requête, ajoute Server-Timing aux en-têtes de la
+    réponse, archive la trace si échantillonnée / forcée / lente."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not TRACING_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        forced = any(k == _FORCE_HEADER and v.strip() in (b"1", b"true") for k, v in scope.get("headers") or ())
+        tr = Trace(sampled=forced or random.random() < TRACE_SAMPLE_RATE)
+        status = {"code": 500}
+
+        async def _send(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                tr.head = time.perf_counter()
+                if SERVER_TIMING_ENABLED:
+                    headers = list(message.get("headers") or [])
+                    headers.append((b"server-timing", tr.server_timing().encode("latin-1")))
+                    if TIMING_ALLOW_ORIGIN:
+                        headers.append((b"timing-allow-origin", TIMING_ALLOW_ORIGIN.encode("latin-1")))
+                    if tr.sampled or (tr.head - tr.t0) * 1000.0 >= TRACE_SLOW_MS:
+                        headers.append((b"x-trace-id", tr.id.encode("latin-1")))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        tok = _trace_var.set(tr)
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            _trace_var.reset(tok)
+            _finish(tr, scope, status["code"])
+
+
+def _finish(tr: Trace, scope, status: int) -> None:
+    _stats["traced"] += 1
+    _stats["spans_dropped"] += tr.dropped
+    total_ms = (time.perf_counter() - tr.t0) * 1000.0
+    if not (tr.sampled or total_ms >= TRACE_SLOW_MS):
+        return
+    _stats["kept"] += 1
+    route = getattr(scope.get("route"), "path", None) or "unmatched"
+    _ring.append({
+        "id": tr.id,
+        "at": tr.at,
+        "method": scope.get("method", ""),
+        "route": route,
+        "path": scope.get("path", ""),  # sans query string (coordonnées, tokens)
+        "status": status,
+        "total_ms": round(total_ms, 1),
+        "timings_ms": {k: round(v * 1000.0, 1) for k, v in tr.timings().items()},
+        "counts": dict(tr.counts),
+        "reason": "sampled" if tr.sampled else "slow",
+        "spans_dropped": tr.dropped,
+        "_spans": [list(s) for s in tr.spans],
+    })
+
+
+# -----------------------------------------------------------------------------
+# Lecture
+# -----------------------------------------------------------------------------
+def _tree(spans: List[List[Any]]) -> List[Dict[str, Any]]:
+    nodes: Dict[int, Dict[str, Any]] = {}
+    roots: List[Dict[str, Any]] = []
+    for sid, parent, name, cat, start, dur in spans:
+        node = {
+            "name": name, "cat": cat,
+            "start_ms": round(start * 1000.0, 2),
+            "dur_ms": round(dur * 1000.0, 2) if dur is not None else None,
+            "children": [],
+        }
+        nodes[sid] = node
+        (nodes[parent]["children"] if parent in nodes else roots).append(node)
+    return roots
+
+
+def _summary(t: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in t.items() if not k.startswith("_")}
+
+
+def trace_list(limit: int = 50, route: Optional[str] = None, min_ms: float = 0.0) -> List[Dict[str, Any]]:
+    out = []
+    for t in reversed(_ring):
+        if route and t["route"] != route:
+            continue
+        if t["total_ms"] < min_ms:
+            continue
+        out.append(_summary(t))
+        if len(out) >= limit:
+            break
+    return out
+
+
+def trace_get(trace_id: str) -> Optional[Dict[str, Any]]:
+    for t in reversed(_ring):
+        if t["id"] == trace_id:
+            return {**_summary(t), "spans": _tree(t["_spans"])}
+    return None
+
+
+def tracing_stats() -> Dict[str, Any]:
+    return {
+        **_stats,
+        "enabled": TRACING_ENABLED,
+        "sample_rate": TRACE_SAMPLE_RATE,
+        "slow_ms": TRACE_SLOW_MS,
+        "ring": len(_ring),
+        "ring_max": TRACE_KEEP,
+    }
@@ -0,0 +1,288 @@
+# app/services/uploads.py
+"""
+Pipeline d'upload en streaming (mémoire bornée).
+
+- UploadGuardMiddleware : avant que FastAPI ne lise le multipart (il le
+  spoole en entier avant l'endpoint) : Content-Length trop grand → refus sans
+  lire le corps ; slot du budget pris avant la première lecture ; octets
+  comptés à la réception, dépassement → arrêt immédiat de la lecture
+- UploadStream : itère l'UploadFile par morceaux, re-vérifie la limite propre
+  au type de fichier (jamais de `await file.read()` complet)
+- UploadBudget : budget global (concurrence → mémoire max = slots × chunk)
+- save_stream_to_disk : écriture streaming sur disque, hors boucle d'événements
+  (les destinations Supabase / local / mémoire sont dans app/services/storage.py)
+"""
+import asyncio
+import hashlib
+import os
+import json
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+from fastapi import HTTPException, UploadFile
+from starlette.concurrency import run_in_threadpool
+
+from app.services.telemetry import upload_bytes, upload_duration
+
+# -------- Parameters (override via env if needed) ----------
+UPLOAD_CHUNK_BYTES     = int(os.getenv("UPLOAD_CHUNK_BYTES", str(256 * 1024)))
+UPLOAD_MAX_CONCURRENT  = int(os.getenv("UPLOAD_MAX_CONCURRENT", "8"))
+UPLOAD_QUEUE_TIMEOUT_S = float(os.getenv("UPLOAD_QUEUE_TIMEOUT_S", "20"))
+
+# marge du corps multipart au-delà du fichier (champs, en-têtes de parties, boundaries)
+UPLOAD_FORM_OVERHEAD   = int(os.getenv("UPLOAD_FORM_OVERHEAD", str(64 * 1024)))
+
+IMAGE_MAX_BYTES = 15 * 1024 * 1024
+VIDEO_MAX_BYTES = 50 * 1024 * 1024
+VIDEO_DIRECT_MAX_BYTES = 15 * 1024 * 1024  # /upload_video (sans session)
+VIDEO_DIRECT_TOO_LARGE = "video too large (max ~15MB)"
+
+# route POST → (budget, limite du fichier, status, detail) ; le type du fichier
+# n'est connu qu'après lecture du multipart : /upload_image est bornée par la
+# plus grande limite (vidéo), la limite image est ré-appliquée par UploadStream
+UPLOAD_GUARDED_ROUTES = {
+    "/upload_image": ("image", VIDEO_MAX_BYTES, 413, "file too large"),
+    "/upload_video": ("video", VIDEO_DIRECT_MAX_BYTES, 400, VIDEO_DIRECT_TOO_LARGE),
+}
+
+
+class StorageUploadError(RuntimeError):
+    def __init__(self, status_code: int, body: str = ""):
+        super().__init__(f"storage request failed [{status_code}]: {body}")
+        self.status_code = status_code
+        self.body = body
+
+
+# -----------------------------------------------------------------------------
+# Lecture en streaming
+# -----------------------------------------------------------------------------
+class UploadStream:
+    """Itère un UploadFile par morceaux de UPLOAD_CHUNK_BYTES.
+    Le corps a déjà été borné à la réception (UploadGuardMiddleware) ; ici la
+    limite propre au fichier est vérifiée à chaque morceau ; `prime()` rejette
+    d'emblée les fichiers vides ou dont la taille annoncée dépasse la limite.
+    Ré-itérable (on repart du début du fichier spoolé) : `digest()` fait une
+    passe locale pour le SHA-256 avant l'envoi au stockage (déduplication)."""
+
+    def __init__(
+        self,
+        file: UploadFile,
+        max_bytes: int,
+        too_large_detail: str = "file too large",
+        too_large_status: int = 413,
+    ):
+        self.file = file
+        self.max_bytes = int(max_bytes)
+        self.too_large_detail = too_large_detail
+        self.too_large_status = too_large_status
+        self.total = 0
+        self._first = b""
+        self._primed = False
+        self._digest: Optional[str] = None
+
+    @property
+    def size_hint(self) -> Optional[int]:
+        size = getattr(self.file, "size", None)
+        return int(size) if size is not None else None
+
+    def _too_large(self) -> HTTPException:
+        return HTTPException(status_code=self.too_large_status, detail=self.too_large_detail)
+
+    async def _read(self) -> bytes:
+        chunk = await self.file.read(UPLOAD_CHUNK_BYTES)
+        self.total += len(chunk)
+        if self.total > self.max_bytes:
+            raise self._too_large()
+        return chunk
+
+    async def prime(self) -> None:
+        hint = self.size_hint
+        if hint is not None and hint > self.max_bytes:
+            raise self._too_large()
+        await self.file.seek(0)
+        self.total = 0
+        self._first = await self._read()
+        if not self._first:
+            raise HTTPException(status_code=400, detail="empty file")
+        self._primed = True
+
+    async def digest(self) -> str:
+        """SHA-256 hex du contenu (limite de taille appliquée au passage)."""
+        if self._digest is None:
+            h = hashlib.sha256()
+            async for chunk in self:
+                h.update(chunk)
+            self._digest = h.hexdigest()
+        return self._digest
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        if not self._primed:
+            await self.prime()
+        self._primed = False
+        chunk, self._first = self._first, b""
+        while chunk:
+            yield chunk
+            chunk = await self._read()
+
+
+# -----------------------------------------------------------------------------
+# Budget global
+# -----------------------------------------------------------------------------
+class UploadBudget:
+    """Borne le nombre d'uploads simultanés (et donc la mémoire : slots × chunk)."""
+
+    def __init__(self, max_concurrent: int, chunk_bytes: int, wait_s: float):
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.chunk_bytes = int(chunk_bytes)
+        self.wait_s = float(wait_s)
+        self._sem = asyncio.Semaphore(self.max_concurrent)
+        self.in_flight = 0
+        self.peak = 0
+        self.rejected = 0
+        self.too_large = 0
+        self.completed = 0
+        self.bytes_total = 0
+
+    @property
+    def memory_bound_bytes(self) -> int:
+        return self.max_concurrent * self.chunk_bytes
+
+    @asynccontextmanager
+    async def slot(self, kind: str = "upload"):
+        try:
+            await asyncio.wait_for(self._sem.acquire(), timeout=self.wait_s)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise HTTPException(status_code=503, detail="upload capacity exhausted, retry later")
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        t0 = time.perf_counter()
+        try:
+            yield self
+        finally:
+            upload_duration.observe(time.perf_counter() - t0, kind)
+            self.in_flight -= 1
+            self.completed += 1
+            self._sem.release()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "max_concurrent": self.max_concurrent,
+            "chunk_bytes": self.chunk_bytes,
+            "memory_bound_bytes": self.memory_bound_bytes,
+            "in_flight": self.in_flight,
+            "peak": self.peak,
+            "rejected": self.rejected,
+            "too_large": self.too_large,
+            "completed": self.completed,
+            "bytes_total": self.bytes_total,
+        }
+
+
+upload_budget = UploadBudget(UPLOAD_MAX_CONCURRENT, UPLOAD_CHUNK_BYTES, UPLOAD_QUEUE_TIMEOUT_S)
+
+
+# -----------------------------------------------------------------------------
+# Garde à la réception (ASGI)
+# -----------------------------------------------------------------------------
+async def _send_error(send, status: int, detail: str) -> None:
+    body = json.dumps({"detail": detail}).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode("latin-1")),
+            (b"connection", b"close"),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class UploadGuardMiddleware:
+    """Applique UPLOAD_GUARDED_ROUTES pendant la réception du corps.
+    À monter à l'intérieur de CORS (les refus portent les en-têtes CORS)."""
+
+    def __init__(self, app, routes: Optional[Dict[str, tuple]] = None):
+        self.app = app
+        self.routes = UPLOAD_GUARDED_ROUTES if routes is None else routes
+
+    async def __call__(self, scope, receive, send):
+        rule = self.routes.get(scope.get("path", "")) if scope["type"] == "http" else None
+        if rule is None or scope.get("method") != "POST":
+            await self.app(scope, receive, send)
+            return
+
+        kind, max_file, status, detail = rule
+        limit = int(max_file) + UPLOAD_FORM_OVERHEAD
+
+        # 1) taille annoncée : refus avant toute lecture
+        for k, v in scope.get("headers") or ():
+            if k == b"content-length":
+                try:
+                    announced = int(v)
+                except ValueError:
+                    await _send_error(send, 400, "invalid content-length")
+                    return
+                if announced > limit:
+                    upload_budget.too_large += 1
+                    await _send_error(send, status, detail)
+                    return
+                break
+
+        # 2) comptage à la réception (corps chunked ou Content-Length mensonger)
+        received = 0
+        started = False
+
+        async def _receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    upload_budget.too_large += 1
+                    # FastAPI relaie l'HTTPException levée pendant la lecture du formulaire
+                    raise HTTPException(status_code=status, detail=detail)
+            return message
+
+        async def _send(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        # 3) slot pris avant la première lecture du corps (503 si la file est pleine)
+        try:
+            async with upload_budget.slot(kind):
+                await self.app(scope, _receive, _send)
+        except HTTPException as e:
+            if started:
+                raise
+            await _send_error(send, e.status_code, e.detail)
+
+
+# -----------------------------------------------------------------------------
+# Disque
+# -----------------------------------------------------------------------------
+async def save_stream_to_disk(stream: UploadStream, disk_path: str, *, account: bool = True) -> int:
+    """Écrit le flux sur disque ; open/write/close passent par le threadpool.
+    account=False pour les copies de travail (ne compte pas dans bytes_total)."""
+    await stream.prime()
+    os.makedirs(os.path.dirname(disk_path) or ".", exist_ok=True)
+    fp = await run_in_threadpool(open, disk_path, "wb")
+    try:
+        async for chunk in stream:
+            await run_in_threadpool(fp.write, chunk)
+    except BaseException:
+        await run_in_threadpool(fp.close)
+        try:
+            os.remove(disk_path)
+        except OSError:
+            pass
+        raise
+    await run_in_threadpool(fp.close)
+    if account:
+        upload_budget.bytes_total += stream.total
+        upload_bytes.observe(stream.total)
+    return stream.total
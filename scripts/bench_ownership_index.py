@@ -0,0 +1,150 @@
+# scripts/bench_ownership_index.py
+"""
+Micro-benchmark du contrôle de propriété des uploads :
+index mémoire (RecentReportIndex.find) vs requête SQL de repli
+(resolve_owned_report, index désactivé).
+
+    python scripts/bench_ownership_index.py                 # index seul (synthétique)
+    python scripts/bench_ownership_index.py --sql           # + SQL (DATABASE_URL requis)
+    python scripts/bench_ownership_index.py --users 50000 --per-user 10 --lookups 200000
+
+Index : N utilisateurs × M reports synthétiques autour de Paris, lookups
+aléatoires (≈ moitié dans le rayon). SQL : échantillon de reports réels des
+OWNERSHIP_LINK_HOURS dernières heures, mêmes lookups rejoués sur l'index
+alimenté avec ces lignes → latences comparables sur les mêmes entrées.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.services.recent_reports import OWNERSHIP_SIGNALS, RecentReportIndex  # noqa: E402
+
+PARIS = (48.8566, 2.3522)
+KINDS = ("blood", "urine", "feces", "vomit", "syringe", "broken_glass")
+RADIUS_M = float(os.getenv("OWNERSHIP_LINK_RADIUS_M", "150"))
+
+
+def _pct(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def _report(label, samples_s):
+    us = [s * 1e6 for s in samples_s]
+    print(
+        f"{label:<10} n={len(us):<7} mean={statistics.fmean(us):9.1f} us  "
+        f"p50={_pct(us, 0.50):9.1f} us  p99={_pct(us, 0.99):9.1f} us"
+    )
+
+
+def _jitter(lat, lng, meters):
+    # ~1e-5 degré ≈ 1,1 m
+    d = meters / 111_000.0
+    return lat + random.uniform(-d, d), lng + random.uniform(-d, d)
+
+
+def bench_index(users: int, per_user: int, lookups: int):
+    idx = RecentReportIndex(max_keys=users * len(KINDS), per_key=max(per_user, 1))
+    t0 = time.perf_counter()
+    for u in range(users):
+        for j in range(per_user):
+            lat, lng = _jitter(*PARIS, 5000)
+            idx.add(f"user-{u}", random.choice(KINDS), random.choice(OWNERSHIP_SIGNALS), lat, lng, f"r-{u}-{j}")
+    fill = time.perf_counter() - t0
+    print(f"index fill: {users * per_user} reports in {fill:.2f} s ({idx.stats()['keys']} keys)")
+
+    probes = []
+    for _ in range(lookups):
+        u = random.randrange(users)
+        key = (f"user-{u}", random.choice(KINDS))
+        entries = idx._data.get(key)
+        if entries and random.random() < 0.5:
+            _, _, lat, lng, _ = random.choice(entries)
+            probes.append((key, _jitter(lat, lng, RADIUS_M / 3)))
+        else:
+            probes.append((key, _jitter(*PARIS, 5000)))
+
+    samples = []
+    for (uid, kind), (lat, lng) in probes:
+        t = time.perf_counter()
+        idx.find(uid, kind, lat, lng, RADIUS_M)
+        samples.append(time.perf_counter() - t)
+    _report("index", samples)
+    print(f"index stats: {idx.stats()}")
+
+
+async def bench_sql(samples_n: int):
+    from sqlalchemy import text
+
+    from app.db import AsyncSessionLocal
+    from app.services import attachment_links
+    from app.services.attachment_links import resolve_owned_report
+    from app.services.recent_reports import OWNERSHIP_LINK_HOURS
+
+    attachment_links.RECENT_INDEX_ENABLED = False  # force le repli SQL
+    async with AsyncSessionLocal() as db:
+        rs = await db.execute(text("""
+            SELECT user_id::text AS uid, LOWER(TRIM(kind::text)) AS kind,
+                   LOWER(TRIM(signal::text)) AS signal,
+                   ST_Y(geom::geometry) AS lat, ST_X(geom::geometry) AS lng,
+                   id::text AS id, EXTRACT(EPOCH FROM created_at)::float8 AS ts
+              FROM reports
+             WHERE user_id IS NOT NULL
+               AND created_at > NOW() - make_interval(hours => :h)
+               AND LOWER(TRIM(signal::text)) = ANY(:signals)
+             ORDER BY random()
+             LIMIT :n
+        """), {"h": OWNERSHIP_LINK_HOURS, "signals": list(OWNERSHIP_SIGNALS), "n": samples_n})
+        rows = rs.mappings().all()
+        if not rows:
+            print("sql: no recent reports with user_id, nothing to measure")
+            return
+
+        idx = RecentReportIndex()
+        for r in rows:
+            idx.add(r["uid"], r["kind"], r["signal"], r["lat"], r["lng"], r["id"], r["ts"])
+
+        probes = [(r["uid"], r["kind"], *_jitter(r["lat"], r["lng"], RADIUS_M / 3)) for r in rows]
+        await resolve_owned_report(  # échauffement (pool, plan de requête)
+            db, kind=probes[0][1], lat=probes[0][2], lng=probes[0][3],
+            signals=OWNERSHIP_SIGNALS, user_id=probes[0][0],
+        )
+
+        sql_s, idx_s, agree = [], [], 0
+        for uid, kind, lat, lng in probes:
+            t = time.perf_counter()
+            a = await resolve_owned_report(db, kind=kind, lat=lat, lng=lng, signals=OWNERSHIP_SIGNALS, user_id=uid)
+            sql_s.append(time.perf_counter() - t)
+            t = time.perf_counter()
+            b = idx.find(uid, kind, lat, lng, RADIUS_M)
+            idx_s.append(time.perf_counter() - t)
+            agree += (b is None or a == b)  # None = repli SQL, jamais une réponse fausse
+        _report("sql", sql_s)
+        _report("index", idx_s)
+        print(f"same answer (or index fallback): {agree}/{len(probes)}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--users", type=int, default=10_000)
+    ap.add_argument("--per-user", type=int, default=5)
+    ap.add_argument("--lookups", type=int, default=100_000)
+    ap.add_argument("--sql", action="store_true", help="compare à la requête SQL (DATABASE_URL)")
+    ap.add_argument("--samples", type=int, default=200, help="lookups SQL (reports réels)")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    random.seed(args.seed)
+    bench_index(args.users, args.per_user, args.lookups)
+    if args.sql:
+        asyncio.run(bench_sql(args.samples))
+
+
+if __name__ == "__main__":
+    main()
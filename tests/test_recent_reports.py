@@ -0,0 +1,162 @@
+# tests/test_recent_reports.py
+import math
+
+import pytest
+
+from app.services import recent_reports as rr
+from app.services.recent_reports import RecentReportIndex, haversine_m
+
+LAT, LNG = 48.8566, 2.3522
+R = 150.0
+
+
+def _north(meters: float) -> float:
+    """Latitude à `meters` au nord de LAT (même longitude → haversine exact)."""
+    return LAT + math.degrees(meters / rr._EARTH_R_M)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = {"t": 1_700_000_000.0}
+    monkeypatch.setattr(rr.time, "time", lambda: now["t"])
+    return now
+
+
+@pytest.fixture
+def idx(clock):
+    return RecentReportIndex(max_keys=100, per_key=10, window_h=48)
+
+
+def test_haversine_north_offset():
+    assert haversine_m(LAT, LNG, _north(100.0), LNG) == pytest.approx(100.0, abs=1e-6)
+
+
+def test_add_then_find_hit(idx):
+    idx.add("U1", "Blood", "to_clean", LAT, LNG, "r1")
+    assert idx.find("u1", "blood", _north(50), LNG, R) == "r1"
+    assert idx.stats()["hits"] == 1
+
+
+def test_add_ignores_other_signals_and_missing_ids(idx):
+    idx.add("u1", "blood", "restored", LAT, LNG, "r1")
+    idx.add(None, "blood", "cut", LAT, LNG, "r2")
+    idx.add("u1", "blood", "cut", LAT, LNG, None)
+    assert idx.stats()["entries"] == 0
+
+
+def test_add_same_report_twice_keeps_one_entry(idx):
+    idx.add("u1", "blood", "cut", LAT, LNG, "r1")
+    idx.add("u1", "blood", "cut", LAT, LNG, "r1")
+    assert idx.stats()["entries"] == 1
+
+
+def test_find_filters_by_user_and_kind(idx):
+    idx.add("u1", "blood", "cut", LAT, LNG, "r1")
+    assert idx.find("u2", "blood", LAT, LNG, R) is None
+    assert idx.find("u1", "urine", LAT, LNG, R) is None
+    assert idx.find("u1", "blood", LAT, LNG, R) == "r1"
+
+
+def test_find_filters_by_signal(idx):
+    idx.add("u1", "blood", "cut", LAT, LNG, "r1")
+    assert idx.find("u1", "blood", LAT, LNG, R, signals=("to_clean",)) is None
+    assert idx.find("u1", "blood", LAT, LNG, R, signals=("CUT",)) == "r1"
+
+
+def test_find_returns_most_recent_match(idx, clock):
+    idx.add("u1", "blood", "cut", LAT, LNG, "old")
+    clock["t"] += 60
+    idx.add("u1", "blood", "cut", LAT, LNG, "new")
+    assert idx.find("u1", "blood", LAT, LNG, R) == "new"
+
+
+def test_find_filters_by_report_id(idx, clock):
+    idx.add("u1", "blood", "cut", LAT, LNG, "r1")
+    clock["t"] += 60
+    idx.add("u1", "blood", "cut", LAT, LNG, "r2")
+    assert idx.find("u1", "blood", LAT, LNG, R, report_id="r1") == "r1"
+    assert idx.find("u1", "blood", LAT, LNG, R, report_id="r3") is None
+
+
+def test_report_id_out_of_radius_is_not_replaced_by_another(idx, clock):
+    idx.add("u1", "blood", "cut", _north(1000), LNG, "far")
+    clock["t"] += 60
+    idx.add("u1", "blood", "cut", LAT, LNG, "near")
+    assert idx.find("u1", "blood", LAT, LNG, R, report_id="far") is None
+
+
+def test_radius_edge_falls_back_to_sql(idx):
+    # entre R × 0,995 et R / 0,995 : l'index ne tranche pas (None + compteur edge)
+    idx.add("u1", "blood", "cut", _north(R * 0.999), LNG, "r1")
+    assert idx.find("u1", "blood", LAT, LNG, R) is None
+    assert idx.stats()["edge"] == 1
+    idx.add("u1", "blood", "cut", _north(R * 1.003), LNG, "r1")
+    assert idx.find("u1", "blood", LAT, LNG, R) is None
+    assert idx.stats()["edge"] == 2
+
+
+def test_radius_inside_margin_hits_and_outside_misses(idx):
+    idx.add("u1", "blood", "cut", _north(R * 0.99), LNG, "r1")
+    assert idx.find("u1", "blood", LAT, LNG, R) == "r1"
+    idx.add("u1", "blood", "cut", _north(R * 1.01), LNG, "r1")
+    assert idx.find("u1", "blood", LAT, LNG, R) is None
+    assert idx.stats()["edge"] == 0
+
+
+def test_edge_entry_stops_scan_before_older_hit(idx, clock):
+    # un report plus ancien franchement dans le rayon ne doit pas masquer le cas limite
+    idx.add("u1", "blood", "cut", LAT, LNG, "older")
+    clock["t"] += 60
+    idx.add("u1", "blood", "cut", _north(R), LNG, "edge")
+    assert idx.find("u1", "blood", LAT, LNG, R) is None
+
+
+def test_expired_entries_are_pruned_on_find(idx, clock):
+    idx.add("u1", "blood", "cut", LAT, LNG, "r1")
+    clock["t"] += 48 * 3600 + 1
+    assert idx.find("u1", "blood", LAT, LNG, R) is None
+    assert idx.stats()["keys"] == 0
+
+
+def test_expired_entries_are_pruned_on_add(idx, clock):
+    idx.add("u1", "blood", "cut", LAT, LNG, "r1")
+    clock["t"] += 48 * 3600 + 1
+    idx.add("u1", "blood", "cut", LAT, LNG, "r2")
+    assert idx.stats()["entries"] == 1
+    assert idx.find("u1", "blood", LAT, LNG, R) == "r2"
+
+
+def test_add_with_old_created_ts_is_not_kept(idx, clock):
+    idx.add("u1", "blood", "cut", LAT, LNG, "r1", created_ts=clock["t"] - 49 * 3600)
+    assert idx.find("u1", "blood", LAT, LNG, R) is None
+
+
+def test_discard_removes_entry_and_empty_key(idx):
+    idx.add("u1", "blood", "cut", LAT, LNG, "r1")
+    idx.add("u1", "urine", "cut", LAT, LNG, "r2")
+    idx.add("u1", "urine", "cut", LAT, LNG, "r3")
+    idx.discard("r1")
+    idx.discard("r2")
+    assert idx.find("u1", "blood", LAT, LNG, R) is None
+    assert idx.find("u1", "urine", LAT, LNG, R) == "r3"
+    assert idx.stats()["keys"] == 1
+
+
+def test_per_key_cap_keeps_most_recent(clock):
+    idx = RecentReportIndex(max_keys=10, per_key=2, window_h=48)
+    for i in range(3):
+        idx.add("u1", "blood", "cut", LAT, LNG, f"r{i}")
+        clock["t"] += 1
+    assert idx.stats()["entries"] == 2
+    assert idx.find("u1", "blood", LAT, LNG, R, report_id="r0") is None
+
+
+def test_max_keys_evicts_least_recently_used(clock):
+    idx = RecentReportIndex(max_keys=2, per_key=5, window_h=48)
+    idx.add("u1", "blood", "cut", LAT, LNG, "r1")
+    idx.add("u2", "blood", "cut", LAT, LNG, "r2")
+    assert idx.find("u1", "blood", LAT, LNG, R) == "r1"  # u1 redevient le plus récent
+    idx.add("u3", "blood", "cut", LAT, LNG, "r3")
+    assert idx.find("u2", "blood", LAT, LNG, R) is None
+    assert idx.find("u1", "blood", LAT, LNG, R) == "r1"
+    assert idx.stats()["evictions"] == 1